@@ -4,7 +4,12 @@ import core.models as core_models
 
 @admin.register(core_models.SearchQuery)
 class SearchQueryAdmin(admin.ModelAdmin):
-    list_display = ('query', 'curriculum', 'id')
+    list_display = ('query', 'dataset', 'curriculum', 'id')
+
+
+@admin.register(core_models.PendingIndexBuild)
+class PendingIndexBuildAdmin(admin.ModelAdmin):
+    list_display = ('dataset', 'partition', 'marked_at', 'id')
 
 
 @admin.register(core_models.School)
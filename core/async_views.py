@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import json
+from json import JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views import View
+from services.src.matcher_pool import SearchDeadlineExceeded
+from services.src.check_pickle_exists import IndexNotBuilt
+from core import views as sync_views
+from core.serializers import SchoolQuerySerializer, SubjectQuerySerializer, CollegeQuerySerializer, MajorQuerySerializer
+from core.search_cache import search_cache
+from core.query_log import query_log
+from core.engines import engine_manager, EngineWarmingUp, EngineUnavailable
+
+
+# The searches of the async views run here, so the CPU work of a process stays bounded however many connections it holds
+search_executor = ThreadPoolExecutor(max_workers=settings.SEARCH_ASYNC_VIEWS['WORKERS'], thread_name_prefix="search")
+
+class AsyncSearchView(View):
+    dataset = None
+    serializer_class = None
+    subject = False
+    sync_view = None
+
+    """
+    Async version of the search GET of a dataset, for ASGI servers.
+    The body is parsed and validated on the event loop, SearchEngine.search runs in the size limited
+    search_executor, and the SearchQuery goes to the query log buffer. The results have the same
+    {"data": [...]} shape as the sync views. POST requests are handed to the sync view of the dataset.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Like the DRF views, the search API does not use CSRF
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    def filter_dict(self, data: dict):
+        return None
+
+    async def get(self, request):
+        try:
+            data = json.loads(request.body or b"null")
+        except JSONDecodeError:
+            return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
+
+        serializer = self.serializer_class(data=data)
+        if not serializer.is_valid():
+            return JsonResponse({"result": "error", "errors": serializer.errors}, status=400)
+
+        try:
+            engine = engine_manager.get_engine(self.dataset)
+        except EngineWarmingUp as error:
+            return sync_views.warming_up_response(error)
+        except EngineUnavailable as error:
+            return sync_views.unavailable_response(error)
+
+        options = serializer.get_search_options()
+        if self.subject:
+            options["subject"] = True
+        search = functools.partial(search_cache.search, self.dataset, engine,
+                                   serializer.validated_data.get('query'),
+                                   self.filter_dict(serializer.validated_data),
+                                   **options)
+
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(search_executor, search)
+        except SearchDeadlineExceeded as error:
+            return sync_views.deadline_response(error)
+        except IndexNotBuilt as error:
+            return sync_views.not_built_response(error)
+
+        query_log.log(serializer.get_query_fields(), dataset=self.dataset)
+        return JsonResponse({"data": results})
+
+    async def post(self, request):
+        return await sync_to_async(self.sync_view.as_view())(request)
+
+
+class AsyncSchoolSearchView(AsyncSearchView):
+    dataset = "school"
+    serializer_class = SchoolQuerySerializer
+    sync_view = sync_views.SchoolAPIView
+
+    def filter_dict(self, data: dict):
+        return {'curriculum__abbreviation': data.get('curriculum').upper()}
+
+
+class AsyncSubjectSearchView(AsyncSearchView):
+    dataset = "subject"
+    serializer_class = SubjectQuerySerializer
+    subject = True
+    sync_view = sync_views.SubjectAPIView
+
+    def filter_dict(self, data: dict):
+        return sync_views.subject_filter_dict(data)
+
+
+class AsyncCollegeSearchView(AsyncSearchView):
+    dataset = "college"
+    serializer_class = CollegeQuerySerializer
+    sync_view = sync_views.CollegeAPIView
+
+
+class AsyncMajorSearchView(AsyncSearchView):
+    dataset = "major"
+    serializer_class = MajorQuerySerializer
+    sync_view = sync_views.MajorAPIView
@@ -0,0 +1,346 @@
+import threading
+import time
+import traceback
+from django.conf import settings
+from services.src import search_engine
+from services.src.corpus_snapshot import CorpusSnapshot
+from services.src.check_pickle_exists import CheckPickleExists
+from services.src.ann_index import AnnIndexBuilder
+from core.models import Curriculum, School, College, Subject, Major, PendingIndexBuild
+
+
+class EngineWarmingUp(Exception):
+    """Raised when a search engine is asked for before it has finished loading."""
+
+
+class EngineUnavailable(Exception):
+
+    """
+    Raised when the search engine of a dataset failed to load, until its next retry.
+    Carries the error of the last attempt, and the seconds until the engine is retried.
+    """
+
+    def __init__(self, dataset: str, reason: str, retry_in: float):
+        super().__init__("The {} search engine failed to load: {}".format(dataset, reason))
+        self.dataset = dataset
+        self.reason = reason
+        self.retry_in = retry_in
+
+
+def get_curriculum_list() -> list:
+    return list(Curriculum.objects.values_list("abbreviation", flat=True))
+
+
+def get_index_source(dataset: str) -> tuple:
+    # The rows of a dataset and its partition options, shared by the engines and the build_search_index command
+    if dataset == "school":
+        return School.objects.select_related('curriculum'), get_curriculum_list()
+    if dataset == "subject":
+        return Subject.objects.select_related('curriculum'), get_curriculum_list()
+    if dataset == "college":
+        return College.objects.all(), None
+    if dataset == "major":
+        return Major.objects.all(), None
+    raise KeyError(dataset)
+
+
+def load_snapshot(dataset: str) -> CorpusSnapshot:
+    queryset, _ = get_index_source(dataset)
+    return CorpusSnapshot.from_queryset(queryset, dataset)
+
+
+def build_engine(dataset: str, snapshot: CorpusSnapshot = None):
+    # Unless SEARCH_INDEX_BUILD_ON_LOAD is set, the engine only loads the embeddings built by build_search_index
+    queryset, options = get_index_source(dataset)
+    return search_engine.SearchEngine(queryset, dataset, options,
+                                      ann_index=settings.SEARCH_ANN_INDEX,
+                                      train_options=settings.SEARCH_TRAIN_OPTIONS,
+                                      build_index=bool(settings.SEARCH_INDEX['BUILD_ON_LOAD']),
+                                      snapshot=snapshot)
+
+
+def build_index_partition(checker: CheckPickleExists, option: str) -> dict:
+    # Encodes the new rows of a partition, and refreshes its ANN index when it is enabled
+    report = checker.build_partition(option)
+
+    ann_index = settings.SEARCH_ANN_INDEX
+    if ann_index.get("ENABLED"):
+        builder = AnnIndexBuilder(n_probe=ann_index.get("N_PROBE", 8),
+                                  min_rows=ann_index.get("MIN_ROWS", 20000),
+                                  store=checker.loader.store)
+        embeddings = checker.loader.load_embeddings(report["file_name"])
+        builder.get_index(embeddings, report["file_name"])
+
+    return report
+
+
+def mark_pending_partitions(dataset: str, partitions: list) -> None:
+    # The web process does not encode: the partitions rows were added to are built by "build_search_index --pending"
+    for partition in partitions:
+        PendingIndexBuild.objects.update_or_create(dataset=dataset, partition=partition)
+
+
+def clear_pending_partition(dataset: str, partition: str, read_at) -> None:
+    # A partition built from the rows read at read_at no longer waits for the rows marked before then
+    PendingIndexBuild.objects.filter(dataset=dataset, partition=partition, marked_at__lte=read_at).delete()
+
+
+def get_pending_partitions() -> dict:
+    pending = {}
+    for dataset, partition in PendingIndexBuild.objects.values_list("dataset", "partition"):
+        pending.setdefault(dataset, set()).add(partition)
+    return pending
+
+
+def build_school_engine(snapshot: CorpusSnapshot = None):
+    return build_engine("school", snapshot)
+
+
+def build_college_engine(snapshot: CorpusSnapshot = None):
+    return build_engine("college", snapshot)
+
+
+def build_subject_engine(snapshot: CorpusSnapshot = None):
+    return build_engine("subject", snapshot)
+
+
+def build_major_engine(snapshot: CorpusSnapshot = None):
+    return build_engine("major", snapshot)
+
+
+class EngineManager:
+
+    """
+    Manages the lifecycle of the search engines, instead of building them when core/views.py is imported.
+    Every dataset goes through the states "pending", "warming", "ready" or "failed".
+    Engines are built on a background thread, either all of them at startup with warm_up(),
+    or one at a time when a request first asks for it. A request for an engine that is not ready
+    gets EngineWarmingUp instead of waiting, so the admin and the health checks are served meanwhile.
+    A failed engine stays failed: its requests get EngineUnavailable with the error, and it is only built again
+    after a backoff (retry_seconds, doubled after each failure up to max_retry_seconds), or by reload().
+    A ready engine can be rebuilt with reload() after rows were added, it keeps serving until the new one replaces it.
+    The engines never encode in the web process, unless SEARCH_INDEX_BUILD_ON_LOAD is set. The embeddings are built
+    by build_search_index, and every watch_seconds each process reloads the engines whose embedding files have
+    a new version on disk, see watch(). So all the workers pick up a build, not only the one that got the rows.
+    """
+
+    def __init__(self, factories: dict, retry_seconds: float = 60, max_retry_seconds: float = 3600,
+                 watch_seconds: float = 0):
+        self.factories = factories
+        self.watch_seconds = watch_seconds
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.engines = {}
+        self.states = {dataset: "pending" for dataset in factories}
+        self.errors = {}
+        self.timings = {}
+        self.failures = {}
+        self.retry_at = {}
+        self.reloading = set()
+        self.stale = set()
+        self.watching = False
+        self.watch_stopped = threading.Event()
+        self.lock = threading.Lock()
+
+
+    def get_engine(self, dataset: str):
+        engine = self.engines.get(dataset)
+        if engine is not None:
+            return engine
+
+        with self.lock:
+            failed = self.states[dataset] == "failed"
+            retry_in = self.retry_at.get(dataset, 0) - time.monotonic()
+            error = self.errors.get(dataset)
+
+        # A failed engine is not rebuilt by every request, only once its backoff is over
+        if failed and retry_in > 0:
+            raise EngineUnavailable(dataset, error, retry_in)
+
+        # A pending engine, or a failed one due for a retry, is built in the background
+        self.start([dataset], retry_failed=True)
+        raise EngineWarmingUp("The {} search engine is warming up, please retry shortly".format(dataset))
+
+
+    def start(self, datasets: list = None, retry_failed: bool = False) -> None:
+        datasets = datasets or list(self.factories)
+        states = ("pending", "failed") if retry_failed else ("pending",)
+
+        with self.lock:
+            to_build = [dataset for dataset in datasets if self.states[dataset] in states]
+            for dataset in to_build:
+                self.states[dataset] = "warming"
+
+        if to_build:
+            thread = threading.Thread(target=self.build, args=(to_build,), name="search-engine-warm-up", daemon=True)
+            thread.start()
+
+
+    def warm_up(self, mode: str = "background") -> None:
+        # "background" builds every engine at startup, "lazy" leaves each engine to its first request
+        if mode == "background":
+            self.start()
+        self.watch()
+
+
+    def watch(self) -> None:
+        # One thread per process checks the embedding files of the ready engines every watch_seconds
+        with self.lock:
+            if self.watch_seconds <= 0 or self.watching:
+                return
+            self.watching = True
+            self.watch_stopped.clear()
+
+        thread = threading.Thread(target=self.run_watch, name="search-index-watch", daemon=True)
+        thread.start()
+
+
+    def run_watch(self) -> None:
+        while not self.watch_stopped.wait(self.watch_seconds):
+            self.reload_changed()
+
+        with self.lock:
+            self.watching = False
+
+
+    def stop_watch(self) -> None:
+        self.watch_stopped.set()
+
+
+    def reload_changed(self) -> list:
+
+        """
+        Reload the ready engines whose embedding files have a new version on disk, or whose missing partitions
+        have been built since they were loaded. Only the manifests are read, the rows are read by the reload.
+        Returns the datasets that are reloaded.
+        """
+
+        changed = []
+        for dataset, engine in list(self.engines.items()):
+            try:
+                if engine.embeddings_changed():
+                    changed.append(dataset)
+            except Exception:
+                # A manifest being replaced is read again on the next check
+                traceback.print_exc()
+
+        for dataset in changed:
+            print("The", dataset, "embeddings have a new version, reloading the search engine")
+            self.reload(dataset)
+        return changed
+
+
+    def build(self, datasets: list) -> None:
+        for dataset in datasets:
+            start = time.perf_counter()
+            try:
+                engine = self.factories[dataset]()
+            except Exception as error:
+                traceback.print_exc()
+                with self.lock:
+                    self.states[dataset] = "failed"
+                    self.errors[dataset] = repr(error)
+                    self.failures[dataset] = self.failures.get(dataset, 0) + 1
+                    backoff = self.retry_seconds * 2 ** (self.failures[dataset] - 1)
+                    self.retry_at[dataset] = time.monotonic() + min(backoff, self.max_retry_seconds)
+                continue
+
+            with self.lock:
+                self.engines[dataset] = engine
+                self.states[dataset] = "ready"
+                self.errors.pop(dataset, None)
+                self.failures.pop(dataset, None)
+                self.retry_at.pop(dataset, None)
+                self.timings[dataset] = round(time.perf_counter() - start, 3)
+
+
+    def reload(self, dataset: str) -> None:
+
+        """
+        Rebuild the engine of a dataset in the background, after rows were added to it.
+        The new rows are found by the abbreviation search right away. The engine only serves embeddings that are
+        built by build_search_index, see watch(), or encodes them itself when SEARCH_INDEX_BUILD_ON_LOAD is set.
+        Reloads asked for while one is running are folded into one more rebuild, instead of starting a thread each.
+        The rows are read first, and the engine is not rebuilt when they and its embedding files have not changed.
+        """
+
+        with self.lock:
+            if self.states[dataset] != "ready":
+                # An engine that is not built yet reads the new rows when it is
+                to_start = True
+            else:
+                to_start = False
+                self.stale.add(dataset)
+                if dataset in self.reloading:
+                    return
+                self.reloading.add(dataset)
+
+        if to_start:
+            # A failed engine is retried right away, the rows it failed on may have been fixed
+            self.start([dataset], retry_failed=True)
+            return
+
+        thread = threading.Thread(target=self.run_reload, args=(dataset,), name="search-engine-reload", daemon=True)
+        thread.start()
+
+
+    def run_reload(self, dataset: str) -> None:
+        while True:
+            with self.lock:
+                if dataset not in self.stale:
+                    self.reloading.discard(dataset)
+                    return
+                self.stale.discard(dataset)
+
+            start = time.perf_counter()
+            try:
+                snapshot = load_snapshot(dataset)
+                if self.engines[dataset].is_current(snapshot):
+                    print("The", dataset, "search engine is up to date, not reloaded")
+                    continue
+                engine = self.factories[dataset](snapshot)
+            except Exception as error:
+                # The previous engine keeps serving
+                traceback.print_exc()
+                with self.lock:
+                    self.errors[dataset] = repr(error)
+                continue
+
+            with self.lock:
+                self.engines[dataset] = engine
+                self.errors.pop(dataset, None)
+                self.timings[dataset] = round(time.perf_counter() - start, 3)
+
+
+    def is_ready(self) -> bool:
+        return all(state == "ready" for state in self.states.values())
+
+
+    def status(self) -> dict:
+        # A ready engine lists the partitions it does not serve because their embeddings are not built
+        now = time.monotonic()
+        with self.lock:
+            return {
+                dataset: {
+                    "state": state,
+                    "seconds": self.timings.get(dataset),
+                    "error": self.errors.get(dataset),
+                    "retry_in": round(max(0, self.retry_at[dataset] - now), 1) if state == "failed" else None,
+                    "missing_partitions": sorted(self.engines[dataset].missing_partitions)
+                    if dataset in self.engines else [],
+                }
+                for dataset, state in self.states.items()
+            }
+
+
+engine_manager = EngineManager(
+    {
+        "school": build_school_engine,
+        "college": build_college_engine,
+        "subject": build_subject_engine,
+        "major": build_major_engine,
+    },
+    retry_seconds=settings.SEARCH_ENGINE_RETRY['SECONDS'],
+    max_retry_seconds=settings.SEARCH_ENGINE_RETRY['MAX_SECONDS'],
+    watch_seconds=settings.SEARCH_INDEX['WATCH_SECONDS'],
+)
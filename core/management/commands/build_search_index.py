@@ -0,0 +1,93 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from services.src.check_pickle_exists import CheckPickleExists
+from core.engines import (engine_manager, get_index_source, build_index_partition,
+                          get_pending_partitions, clear_pending_partition)
+
+
+class Command(BaseCommand):
+    help = "Build or refresh the embeddings (and ANN indexes) of every dataset and curriculum partition"
+
+    """
+    The embeddings are built here, offline, instead of by the first web worker that loads a search engine.
+    Every partition (one file per dataset and curriculum) is encoded when it has no file yet, and otherwise
+    brought up to date with the database, encoding only the new rows. The partitions are built in parallel
+    on a pool of threads. Each build is written as a new version of the partition's files, see EmbeddingStore.
+    The web workers reload their engines once the new versions appear, see EngineManager.watch().
+    Legacy "<name>.pkl" files are converted here, the web process never converts or encodes.
+    With --pending only the partitions the web process recorded rows for are built (see PendingIndexBuild),
+    which is what a cron job or an offline worker runs. A built partition's records are deleted,
+    unless rows were recorded after its rows were read.
+    Prints the rows, encoded and deleted values, version and time of each partition, and exits with
+    a non-zero status when any of them failed.
+
+    python manage.py build_search_index
+    python manage.py build_search_index --pending
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dataset", action="append", choices=list(engine_manager.factories),
+                            help="Only build this dataset, can be repeated. All datasets by default.")
+        parser.add_argument("--workers", type=int, default=settings.SEARCH_INDEX['WORKERS'],
+                            help="Number of partitions built at once.")
+        parser.add_argument("--pending", action="store_true",
+                            help="Only build the partitions that rows were added to through the API.")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        datasets = options["dataset"] or list(engine_manager.factories)
+
+        pending = get_pending_partitions()
+        if options["pending"]:
+            datasets = [dataset for dataset in datasets if dataset in pending]
+            if not datasets:
+                self.stdout.write("No partitions are pending")
+                return
+
+        # The rows of every dataset are read first, on this thread
+        read_at = timezone.now()
+        partitions = []
+        failures = []
+        for dataset in datasets:
+            try:
+                queryset, partition_options = get_index_source(dataset)
+                checker = CheckPickleExists(queryset, dataset, partition_options,
+                                            train_options=settings.SEARCH_TRAIN_OPTIONS, build=False)
+                checker.load_snapshot()
+            except Exception as error:
+                failures.append((dataset, None, error))
+                continue
+            partitions += [(checker, option) for option in checker.get_file_names()
+                           if not options["pending"] or option in pending[dataset]]
+
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"]), thread_name_prefix="build-index") as executor:
+            futures = [(checker, option, executor.submit(build_index_partition, checker, option))
+                       for checker, option in partitions]
+
+        reports = []
+        for checker, option, future in futures:
+            try:
+                reports.append(future.result())
+            except Exception as error:
+                failures.append((checker.dataset, option, error))
+
+        for report in reports:
+            clear_pending_partition(report["dataset"], report["partition"], read_at)
+            self.stdout.write("{dataset:<8} {partition:<8} rows={rows:<8} encoded={encoded:<8} deleted={deleted:<8} "
+                              "version={version} {seconds}s".format(**report))
+
+        self.stdout.write("Built {} partitions, {} rows, {} encoded, in {}s".format(
+            len(reports),
+            sum(report["rows"] for report in reports),
+            sum(report["encoded"] for report in reports),
+            round(time.perf_counter() - start, 3)))
+
+        if failures:
+            for dataset, option, error in failures:
+                self.stderr.write("{} {} failed:".format(dataset, option or ""))
+                self.stderr.write("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+            raise CommandError("{} of the partitions failed".format(len(failures)))
@@ -0,0 +1,80 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from core.replay import (DATASET_PATHS, load_search_log, read_log_file, write_log_file,
+                         InProcessTarget, HttpTarget, TrafficReplay)
+
+
+class Command(BaseCommand):
+    help = "Replay the logged searches (SearchQuery) against a running instance or the in-process search engines"
+
+    """
+    Load testing with the real query mix: the searches of the SearchQuery table, or of a sample exported with
+    --export, are replayed on their own datasets at each --concurrency level, optionally at a fixed --rate.
+    With --url they are sent to a running instance, otherwise they run on search engines built in this process.
+    Prints the throughput, latency percentiles and errors of every level and the level where the target saturated,
+    and writes the whole report, with the latency of every dataset, as JSON with --output.
+
+    python manage.py replay_search_log --limit 5000 --export sample.ndjson
+    python manage.py replay_search_log --input sample.ndjson --url http://localhost:8000 --concurrency 1 4 16 64
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--input", help="Exported log to replay (NDJSON or CSV), the SearchQuery table by default.")
+        parser.add_argument("--limit", type=int, help="Only the last N searches of the SearchQuery table.")
+        parser.add_argument("--dataset", action="append", choices=list(DATASET_PATHS),
+                            help="Only replay this dataset, can be repeated. All datasets by default.")
+        parser.add_argument("--default-dataset", choices=list(DATASET_PATHS),
+                            help="Dataset of the old rows logged with only a query. They are skipped by default.")
+        parser.add_argument("--export", help="Write the searches to this NDJSON file and exit, without replaying them.")
+        parser.add_argument("--url", help="Base URL of a running instance. In process by default.")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds before an HTTP request fails.")
+        parser.add_argument("--no-cache", action="store_true", help="In process, search without the result cache.")
+        parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 2, 4, 8, 16],
+                            help="Concurrency levels, one step each.")
+        parser.add_argument("--requests", type=int, help="Searches of each step, the number of searches by default.")
+        parser.add_argument("--rate", type=float, help="Searches started per second. As fast as possible by default.")
+        parser.add_argument("--slo-ms", type=float, help="p99 latency above which the target is saturated.")
+        parser.add_argument("--max-error-rate", type=float, default=0.01,
+                            help="Error rate above which the target is saturated.")
+        parser.add_argument("--output", help="File to write the JSON report to.")
+
+    def handle(self, *args, **options):
+        if options["input"]:
+            entries, skipped = read_log_file(options["input"], options["dataset"], options["default_dataset"])
+        else:
+            entries, skipped = load_search_log(options["limit"], options["dataset"], options["default_dataset"])
+
+        self.stdout.write("Loaded {} searches, skipped {}".format(len(entries), skipped))
+        if not entries:
+            raise CommandError("There are no searches to replay")
+
+        if options["export"]:
+            write_log_file(options["export"], entries)
+            self.stdout.write("Exported {} searches to {}".format(len(entries), options["export"]))
+            return
+
+        if options["url"]:
+            target = HttpTarget(options["url"], timeout=options["timeout"])
+        else:
+            target = InProcessTarget(use_cache=not options["no_cache"])
+
+        replay = TrafficReplay(target, entries, requests=options["requests"], rate=options["rate"])
+        try:
+            report = replay.run(sorted(set(options["concurrency"])), options["slo_ms"], options["max_error_rate"])
+        except RuntimeError as error:
+            raise CommandError(str(error))
+
+        self.stdout.write("Mix: " + ", ".join("{} {}".format(dataset, count) for dataset, count in report["mix"].items()))
+        for step in report["steps"]:
+            self.stdout.write("concurrency={concurrency:<4} requests={requests:<6} throughput={throughput}/s "
+                              "p50={p50_ms}ms p95={p95_ms}ms p99={p99_ms}ms errors={errors} {error_kinds}".format(**step))
+
+        saturation = report["saturation"]
+        if saturation:
+            self.stdout.write("Saturated at concurrency {concurrency}, {throughput}/s: {reason}".format(**saturation))
+        else:
+            self.stdout.write("No saturation up to concurrency {}".format(report["steps"][-1]["concurrency"]))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=4)
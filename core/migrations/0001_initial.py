@@ -0,0 +1,92 @@
+# Generated by Django 4.1.3 on 2026-10-18 01:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='College',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='name')),
+                ('address', models.CharField(max_length=255, verbose_name='country')),
+            ],
+            options={
+                'verbose_name_plural': 'College Data',
+            },
+        ),
+        migrations.CreateModel(
+            name='Curriculum',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('abbreviation', models.CharField(max_length=10)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MajorCategory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='name')),
+            ],
+            options={
+                'verbose_name_plural': 'Major Categories',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=255, verbose_name='query')),
+                ('curriculum', models.CharField(blank=True, default=None, max_length=255, null=True, verbose_name='curriculum')),
+                ('education_level', models.CharField(blank=True, default=None, max_length=255, null=True, verbose_name='education_level')),
+            ],
+            options={
+                'verbose_name_plural': 'Search Queries',
+            },
+        ),
+        migrations.CreateModel(
+            name='School',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='name')),
+                ('address', models.CharField(max_length=255, verbose_name='address')),
+                ('curriculum', models.ForeignKey(max_length=255, on_delete=django.db.models.deletion.CASCADE, to='core.curriculum', verbose_name='curriculum')),
+            ],
+            options={
+                'verbose_name_plural': 'School Data',
+            },
+        ),
+        migrations.CreateModel(
+            name='Major',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='name')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.majorcategory', verbose_name='category')),
+            ],
+            options={
+                'verbose_name_plural': 'Majors',
+            },
+        ),
+        migrations.CreateModel(
+            name='Subject',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='name')),
+                ('education_level', models.CharField(choices=[('ssc', 'Secondary'), ('hsc', 'Higher Secondary'), ('ug', 'Undergraduate'), ('pg', 'Postgraduate'), ('phd', 'PhD')], max_length=255, verbose_name='education_level')),
+                ('curriculum', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.curriculum', verbose_name='curriculum')),
+            ],
+            options={
+                'verbose_name_plural': 'Subjects',
+                'unique_together': {('name', 'curriculum', 'education_level')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchquery',
+            name='dataset',
+            field=models.CharField(blank=True, default=None, max_length=20, null=True, verbose_name='dataset'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.3 on 2026-10-18 02:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_searchquery_dataset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingIndexBuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset', models.CharField(max_length=20, verbose_name='dataset')),
+                ('partition', models.CharField(max_length=20, verbose_name='partition')),
+                ('marked_at', models.DateTimeField(auto_now=True, verbose_name='marked_at')),
+            ],
+            options={
+                'verbose_name_plural': 'Pending Index Builds',
+                'unique_together': {('dataset', 'partition')},
+            },
+        ),
+    ]
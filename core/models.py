@@ -17,11 +17,34 @@ class SearchQuery(models.Model):
     query = models.CharField(max_length=255, verbose_name="query")
     curriculum = models.CharField(max_length=255, verbose_name="curriculum", default=None, null=True, blank=True)
     education_level = models.CharField(max_length=255, verbose_name="education_level", default=None, null=True, blank=True)
+    # The search engine the query went to (school, subject, college or major), empty for the rows logged before it was recorded
+    dataset = models.CharField(max_length=20, verbose_name="dataset", default=None, null=True, blank=True)
 
     def __str__(self):
         return f'{self.query}'
 
 
+class PendingIndexBuild(models.Model):
+
+    """
+    A partition that rows were added to by the web process, whose embeddings are not built yet.
+    The web process only records it; "build_search_index --pending" builds the recorded partitions offline
+    and deletes the records older than the rows it read.
+    """
+
+    class Meta:
+        verbose_name_plural = "Pending Index Builds"
+        unique_together = ('dataset', 'partition')
+
+    dataset = models.CharField(max_length=20, verbose_name="dataset")
+    # The option of the embeddings file, a curriculum abbreviation in lowercase or the name of the dataset
+    partition = models.CharField(max_length=20, verbose_name="partition")
+    marked_at = models.DateTimeField(auto_now=True, verbose_name="marked_at")
+
+    def __str__(self):
+        return f'{self.dataset} {self.partition}'
+
+
 class School(models.Model):
     
     class Meta:
@@ -0,0 +1,149 @@
+import atexit
+import queue
+import threading
+import time
+import traceback
+from django.conf import settings
+from django.db import close_old_connections
+from services.src.search_metrics import search_metrics, render_samples
+from core.models import SearchQuery
+
+
+# Time of each bulk_create of the writer
+write_seconds = search_metrics.histogram("search_query_log_write_seconds", "Time of each batch written to SearchQuery")
+
+
+class QueryLogBuffer:
+
+    """
+    Buffers the SearchQuery rows of the searches in memory, and writes them with bulk_create on a background thread,
+    so a search does not wait for its INSERT, and searches are not serialized behind the database write lock.
+    The writer flushes when batch_size rows are waiting, or flush_interval seconds after the first of them.
+    The queue holds at most max_size rows: when the writer can not keep up, new rows are dropped and counted,
+    the searches are never slowed down. The rows still waiting are written when the process exits.
+    """
+
+    def __init__(self, max_size: int = 10000, batch_size: int = 500, flush_interval: float = 1.0):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.counts = {"written": 0, "dropped": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.writer = None
+
+
+    def log(self, fields: dict, dataset: str = None) -> bool:
+        # Returns False when the row was dropped because the queue is full
+        self.start()
+        try:
+            self.queue.put_nowait(SearchQuery(dataset=dataset, **fields))
+            return True
+        except queue.Full:
+            self.count("dropped")
+            return False
+
+
+    def log_many(self, rows: list, dataset: str = None) -> None:
+        for fields in rows:
+            self.log(fields, dataset=dataset)
+
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counts[name] += value
+
+
+    def start(self) -> None:
+        if self.writer is not None:
+            return
+
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name="search-query-log", daemon=True)
+                self.writer.start()
+                atexit.register(self.close)
+
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            # Wait for more rows until the batch is full or the first row has waited flush_interval seconds
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.write(batch)
+
+
+    def write(self, batch: list) -> None:
+        # A failed write is printed and counted, the rows are not retried
+        try:
+            close_old_connections()
+            with search_metrics.timer(write_seconds):
+                SearchQuery.objects.bulk_create(batch, batch_size=self.batch_size)
+            self.count("written", len(batch))
+        except Exception:
+            traceback.print_exc()
+            self.count("failed", len(batch))
+
+
+    def flush(self) -> None:
+
+        """
+        Write every row waiting in the queue from the calling thread.
+        Used on shutdown, and by code that needs the rows in the database right away.
+        """
+
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+
+        if batch:
+            self.write(batch)
+
+
+    def close(self) -> None:
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join(timeout=self.flush_interval * 2)
+        self.flush()
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counts, queued=self.queue.qsize())
+
+
+    def metrics(self) -> list:
+        # Lines of the search metrics endpoint
+        stats = self.stats()
+        return (render_samples("search_query_log_rows_total", "counter", "Rows of the query log by outcome",
+                               [({"outcome": name}, stats[name]) for name in ("written", "dropped", "failed")])
+                + render_samples("search_query_log_queued", "gauge", "Rows waiting to be written", [({}, stats["queued"])]))
+
+
+query_log = QueryLogBuffer(
+    max_size=settings.SEARCH_QUERY_LOG['MAX_QUEUE'],
+    batch_size=settings.SEARCH_QUERY_LOG['BATCH_SIZE'],
+    flush_interval=settings.SEARCH_QUERY_LOG['FLUSH_INTERVAL'],
+)
+search_metrics.add_collector(query_log.metrics)
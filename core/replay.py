@@ -0,0 +1,302 @@
+import csv
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+from services.src.search_benchmark import latency_summary
+from core.models import SearchQuery
+from core.search_cache import search_cache
+from core.engines import engine_manager
+
+
+# The search endpoint of each dataset, and the SearchQuery fields its request body is made of
+DATASET_PATHS = {
+    "school": "profile/school",
+    "subject": "profile/school/subject",
+    "college": "profile/college",
+    "major": "profile/college/major",
+}
+
+REQUEST_FIELDS = {
+    "school": ("query", "curriculum"),
+    "subject": ("query", "curriculum", "education_level"),
+    "college": ("query", "curriculum"),
+    "major": ("query",),
+}
+
+
+def route_entry(fields: dict, default_dataset: str = None):
+
+    """
+    The replay entry of a logged search: its dataset and the fields of its request.
+    The rows logged before the dataset was recorded are routed by their fields: an education level is a subject
+    search and a curriculum alone a school search. College and major searches only have a query, they go to
+    default_dataset, or are skipped (None) when it is not given.
+    """
+
+    dataset = fields.get("dataset")
+    if not dataset:
+        if fields.get("education_level"):
+            dataset = "subject"
+        elif fields.get("curriculum"):
+            dataset = "school"
+        else:
+            dataset = default_dataset
+
+    if dataset not in DATASET_PATHS or not fields.get("query"):
+        return None
+
+    entry = {"dataset": dataset}
+    for name in REQUEST_FIELDS[dataset]:
+        if fields.get(name):
+            entry[name] = fields[name]
+    return entry
+
+
+def load_search_log(limit: int = None, datasets: list = None, default_dataset: str = None) -> tuple:
+    # The last 'limit' searches of the SearchQuery table, in the order they were made. Returns (entries, skipped)
+    queryset = SearchQuery.objects.order_by("-id").values("query", "curriculum", "education_level", "dataset")
+    if limit:
+        queryset = queryset[:limit]
+    return route_entries(reversed(list(queryset)), datasets, default_dataset)
+
+
+def read_log_file(path: str, datasets: list = None, default_dataset: str = None) -> tuple:
+    # An exported sample of the log, as NDJSON (one object per line) or as CSV with a header row
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    return route_entries(rows, datasets, default_dataset)
+
+
+def route_entries(rows, datasets: list = None, default_dataset: str = None) -> tuple:
+    entries = []
+    skipped = 0
+    for fields in rows:
+        entry = route_entry(fields, default_dataset)
+        if entry is None or (datasets and entry["dataset"] not in datasets):
+            skipped += 1
+        else:
+            entries.append(entry)
+    return entries, skipped
+
+
+def write_log_file(path: str, entries: list) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class InProcessTarget:
+
+    """
+    Replays the searches on the search engines of this process, the way the views run them:
+    through the result cache, unless use_cache is False, with the filter and subject flag of the view.
+    The engines are built before the replay starts, the time to build them is not measured.
+    """
+
+    name = "in-process"
+
+    def __init__(self, use_cache: bool = True):
+        self.use_cache = use_cache
+
+
+    def prepare(self, datasets: list) -> None:
+        engine_manager.build([dataset for dataset in datasets if dataset not in engine_manager.engines])
+        failed = [dataset for dataset in datasets if dataset not in engine_manager.engines]
+        if failed:
+            raise RuntimeError("The search engines of {} could not be built: {}".format(
+                ", ".join(failed), engine_manager.errors))
+
+
+    def send(self, entry: dict):
+        # Returns None, or the kind of error of the search
+        dataset = entry["dataset"]
+        engine = engine_manager.engines[dataset]
+        filter_dict = None
+        if dataset in ("school", "subject"):
+            filter_dict = {"curriculum__abbreviation": entry.get("curriculum", "").upper()}
+        if dataset == "subject" and entry.get("education_level"):
+            filter_dict["education_level"] = entry["education_level"].lower()
+        options = {"subject": True} if dataset == "subject" else {}
+
+        try:
+            if self.use_cache:
+                search_cache.search(dataset, engine, entry["query"], filter_dict, **options)
+            elif filter_dict is None:
+                engine.search(entry["query"], **options)
+            else:
+                engine.search(entry["query"], filter_dict, **options)
+        except Exception as error:
+            return type(error).__name__
+        return None
+
+
+class HttpTarget:
+
+    """
+    Replays the searches against a running instance: a GET with the JSON body of each search, on the endpoint
+    of its dataset. A response other than 200 is an error of kind "http_<status>" ("http_503" while the engines
+    warm up, "http_504" on a deadline), and a request that gets no response is a "connection" or "timeout" error.
+    """
+
+    name = "http"
+
+    def __init__(self, base_url: str, timeout: float = 10.0):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+
+
+    def prepare(self, datasets: list) -> None:
+        pass
+
+
+    def send(self, entry: dict):
+        body = json.dumps({name: value for name, value in entry.items() if name != "dataset"}).encode("utf-8")
+        request = urllib.request.Request(self.base_url + DATASET_PATHS[entry["dataset"]], data=body, method="GET",
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return None if response.status == 200 else "http_{}".format(response.status)
+        except urllib.error.HTTPError as error:
+            return "http_{}".format(error.code)
+        except urllib.error.URLError as error:
+            return "timeout" if isinstance(error.reason, TimeoutError) else "connection"
+        except TimeoutError:
+            return "timeout"
+        except OSError:
+            return "connection"
+
+
+class TrafficReplay:
+
+    """
+    Replays a list of logged searches on a target, at increasing concurrency levels, to find where it saturates.
+    Each step sends 'requests' searches (the log is cycled through, in its order) from 'concurrency' threads.
+    With a rate, the searches are started on a fixed schedule of 'rate' per second across all the threads,
+    so a target that keeps up shows its latency at that load, and one that does not falls behind the schedule.
+    Without a rate every thread sends its next search as soon as the previous one returns.
+    """
+
+    def __init__(self, target, entries: list, requests: int = None, rate: float = None):
+        self.target = target
+        self.entries = entries
+        self.requests = requests or len(entries)
+        self.rate = rate
+
+
+    def run_step(self, concurrency: int) -> dict:
+        entries = itertools.islice(enumerate(itertools.cycle(self.entries)), self.requests)
+        lock = threading.Lock()
+        results = []
+
+        def worker():
+            while True:
+                with lock:
+                    item = next(entries, None)
+                if item is None:
+                    return
+
+                position, entry = item
+                if self.rate:
+                    delay = start + position / self.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                sent = time.perf_counter()
+                error = self.target.send(entry)
+                seconds = time.perf_counter() - sent
+                with lock:
+                    results.append((entry["dataset"], seconds, error))
+
+        threads = [threading.Thread(target=worker, name="replay-{}".format(number), daemon=True)
+                   for number in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.perf_counter() - start
+
+        return self.summarize(concurrency, results, wall_seconds)
+
+
+    def summarize(self, concurrency: int, results: list, wall_seconds: float) -> dict:
+        errors = {}
+        for _, _, error in results:
+            if error is not None:
+                errors[error] = errors.get(error, 0) + 1
+
+        succeeded = [(dataset, seconds) for dataset, seconds, error in results if error is None]
+        datasets = {}
+        for dataset, seconds in succeeded:
+            datasets.setdefault(dataset, []).append(seconds)
+
+        milliseconds = np.array([seconds for _, seconds in succeeded]) * 1000
+        return {
+            "concurrency": concurrency,
+            "rate": self.rate,
+            "requests": len(results),
+            "errors": sum(errors.values()),
+            "error_rate": round(sum(errors.values()) / len(results), 4) if results else 0,
+            "error_kinds": errors,
+            "seconds": round(wall_seconds, 3),
+            "throughput": round(len(succeeded) / wall_seconds, 2) if wall_seconds > 0 else None,
+            "p50_ms": round(float(np.percentile(milliseconds, 50)), 4) if len(milliseconds) else None,
+            "p95_ms": round(float(np.percentile(milliseconds, 95)), 4) if len(milliseconds) else None,
+            "p99_ms": round(float(np.percentile(milliseconds, 99)), 4) if len(milliseconds) else None,
+            "datasets": {dataset: latency_summary(seconds) for dataset, seconds in sorted(datasets.items())},
+        }
+
+
+    def run(self, concurrency_levels: list, slo_ms: float = None, max_error_rate: float = 0.01) -> dict:
+        self.target.prepare(sorted({entry["dataset"] for entry in self.entries}))
+
+        steps = []
+        for concurrency in concurrency_levels:
+            steps.append(self.run_step(concurrency))
+
+        return {
+            "target": self.target.name,
+            "entries": len(self.entries),
+            "mix": {dataset: sum(1 for entry in self.entries if entry["dataset"] == dataset)
+                    for dataset in sorted({entry["dataset"] for entry in self.entries})},
+            "steps": steps,
+            "saturation": find_saturation(steps, slo_ms, max_error_rate),
+        }
+
+
+def find_saturation(steps: list, slo_ms: float = None, max_error_rate: float = 0.01, min_gain: float = 1.1):
+
+    """
+    The first step where the target stops scaling: its error rate is above max_error_rate, its p99 is above
+    slo_ms, or its throughput grew by less than min_gain times the throughput of the step before.
+    With a fixed rate the throughput can not grow past it, the target saturates when it falls behind the rate instead.
+    Returns {"concurrency", "throughput", "reason"} of that step, or None when every step scaled.
+    """
+
+    previous = None
+    for step in steps:
+        reason = None
+        if step["error_rate"] > max_error_rate:
+            reason = "error rate {} above {}".format(step["error_rate"], max_error_rate)
+        elif slo_ms and step["p99_ms"] is not None and step["p99_ms"] > slo_ms:
+            reason = "p99 {}ms above {}ms".format(step["p99_ms"], slo_ms)
+        elif step["rate"] and step["throughput"] is not None:
+            if step["throughput"] < step["rate"] / min_gain:
+                reason = "throughput {} behind the rate of {}".format(step["throughput"], step["rate"])
+        elif previous and previous["throughput"] and step["throughput"] is not None \
+                and step["throughput"] < previous["throughput"] * min_gain:
+            reason = "throughput {} did not grow from {} at concurrency {}".format(
+                step["throughput"], previous["throughput"], previous["concurrency"])
+
+        if reason:
+            return {"concurrency": step["concurrency"], "throughput": step["throughput"], "reason": reason}
+        previous = step
+    return None
@@ -0,0 +1,64 @@
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import caches
+from services.src.search_metrics import search_metrics
+
+
+# Lookups of the result cache per dataset, hit or miss
+cache_requests = search_metrics.counter(
+    "search_result_cache_requests_total", "Lookups of the search result cache", ("dataset", "result"))
+
+
+class SearchResultCache:
+
+    """
+    Caches the results of SearchEngine.search in a Django cache, so it can be local memory or a shared backend.
+    The key is made of the dataset, the version of the engine that serves it, the normalized query,
+    the filter dictionary and the search options. The version of an engine changes with its rows and with its
+    embedding files, see SearchEngine.version. So once rows are added and the engine is reloaded, the results
+    cached from the previous engine are no longer reachable and expire on their own, and an engine that is not
+    reloaded yet keeps caching results that match what it serves. The workers serving the same rows and files share the keys.
+    The TTL and the size bound are the TIMEOUT and MAX_ENTRIES of the cache alias.
+    """
+
+    def __init__(self, alias: str = None):
+        self.alias = alias or settings.SEARCH_RESULT_CACHE_ALIAS
+
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+
+    def make_key(self, dataset: str, version: str, query: str, filter_dict: dict = None, **options) -> str:
+
+        # Abbreviation and fuzzy search both lowercase and strip the query, so those differences share a key
+        normalized = json.dumps(
+            [query.strip().lower(), filter_dict or {}, options],
+            sort_keys=True,
+            default=str
+            )
+        digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        return "search:{}:{}:{}".format(dataset, version, digest)
+
+
+    def search(self, dataset: str, engine, query: str, filter_dict: dict = None, **options) -> list:
+        key = self.make_key(dataset, engine.version, query, filter_dict, **options)
+
+        results = self.cache.get(key)
+        cache_requests.inc(dataset, "hit" if results is not None else "miss")
+        if results is None:
+            if filter_dict is None:
+                results = engine.search(query, **options)
+            else:
+                results = engine.search(query, filter_dict, **options)
+
+            # Results where a matcher missed its deadline are returned, but not cached
+            if not getattr(results, "partial", False):
+                self.cache.set(key, results)
+
+        return results
+
+
+search_cache = SearchResultCache()
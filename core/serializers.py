@@ -1,11 +1,35 @@
+from django.conf import settings
 from . import models
 from rest_framework import serializers
 from rest_framework.fields import CharField
 from services.src import search_engine
 
 
+class SearchOptionsMixin(serializers.Serializer):
+	"""
+	Options of a search request that are passed on to the search engine,
+	but are not columns of SearchQuery, so they are left out when the query is saved.
+	limit is the number of results of each matcher, candidates the number of embedding matches the fuzzy search reranks.
+	"""
+	limit = serializers.IntegerField(min_value=1, max_value=100, required=False, write_only=True)
+	candidates = serializers.IntegerField(min_value=1, max_value=500, required=False, write_only=True)
 
-class SchoolQuerySerializer(serializers.ModelSerializer):
+	option_fields = ('limit', 'candidates')
+
+	def get_search_options(self) -> dict:
+		return {name: self.validated_data[name] for name in self.option_fields if name in self.validated_data}
+
+	def get_query_fields(self) -> dict:
+		# The SearchQuery columns of the request, for the query log
+		return {name: value for name, value in self.validated_data.items() if name not in self.option_fields}
+
+	def create(self, validated_data):
+		for name in self.option_fields:
+			validated_data.pop(name, None)
+		return super().create(validated_data)
+
+
+class SchoolQuerySerializer(SearchOptionsMixin, serializers.ModelSerializer):
 	query = serializers.CharField(max_length=100)
 	curriculum = serializers.CharField(max_length=10)
 
@@ -14,16 +38,20 @@ class SchoolQuerySerializer(serializers.ModelSerializer):
 		fields = (
 			'query',
 			'curriculum',
+			'limit',
+			'candidates',
 		)
 
 
-class SubjectQuerySerializer(serializers.ModelSerializer):
+class SubjectQuerySerializer(SearchOptionsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.SearchQuery
 		fields = (
 			'query',
 			'curriculum',
-			'education_level'
+			'education_level',
+			'limit',
+			'candidates',
 		)
 	
 	# def save(self):
@@ -33,12 +61,14 @@ class SubjectQuerySerializer(serializers.ModelSerializer):
 	# 	return results
 
 
-class CollegeQuerySerializer(serializers.ModelSerializer):
+class CollegeQuerySerializer(SearchOptionsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.SearchQuery
 		fields = (
 			'query',
-			'curriculum'
+			'curriculum',
+			'limit',
+			'candidates',
 		)
 	
 	# def save(self):
@@ -47,11 +77,13 @@ class CollegeQuerySerializer(serializers.ModelSerializer):
 	# 	return results
 
 
-class MajorQuerySerializer(serializers.ModelSerializer):
+class MajorQuerySerializer(SearchOptionsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.SearchQuery
 		fields = (
 			'query',
+			'limit',
+			'candidates',
 		)
 	
 	# def save(self):
@@ -60,6 +92,44 @@ class MajorQuerySerializer(serializers.ModelSerializer):
 	# 	return results
 
 
+class SearchBatchSerializer(SearchOptionsMixin):
+	"""
+	A batch of searches of one dataset. The limit and candidates options apply to every item,
+	so an item that sets its own is rejected rather than searched with the options of the batch.
+	stream asks for the results as NDJSON lines instead of a single response.
+	"""
+	stream = serializers.BooleanField(default=False)
+
+	def validate_items(self, items):
+		if not items:
+			raise serializers.ValidationError("The batch has no items")
+		if len(items) > settings.SEARCH_BATCH['MAX_ITEMS']:
+			raise serializers.ValidationError(
+				"A batch can have at most {} items".format(settings.SEARCH_BATCH['MAX_ITEMS']))
+		for index, item in enumerate(items):
+			options = [name for name in self.option_fields if name in item]
+			if options:
+				raise serializers.ValidationError(
+					"Item {}: {} must be set for the whole batch, next to items".format(index, " and ".join(options)))
+		return items
+
+
+class SchoolBatchSerializer(SearchBatchSerializer):
+	items = SchoolQuerySerializer(many=True)
+
+
+class SubjectBatchSerializer(SearchBatchSerializer):
+	items = SubjectQuerySerializer(many=True)
+
+
+class CollegeBatchSerializer(SearchBatchSerializer):
+	items = CollegeQuerySerializer(many=True)
+
+
+class MajorBatchSerializer(SearchBatchSerializer):
+	items = MajorQuerySerializer(many=True)
+
+
 class SchoolDataSerializer(serializers.ModelSerializer):
 	curriculum = serializers.SlugRelatedField(
 		queryset=models.Curriculum.objects.all(),
@@ -105,7 +175,7 @@ class CollegeDataSerializer(serializers.ModelSerializer):
 		model = models.College
 		fields = (
 			'name',
-			'country'
+			'address'
 		)
 
 
@@ -122,6 +192,30 @@ class MajorDataSerializer(serializers.ModelSerializer):
 		)
 
 
+class SchoolRowSerializer(SchoolDataSerializer):
+	"""
+	Serializers of one row of a bulk ingestion. The related curriculum or category is only checked to be a string here,
+	the bulk ingestion view resolves them for a whole chunk of rows with one query, instead of one query per row.
+	The uniqueness of subjects is checked the same way, for a whole chunk.
+	"""
+	curriculum = serializers.CharField(max_length=10)
+
+
+class SubjectRowSerializer(SubjectDataSerializer):
+	curriculum = serializers.CharField(max_length=10)
+
+	class Meta(SubjectDataSerializer.Meta):
+		validators = []
+
+
+class CollegeRowSerializer(CollegeDataSerializer):
+	pass
+
+
+class MajorRowSerializer(MajorDataSerializer):
+	category = serializers.CharField(max_length=100)
+
+
 class MajorCategorySerializer(serializers.ModelSerializer):
 	class Meta:
 		model = models.MajorCategory
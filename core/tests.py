@@ -1,3 +1,1909 @@
-from django.test import TestCase
+import io
+import json
+import os
+import pickle
+import random
+import regex as re
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+import pandas as pd
+import jaro
+from fuzzywuzzy import fuzz, process, utils
+from rapidfuzz import fuzz as rapid_fuzz
+from django.core.management import call_command
+from django.http import JsonResponse
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from services.src.data_loader import DataLoader
+from services.src.synthetic_corpus import SyntheticCorpus
+from services.src.search_benchmark import SearchBenchmark, HashingEncoder, compare
+from services.src.model_registry import ModelRegistry, DEFAULT_MODEL_NAME
+from services.src.train_model import TrainModel
+from services.src.fuzzy_school_matcher import FuzzySchoolMatcher
+from services.src.query_embedding_cache import QueryEmbeddingCache
+from services.src.search_metrics import MetricsRegistry, render_samples
+from services.src.embedding_store import EmbeddingStore
+from services.src.embedding_matrix import EmbeddingMatrix
+from services.src.ann_index import IVFIndex, recall_report
+from services.src.matcher_pool import MatcherPool, PartialResults, SearchDeadlineExceeded, check_deadline
+from services.src.corpus_snapshot import CorpusSnapshot
+from services.src.search_engine import SearchEngine
+from services.src.check_pickle_exists import CheckPickleExists, IndexNotBuilt
+from services.src.address_index import AddressIndex
+from services.src.acronym_index import AcronymIndex
+from services.src.abbr_school_matcher import compile_pattern
+from core.models import PendingIndexBuild, SearchQuery, Curriculum, School, College, Subject
+from core.views import BulkIngestAPIView, SubjectBulkIngestAPIView
+from core.async_views import AsyncSchoolSearchView
+from core.query_log import QueryLogBuffer, query_log
+from core.search_cache import SearchResultCache
+from core.replay import load_search_log
+from core.engines import EngineManager, EngineWarmingUp, EngineUnavailable, load_snapshot, mark_pending_partitions
 
-# Create your tests here.
+
+class CleanSeriesTests(SimpleTestCase):
+
+    """
+    DataLoader.clean_series must give exactly the output of clean_string, which cleans the queries,
+    or the cleaned rows would no longer match the keys of the stored embeddings.
+    """
+
+    def setUp(self):
+        self.loader = DataLoader()
+
+    def assert_same_as_clean_string(self, values: list):
+        series = pd.Series(values, index=range(7, 7 + len(values)), name="concat")
+        cleaned = self.loader.clean_series(series)
+
+        self.assertEqual(list(cleaned.index), list(series.index))
+        self.assertEqual(cleaned.name, "concat")
+        mismatches = [(value, fast, self.loader.clean_string(value))
+                      for value, fast in zip(values, cleaned.tolist()) if fast != self.loader.clean_string(value)]
+        self.assertEqual(mismatches[:10], [])
+
+    def test_examples(self):
+        self.assert_same_as_clean_string([
+            "D.P.S. R K Puram, New Delhi", "  K V  No. 1 ", "St. Xavier's (High) School", "a b c", "a  b\tc d",
+            "a & b", "x-y z", "", " ", "1 2 3", "a 1 b c", "IIT B", "ΣΑΣ Σ ς", "é à ü", "x y z", "_ a",
+        ])
+        self.assertEqual(self.loader.clean_series(pd.Series(["D P S, R.K. Puram"])).tolist(), ["dps rk puram"])
+
+    def test_synthetic_corpus(self):
+        # 200k school rows, the size the vectorized path is meant for
+        df = SyntheticCorpus(seed=3).generate("school", 200000)
+        self.assert_same_as_clean_string((df["name"] + " " + df["address"]).tolist())
+
+    def test_random_strings(self):
+        # Punctuation, digits, single letters, every kind of whitespace and characters outside latin-1
+        rng = random.Random(0)
+        alphabet = list("abcXYZ09_ ") * 3 + list(".,\"'()-&/ \t\n\r\x0b\x0c\x85  éÉßΣσİ٣²ª\ud800")
+        self.assert_same_as_clean_string(
+            ["".join(rng.choice(alphabet) for _ in range(rng.randrange(12))) for _ in range(50000)])
+
+    def test_latin_strings(self):
+        rng = random.Random(1)
+        alphabet = list("abAB1_ ") * 4 + [chr(code) for code in range(1, 256)]
+        self.assert_same_as_clean_string(
+            ["".join(rng.choice(alphabet) for _ in range(rng.randrange(12))) for _ in range(50000)])
+
+    def test_separator_in_a_string(self):
+        self.assert_same_as_clean_string(["a\x00b c", "d e"])
+
+    def test_empty_column(self):
+        self.assertEqual(self.loader.clean_series(pd.Series([], dtype=object)).tolist(), [])
+
+
+def wait_for_query_log(count: int, timeout: float = 5.0) -> None:
+    # The rows are written by the writer thread of the query log, or by flush() when they are still queued
+    deadline = time.monotonic() + timeout
+    while SearchQuery.objects.count() < count and time.monotonic() < deadline:
+        query_log.flush()
+        time.sleep(0.05)
+
+
+class QueryLogReplayTests(TransactionTestCase):
+
+    """
+    A search logged through the query log buffer is written with its dataset, and read back for the replay.
+    """
+
+    def test_logged_search_is_replayed_on_its_dataset(self):
+        query_log.log({"query": "dps rk puram", "curriculum": "cbse"}, dataset="school")
+        query_log.log({"query": "iit bombay"}, dataset="college")
+        query_log.log({"query": "mathematics", "curriculum": "icse", "education_level": "ssc"}, dataset="subject")
+        wait_for_query_log(3)
+
+        self.assertEqual(list(SearchQuery.objects.order_by("id").values_list("dataset", flat=True)),
+                         ["school", "college", "subject"])
+
+        entries, skipped = load_search_log()
+        self.assertEqual(skipped, 0)
+        self.assertEqual(entries, [
+            {"dataset": "school", "query": "dps rk puram", "curriculum": "cbse"},
+            {"dataset": "college", "query": "iit bombay"},
+            {"dataset": "subject", "query": "mathematics", "curriculum": "icse", "education_level": "ssc"},
+        ])
+
+    def test_rows_logged_without_a_dataset(self):
+        SearchQuery.objects.create(query="kv", curriculum="cbse")
+        SearchQuery.objects.create(query="physics", curriculum="cbse", education_level="hsc")
+        SearchQuery.objects.create(query="computer science")
+
+        entries, skipped = load_search_log()
+        self.assertEqual([entry["dataset"] for entry in entries], ["school", "subject"])
+        self.assertEqual(skipped, 1)
+
+        entries, skipped = load_search_log(limit=1, default_dataset="major")
+        self.assertEqual(entries, [{"dataset": "major", "query": "computer science"}])
+
+
+class QueryLogBufferTests(TransactionTestCase):
+
+    """
+    The query log writes its rows in batches on its writer thread, drops and counts the rows of a full queue,
+    and writes the rows still waiting when it is closed.
+    """
+
+    def test_batches_are_written_by_the_writer(self):
+        buffer = QueryLogBuffer(batch_size=2, flush_interval=0.5)
+        self.addCleanup(buffer.close)
+        with mock.patch.object(SearchQuery.objects, "bulk_create", wraps=SearchQuery.objects.bulk_create) as bulk_create:
+            self.assertTrue(buffer.log({"query": "dps", "curriculum": "cbse"}, dataset="school"))
+            buffer.log_many([{"query": "kv", "curriculum": "cbse"}, {"query": "iit bombay"}], dataset="college")
+
+            deadline = time.monotonic() + 5
+            while buffer.stats()["written"] < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual([len(call[0][0]) for call in bulk_create.call_args_list], [2, 1])
+        self.assertEqual(buffer.stats(), {"written": 3, "dropped": 0, "failed": 0, "queued": 0})
+        self.assertEqual(list(SearchQuery.objects.order_by("id").values_list("query", "dataset")),
+                         [("dps", "school"), ("kv", "college"), ("iit bombay", "college")])
+
+    def test_rows_of_a_full_queue_are_dropped(self):
+        buffer = QueryLogBuffer(max_size=2)
+        # The writer is not started, the rows stay queued
+        with mock.patch.object(buffer, "start"):
+            results = [buffer.log({"query": query}, dataset="major") for query in ("biology", "physics", "law")]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(buffer.stats(), {"written": 0, "dropped": 1, "failed": 0, "queued": 2})
+        self.assertEqual(SearchQuery.objects.count(), 0)
+
+        buffer.close()
+        self.assertEqual(buffer.stats(), {"written": 2, "dropped": 1, "failed": 0, "queued": 0})
+        self.assertEqual(sorted(SearchQuery.objects.values_list("query", flat=True)), ["biology", "physics"])
+
+    def test_waiting_rows_are_written_on_close(self):
+        buffer = QueryLogBuffer(batch_size=100, flush_interval=0.2)
+        buffer.log_many([{"query": "dps {}".format(row), "curriculum": "cbse"} for row in range(150)], dataset="school")
+        buffer.close()
+
+        self.assertFalse(buffer.writer.is_alive())
+        self.assertEqual(buffer.stats(), {"written": 150, "dropped": 0, "failed": 0, "queued": 0})
+        self.assertEqual(SearchQuery.objects.count(), 150)
+
+    def test_failed_writes_are_counted(self):
+        buffer = QueryLogBuffer()
+        with mock.patch.object(buffer, "start"), \
+                mock.patch.object(SearchQuery.objects, "bulk_create", side_effect=RuntimeError("The database is gone")), \
+                mock.patch("traceback.print_exc"):
+            buffer.log({"query": "dps", "curriculum": "cbse"}, dataset="school")
+            buffer.flush()
+        self.assertEqual(buffer.stats(), {"written": 0, "dropped": 0, "failed": 1, "queued": 0})
+
+
+class AddressIndexTests(SimpleTestCase):
+
+    """
+    The AddressIndex only skips the addresses the fuzzy regex can not match,
+    so the abbreviation search ranks the schools exactly as with the regex alone.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+
+    def test_same_results_as_the_regex(self):
+        corpus = SyntheticCorpus(seed=11, curricula=2)
+        df = corpus.generate("school", 1500)
+        benchmark = SearchBenchmark()
+        engine = SearchEngine.from_dataframe(df, "school", benchmark.encode_partitions("school", df), benchmark.model_name)
+
+        rng = random.Random(4)
+        queries = [(query, filter_dict) for query, filter_dict in corpus.queries("school", df, 300)]
+        queries += [("{} {}".format(acronym, "".join(rng.choice("abcdeghklmnprstuv") for _ in range(rng.randint(1, 3)))),
+                     {"curriculum__abbreviation": "CBSE"})
+                    for acronym in ("dps", "kv", "sxs", "dav", "gdg")]
+
+        with mock.patch.object(AddressIndex, "supports", classmethod(lambda cls, pieces: False)):
+            regex_results = [engine.abbreviation_search(query, engine.select_partition(filter_dict))
+                             for query, filter_dict in queries]
+        index_results = [engine.abbreviation_search(query, engine.select_partition(filter_dict))
+                         for query, filter_dict in queries]
+
+        mismatches = [(query, index, regex) for (query, _), index, regex in zip(queries, index_results, regex_results)
+                      if index != regex]
+        self.assertEqual(mismatches[:5], [])
+
+    def test_rows_matched_by_the_regex_are_never_skipped(self):
+        rng = random.Random(7)
+        df = SyntheticCorpus(seed=12).generate("school", 150)
+        # Characters the regex matches while ignoring case, and punctuation it counts as edits
+        addresses = df["address"].tolist() + ["ſector 5 noida", "Kalkaji, new delhi", "d.a. higher secondary", "b-12 rk puram"]
+        index = AddressIndex(addresses)
+
+        for _ in range(40):
+            place = "".join(rng.choice("abcdeghklmnoprstuvy125") for _ in range(rng.randint(1, 3)))
+            full_words = [rng.choice(["delhi", "sector", "noida", "puram", "nagar", "secondary"])] if rng.random() < 0.5 else []
+            if full_words:
+                pattern = r"(\b" + r"[a-z]*\s+".join(place) + r"[a-z]*\s+\b" + r"[a-z]*\s+".join(full_words) + r"[a-z]*\b){e<=2}"
+            else:
+                pattern = r"(\b" + r"[a-z]*\s+".join(place) + r"[a-z]*\b){e<=2}"
+            address_pattern = compile_pattern(pattern, re.IGNORECASE)
+            bits = index.pattern_bits(list(place) + full_words)
+
+            for row, address in enumerate(addresses):
+                if address_pattern.search(address.strip().lower()):
+                    self.assertTrue(index.may_match(row, bits), (place, full_words, address))
+
+
+def scan_abbreviation_search(query: str, partition, limit: int = 10) -> list:
+
+    """
+    The abbreviation search as it was before the acronym index and the heaps: the name regex is run on every row
+    and the whole list is sorted after every match. The acronym index and the heaps must give the same results.
+    """
+
+    common_words_set = {'sec', 'st', 'sr', 'the', 'of', 'new', 'no'}
+    selected = []
+    query = query.strip().lower().split(" ")
+    full_words = []
+    if len(query) > 1:
+        new_search_string = query.copy()
+        for word in query:
+            if word in common_words_set or len(word) > 4:
+                new_search_string.remove(word)
+                full_words.append(word)
+        if len(new_search_string) > 1:
+            place = " ".join(new_search_string[1:])
+            new_search_string = new_search_string[0]
+        else:
+            place = " ".join(full_words)
+        list_of_letters = [letter for word in new_search_string for letter in word]
+        pattern = r"^(\b" + r"[a-z]*\s+".join(list_of_letters) + r"[a-z]*\b)"
+        query = "".join(list_of_letters) + " " + " ".join(full_words)
+    else:
+        place = ""
+        query = query[0]
+        pattern = r"\b" + r"[a-z]*\s+".join(query) + r"[a-z]*\b"
+    if place == " ".join(full_words):
+        place = ""
+
+    def abbreviation_score(match) -> float:
+        split_name = match.group(0).strip().split(" ")
+        full_name_abbr = "".join(name[0] for name in split_name) if len(split_name) > 1 else split_name[0]
+        return round(jaro.jaro_winkler_metric(query, full_name_abbr.strip().lower()) * 100, 4)
+
+    if not partition.has_address:
+        for name in partition.names:
+            for match in re.finditer(pattern, name.strip().lower()):
+                selected.append((name.title(), abbreviation_score(match)))
+                selected.sort(key=lambda x: x[1], reverse=True)
+        return selected[:limit]
+
+    for name, address in zip(partition.names, partition.addresses):
+        for match in re.finditer(pattern, name.strip().lower()):
+            selected.append((name.title(), address.title(), abbreviation_score(match)))
+            selected.sort(key=lambda x: x[2], reverse=True)
+
+    if place and full_words:
+        pattern = r"(\b" + r"[a-z]*\s+".join(place) + r"[a-z]*\s+\b" + r"[a-z]*\s+".join(full_words) + r"[a-z]*\b){e<=2}"
+    elif place:
+        pattern = r"(\b" + r"[a-z]*\s+".join(place) + r"[a-z]*\b){e<=2}"
+    elif full_words:
+        pattern = r"(\b" + r"[a-z]*\s+".join(full_words) + r"[a-z]*\b){e<=2}"
+
+    final_list = []
+    for name, address, score_name in selected:
+        if re.search(pattern, address.strip().lower(), re.IGNORECASE):
+            full_address = address.strip().lower()
+            full_address_abbr = "".join(word[0] for word in full_address.split(" ") if word[0] not in "0123456789")
+            input_address = "".join(place) or " ".join(full_words)
+            score_address = max(jaro.jaro_winkler_metric(input_address, full_address_abbr.strip().lower()) * 100,
+                                jaro.jaro_winkler_metric(input_address, full_address) * 100)
+            if input_address in full_address or input_address in full_address_abbr.strip().lower():
+                score_address += 5
+            final_list.append((name, address, round(score_name, 4), round(score_address, 4)))
+            final_list.sort(key=lambda x: (x[2], x[3]), reverse=True)
+
+    if final_list == []:
+        return selected[:limit]
+    return [(school[0].title(), school[1].title(), round((school[2] + school[3]) / 2, 4)) for school in final_list[:limit]]
+
+
+class AcronymIndexTests(SimpleTestCase):
+
+    """
+    The acronym index returns every row the name regex can match, so the abbreviation search
+    gives the results of the full scan.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+
+    def test_candidates_hold_every_match(self):
+        names = SyntheticCorpus(seed=13).generate("school", 400)["name"].str.strip().str.lower().tolist()
+        names += ["x-delhi public school", "st. mary's convent", "d.a.v. public school", "  kendriya  vidyalaya no 2"]
+        index = AcronymIndex(names)
+        rng = random.Random(2)
+
+        queries = ["dps", "xdps", "dpsx", "smc", "kvn", "davps", "k", "dapsx"]
+        queries += ["".join(rng.choice("abcdegkmnpsv") for _ in range(rng.randint(1, 6))) for _ in range(200)]
+        for letters in queries:
+            for anchored in (False, True):
+                if anchored:
+                    pattern = r"^(\b" + r"[a-z]*\s+".join(letters) + r"[a-z]*\b)"
+                else:
+                    pattern = r"\b" + r"[a-z]*\s+".join(letters) + r"[a-z]*\b"
+                candidates = set(index.candidates(list(letters), anchored=anchored).tolist())
+                for row, name in enumerate(names):
+                    if re.search(pattern, name):
+                        self.assertIn(row, candidates, (letters, anchored, name))
+
+        self.assertIsNone(index.candidates(["d", "1"]))
+        self.assertIsNone(index.candidates([]))
+
+    def test_same_results_as_the_scan(self):
+        for dataset in ("school", "major"):
+            corpus = SyntheticCorpus(seed=14, curricula=2)
+            df = corpus.generate(dataset, 600)
+            benchmark = SearchBenchmark()
+            engine = SearchEngine.from_dataframe(df, dataset, benchmark.encode_partitions(dataset, df), benchmark.model_name)
+
+            for query, filter_dict in corpus.queries(dataset, df, 100):
+                partition = engine.select_partition(filter_dict)
+                self.assertEqual(engine.abbreviation_search(query, partition), scan_abbreviation_search(query, partition),
+                                 (dataset, query))
+
+
+class AbbreviationTopKTests(SimpleTestCase):
+
+    """
+    The bounded heaps of the abbreviation search return the first 'limit' results of the fully sorted lists,
+    ties in the order the rows were found, also when the early stop cuts the loops short.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        self.benchmark = SearchBenchmark()
+
+    def engine(self, df: pd.DataFrame, dataset: str) -> SearchEngine:
+        return SearchEngine.from_dataframe(df, dataset, self.benchmark.encode_partitions(dataset, df),
+                                           self.benchmark.model_name)
+
+    def test_limits(self):
+        corpus = SyntheticCorpus(seed=15)
+        df = corpus.generate("school", 800)
+        engine = self.engine(df, "school")
+
+        for query, filter_dict in corpus.queries("school", df, 80):
+            partition = engine.select_partition(filter_dict)
+            for limit in (1, 3, 25):
+                self.assertEqual(engine.abbreviation_search(query, partition, limit=limit),
+                                 scan_abbreviation_search(query, partition, limit=limit), (query, limit))
+
+    def test_ties_and_early_stop(self):
+        # More perfect matches than the limit, the first ones found are kept
+        names = ["Delhi Public School", "Dayanand Public School", "Delhi Private School", "Don Pre School"] * 5
+        schools = pd.DataFrame({"name": names,
+                                "address": ["Sector {} Rohini".format(row) for row in range(len(names))],
+                                "curriculum__abbreviation": "CBSE"})
+        majors = pd.DataFrame({"name": names + ["Data Processing Systems"]})
+
+        school_engine = self.engine(schools, "school")
+        partition = school_engine.select_partition({"curriculum__abbreviation": "CBSE"})
+        for query in ("dps", "dps sr", "dps rohini", "dps sector"):
+            results = school_engine.abbreviation_search(query, partition, limit=6)
+            self.assertEqual(results, scan_abbreviation_search(query, partition, limit=6), query)
+            self.assertEqual(len(results), 6)
+
+        major_engine = self.engine(majors, "major")
+        partition = major_engine.select_partition()
+        results = major_engine.abbreviation_search("dps", partition, limit=6)
+        self.assertEqual(results, scan_abbreviation_search("dps", partition, limit=6))
+        self.assertEqual([name for name, _ in results], [name.title() for name in names[:6]])
+
+
+class FuzzyRerankTests(SimpleTestCase):
+
+    """
+    The batched rapidfuzz rerank gives the scores and the order of fuzzywuzzy's extractBests with token_set_ratio,
+    including the ratios that fall on .5 and the candidates with equal scores.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        rng = random.Random(1)
+        words = ["dps", "delhi", "public", "school", "rk", "puram", "kv", "no", "2", "st", "mary's", "convent", "pune"]
+        self.queries = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(100)]
+        self.choices = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 5))) for _ in range(40)]
+
+    def test_same_scores_as_fuzzywuzzy(self):
+        choices = FuzzySchoolMatcher.rerank_strings(self.choices)
+        halves = 0
+        for query in self.queries:
+            processed_query = utils.full_process(query, force_ascii=True)
+            halves += sum(abs(rapid_fuzz.token_set_ratio(processed_query, choice) % 1 - 0.5) < 1e-6 for choice in choices)
+            self.assertEqual(FuzzySchoolMatcher.rerank_scores(query, choices).tolist(),
+                             [fuzz.token_set_ratio(query, choice) for choice in self.choices], query)
+        self.assertTrue(halves)
+
+    def test_same_order_as_extract_bests(self):
+        df = pd.DataFrame({"name": self.choices, "address": "", "curriculum__abbreviation": "CBSE"})
+        benchmark = SearchBenchmark()
+        engine = SearchEngine.from_dataframe(df, "school", benchmark.encode_partitions("school", df), benchmark.model_name)
+        partition = engine.select_partition({"curriculum__abbreviation": "CBSE"})
+
+        for query in self.queries:
+            for candidates, limit in ((25, 5), (40, 10), (3, 2)):
+                entries = partition.embeddings.top_k(engine.model.encode(query), candidates)
+                results = engine.fuzzy_using_ST(query, partition, candidates=candidates, limit=limit)
+                expected = process.extractBests(query, [key for key, _ in entries], scorer=fuzz.token_set_ratio,
+                                                limit=limit, score_cutoff=0)
+                self.assertEqual([(name.lower(), score) for name, _, score in results],
+                                 [(partition.names[partition.row_index[key]].lower(), score) for key, score in expected],
+                                 (query, candidates, limit))
+
+
+class FakeEngine:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.version = name
+        self.missing_partitions = {}
+        self.changed = False
+
+    def embeddings_changed(self) -> bool:
+        return self.changed
+
+
+class FakeFactory:
+
+    """
+    An engine factory that blocks until released, then returns an engine or raises, as the test tells it.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.error = None
+
+    def __call__(self, snapshot=None):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return FakeEngine("engine-{}".format(self.calls))
+
+
+def wait_for_state(manager: EngineManager, dataset: str, state: str, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while manager.states[dataset] != state and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class EngineManagerTests(SimpleTestCase):
+
+    """
+    The states of the engines: a pending engine is built on its first request and served once ready,
+    a failed engine answers with its error and is only built again after its backoff, or by reload().
+    """
+
+    def setUp(self):
+        self.factory = FakeFactory()
+        self.manager = EngineManager({"school": self.factory}, retry_seconds=60, max_retry_seconds=600)
+        # The failed builds print their traceback
+        patcher = mock.patch("core.engines.traceback.print_exc")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fail_build(self, error: Exception = RuntimeError("no embeddings")) -> None:
+        self.factory.error = error
+        self.factory.release.set()
+        with self.assertRaises(EngineWarmingUp):
+            self.manager.get_engine("school")
+        wait_for_state(self.manager, "school", "failed")
+
+    def test_pending_to_ready(self):
+        self.assertEqual(self.manager.states["school"], "pending")
+        with self.assertRaises(EngineWarmingUp):
+            self.manager.get_engine("school")
+        self.assertEqual(self.manager.states["school"], "warming")
+
+        # A request while it warms up does not start another build
+        with self.assertRaises(EngineWarmingUp):
+            self.manager.get_engine("school")
+        self.factory.release.set()
+        wait_for_state(self.manager, "school", "ready")
+
+        self.assertEqual(self.manager.get_engine("school").name, "engine-1")
+        self.assertEqual(self.factory.calls, 1)
+        self.assertTrue(self.manager.is_ready())
+
+    def test_failed_engine_stays_failed(self):
+        self.fail_build()
+        for _ in range(3):
+            with self.assertRaises(EngineUnavailable) as raised:
+                self.manager.get_engine("school")
+        self.assertEqual(raised.exception.reason, "RuntimeError('no embeddings')")
+        self.assertGreater(raised.exception.retry_in, 59)
+        self.assertEqual(self.factory.calls, 1)
+
+        # start() at startup only builds pending engines
+        self.manager.start()
+        self.assertEqual(self.manager.states["school"], "failed")
+
+    def test_failed_engine_retried_after_backoff(self):
+        self.fail_build()
+        self.manager.retry_at["school"] = time.monotonic() - 1
+        with self.assertRaises(EngineWarmingUp):
+            self.manager.get_engine("school")
+        wait_for_state(self.manager, "school", "failed")
+        self.assertEqual(self.factory.calls, 2)
+
+        # The backoff doubles after each failure
+        self.assertGreater(self.manager.retry_at["school"] - time.monotonic(), 119)
+
+        self.factory.error = None
+        self.manager.retry_at["school"] = time.monotonic() - 1
+        with self.assertRaises(EngineWarmingUp):
+            self.manager.get_engine("school")
+        wait_for_state(self.manager, "school", "ready")
+        self.assertEqual(self.manager.get_engine("school").name, "engine-3")
+        self.assertNotIn("school", self.manager.failures)
+
+    def test_failed_engine_retried_on_reload(self):
+        self.fail_build()
+        self.factory.error = None
+        self.manager.reload("school")
+        wait_for_state(self.manager, "school", "ready")
+        self.assertEqual(self.manager.get_engine("school").name, "engine-2")
+
+    def test_engines_with_new_embeddings_are_reloaded(self):
+        manager = EngineManager({"school": self.factory, "college": FakeFactory()})
+        self.factory.release.set()
+        manager.build(["school"])
+
+        with mock.patch.object(manager, "reload") as reload:
+            self.assertEqual(manager.reload_changed(), [])
+            # build_search_index wrote a new version of the school embeddings
+            manager.engines["school"].changed = True
+            self.assertEqual(manager.reload_changed(), ["school"])
+        reload.assert_called_once_with("school")
+
+    def test_watch(self):
+        manager = EngineManager({"school": self.factory}, watch_seconds=0.01)
+        self.factory.release.set()
+        manager.build(["school"])
+        manager.engines["school"].changed = True
+
+        with mock.patch.object(manager, "reload") as reload:
+            manager.warm_up("lazy")
+            manager.watch()
+            deadline = time.monotonic() + 5
+            while not reload.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+            manager.stop_watch()
+            while manager.watching and time.monotonic() < deadline:
+                time.sleep(0.01)
+        reload.assert_called_with("school")
+        self.assertFalse(manager.watching)
+
+        # Without watch_seconds the files are not watched
+        self.manager.watch()
+        self.assertFalse(self.manager.watching)
+
+    def test_readiness_payload(self):
+        manager = EngineManager({"school": self.factory, "college": FakeFactory()}, retry_seconds=60)
+        self.factory.error = RuntimeError("no embeddings")
+        self.factory.release.set()
+        manager.build(["school"])
+
+        with mock.patch("core.views.engine_manager", manager):
+            response = self.client.get("/profile/ready")
+        self.assertEqual(response.status_code, 503)
+        datasets = response.json()["datasets"]
+        self.assertEqual(datasets["college"], {"state": "pending", "seconds": None, "error": None, "retry_in": None,
+                                               "missing_partitions": []})
+        self.assertEqual(datasets["school"]["state"], "failed")
+        self.assertEqual(datasets["school"]["error"], "RuntimeError('no embeddings')")
+        self.assertGreater(datasets["school"]["retry_in"], 59)
+
+        manager.factories["college"].release.set()
+        manager.build(["college"])
+        manager.states["school"] = "warming"
+        manager.build(["school"])
+        self.assertEqual(manager.states["school"], "failed")
+
+        self.factory.error = None
+        manager.build(["school"])
+        with mock.patch("core.views.engine_manager", manager):
+            response = self.client.get("/profile/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ready"], True)
+        self.assertEqual(response.json()["datasets"]["school"]["retry_in"], None)
+
+    def test_unavailable_response(self):
+        self.fail_build()
+        with mock.patch("core.views.engine_manager", self.manager):
+            response = self.client.generic("GET", "/profile/school", '{"query": "dps", "curriculum": "cbse"}',
+                                           content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["result"], "unavailable")
+        self.assertEqual(response.json()["error"], "RuntimeError('no embeddings')")
+        self.assertGreaterEqual(int(response["Retry-After"]), 59)
+
+
+def use_portable_paths(test) -> None:
+    # The data paths of the services are Windows paths, the tests read query_data.json from any OS
+    patcher = mock.patch.object(CorpusSnapshot, "json_file", os.path.join("services", "data", "input", "query_data.json"))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+class SearchBenchmarkTests(SimpleTestCase):
+
+    """
+    The synthetic corpora and queries are the same for the same seed, the benchmark reports every search path
+    of every dataset as JSON, and compare() reports the measures that got slower than the threshold.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+
+    def test_corpora_are_reproducible(self):
+        for dataset in ("school", "college", "subject", "major"):
+            df = SyntheticCorpus(seed=3, curricula=2).generate(dataset, 300)
+            pd.testing.assert_frame_equal(df, SyntheticCorpus(seed=3, curricula=2).generate(dataset, 300))
+            self.assertEqual(len(df), 300)
+            self.assertEqual(SyntheticCorpus(seed=3).queries(dataset, df, 20), SyntheticCorpus(seed=3).queries(dataset, df, 20))
+            self.assertFalse(SyntheticCorpus(seed=4, curricula=2).generate(dataset, 300).equals(df))
+            if "curriculum__abbreviation" in df.columns:
+                self.assertEqual(df["curriculum__abbreviation"].nunique(), 2)
+
+    def test_run(self):
+        benchmark = SearchBenchmark(seed=1, curricula=2, queries=20, warmup=2)
+        with mock.patch("sys.stderr", io.StringIO()):
+            report = benchmark.run(["school", "college", "subject", "major"], [200])
+        report = json.loads(json.dumps(report))
+
+        self.assertEqual((report["meta"]["encoder"], report["meta"]["queries"]), ("hashing", 20))
+        self.assertEqual([(result["dataset"], result["rows"]) for result in report["results"]],
+                         [("school", 200), ("college", 200), ("subject", 200), ("major", 200)])
+        for result in report["results"]:
+            paths = result["paths"]
+            self.assertEqual(sum(summary["queries"] for route, summary in paths.items()
+                                 if not route.startswith("address_miss")), 20)
+            for summary in paths.values():
+                self.assertLessEqual(summary["p50_ms"], summary["p95_ms"])
+                self.assertLessEqual(summary["p95_ms"], summary["p99_ms"])
+
+            # The datasets with addresses time the address misses with and without the AddressIndex
+            if result["dataset"] in ("school", "college"):
+                self.assertTrue(paths["address_miss"]["queries"])
+                self.assertEqual(paths["address_miss"]["queries"], paths["address_miss_regex"]["queries"])
+            else:
+                self.assertNotIn("address_miss", paths)
+        self.assertEqual(list(report["results"][2]["paths"]), ["subject"])
+        self.assertGreater(len(report["results"][0]["paths"]), 1)
+
+    def test_address_miss_queries_fail_the_prefilter(self):
+        benchmark = SearchBenchmark(seed=1, queries=40)
+        df = benchmark.corpus.generate("school", 500)
+        engine = SearchEngine.from_dataframe(df, "school", benchmark.encode_partitions("school", df), benchmark.model_name)
+        queries = benchmark.address_miss_queries("school", df)
+        self.assertTrue(queries)
+
+        index = AddressIndex(df["address"].tolist())
+        for query, filter_dict in queries:
+            place = query.split(" ")[1]
+            self.assertEqual(sum(index.may_match(row, index.pattern_bits([place])) for row in range(len(df))), 0, query)
+
+        # The indexes of the engine are put back after the regex only run
+        indexes = [partition.address_index for partition in engine.partitions.values()]
+        timings = benchmark.run_address_misses(engine, "school", df)
+        self.assertEqual(len(timings["address_miss"]), len(queries))
+        self.assertEqual([partition.address_index for partition in engine.partitions.values()], indexes)
+
+    def test_compare(self):
+        def report(build_seconds: float, p95_ms: float) -> dict:
+            return {"results": [{"dataset": "school", "rows": 1000, "build_seconds": build_seconds,
+                                 "paths": {"hybrid": {"p50_ms": 1.0, "p95_ms": p95_ms, "p99_ms": 3.0}}}]}
+
+        self.assertEqual(compare(report(1.0, 2.0), report(1.1, 2.0)), [])
+        self.assertEqual(compare(report(1.0, 2.0), report(1.0, 3.0)), ["school 1000 rows: hybrid p95_ms 2.0 -> 3.0 (1.50x)"])
+        self.assertEqual(compare(report(1.0, 2.0), report(1.0, 3.0), threshold=2), [])
+        self.assertEqual(compare({"results": []}, report(9.0, 9.0)), [])
+
+
+class PartialIndexTests(SimpleTestCase):
+
+    """
+    An engine that only loads the embeddings built by build_search_index serves the partitions that are built,
+    and reports the others, instead of failing the whole dataset when a new curriculum has no embeddings yet.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = EmbeddingStore(directory.name + "/")
+        patcher = mock.patch("services.src.data_loader.EmbeddingStore", lambda: EmbeddingStore(directory.name + "/"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # CBSE, ICSE and IB rows, only the CBSE and ICSE embeddings are built
+        self.df = SyntheticCorpus(seed=5, curricula=3).generate("school", 300)
+        benchmark = SearchBenchmark()
+        self.model_name = benchmark.model_name
+        self.embeddings = benchmark.encode_partitions("school", self.df)
+        for option in ("cbse", "icse"):
+            self.store.save(self.embeddings[option], "school_{}_embeddings".format(option), model_name=self.model_name)
+
+    def load_engine(self, snapshot: CorpusSnapshot = None, queryset=None) -> SearchEngine:
+        engine = SearchEngine(queryset, "school", ["CBSE", "ICSE", "IB"], build_index=False,
+                              snapshot=snapshot or CorpusSnapshot.from_dataframe(self.df, "school"))
+        engine.model_name = self.model_name
+        return engine
+
+    def test_missing_partition_is_reported(self):
+        engine = self.load_engine()
+        self.assertEqual(engine.missing_partitions, {"ib": "school_ib_embeddings"})
+        self.assertEqual(sorted(engine.pkl_data_holder), ["cbse", "icse"])
+
+        row = self.df[self.df["curriculum__abbreviation"] == "ICSE"].iloc[0]
+        results = engine.search(row["name"] + " " + row["address"], {"curriculum__abbreviation": "ICSE"})
+        self.assertTrue(results)
+        with self.assertRaises(IndexNotBuilt):
+            engine.search("dps", {"curriculum__abbreviation": "IB"})
+        with self.assertRaises(IndexNotBuilt):
+            engine.search_batch([("dps", {"curriculum__abbreviation": "CBSE"}), ("dps", {"curriculum__abbreviation": "IB"})])
+
+        # Once build_search_index has built the partition, a reload picks it up
+        snapshot = CorpusSnapshot.from_dataframe(self.df, "school")
+        self.assertTrue(engine.is_current(snapshot))
+        self.store.save(self.embeddings["ib"], "school_ib_embeddings", model_name=self.model_name)
+        self.assertFalse(engine.is_current(snapshot))
+        self.assertEqual(self.load_engine().missing_partitions, {})
+
+    def test_pkl_files_are_not_converted_by_the_web_process(self):
+        ib = self.embeddings["ib"]
+        with open(self.store.dir_path + "school_ib_embeddings.pkl", "wb") as f:
+            pickle.dump(dict(zip(ib.keys, np.asarray(ib.matrix))), f)
+
+        self.assertEqual(self.load_engine().missing_partitions, {"ib": "school_ib_embeddings"})
+        self.assertFalse(self.store.exists("school_ib_embeddings"))
+
+    def test_files_are_checked_before_the_rows_are_read(self):
+        queryset = mock.Mock()
+        queryset.values_list.side_effect = AssertionError("the rows were read")
+        with self.assertRaises(IndexNotBuilt):
+            SearchEngine(queryset, "subject", ["CBSE", "ICSE"], build_index=False)
+        queryset.values_list.assert_not_called()
+
+    def test_readiness_and_search_of_a_missing_partition(self):
+        engine = self.load_engine()
+        manager = EngineManager({"school": lambda snapshot=None: engine})
+        manager.build(["school"])
+
+        with mock.patch("core.views.engine_manager", manager):
+            ready = self.client.get("/profile/ready")
+            missing = self.client.generic("GET", "/profile/school", '{"query": "dps", "curriculum": "ib"}',
+                                          content_type="application/json")
+        self.assertEqual(ready.status_code, 200)
+        self.assertEqual(ready.json()["datasets"]["school"]["missing_partitions"], ["ib"])
+        self.assertEqual(missing.status_code, 503)
+        self.assertEqual(missing.json()["result"], "unavailable")
+
+
+class CorpusSnapshotTests(TestCase):
+
+    """
+    An engine and its CheckPickleExists read the rows once into one CorpusSnapshot,
+    whose content hash tells a reload that the rows have not changed.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        mock.patch("services.src.data_loader.EmbeddingStore", lambda: EmbeddingStore(directory.name + "/")).start()
+        registry = ModelRegistry()
+        registry.register(DEFAULT_MODEL_NAME, HashingEncoder())
+        mock.patch("services.src.train_model.model_registry", registry).start()
+        mock.patch("services.src.fuzzy_school_matcher.model_registry", registry).start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.cbse = Curriculum.objects.create(name="Central Board of Secondary Education", abbreviation="CBSE")
+        for name, address in [("Delhi Public School", "R K Puram"), ("Kendriya Vidyalaya", "Andheri")]:
+            School.objects.create(name=name, address=address, curriculum=self.cbse)
+
+    def test_rows_are_read_once(self):
+        queryset = School.objects.select_related('curriculum')
+        with self.assertNumQueries(1):
+            engine = SearchEngine(queryset, "school", ["CBSE"])
+
+        self.assertIs(engine.checker.snapshot, engine.snapshot)
+        self.assertEqual(sorted(engine.snapshot.df["name"]), ["Delhi Public School", "Kendriya Vidyalaya"])
+        self.assertEqual(engine.search("dps", {"curriculum__abbreviation": "CBSE"})[0][0], "Delhi Public School")
+
+        # A snapshot that is given is used as it is
+        snapshot = CorpusSnapshot.from_queryset(queryset, "school")
+        with self.assertNumQueries(0):
+            engine = SearchEngine(queryset, "school", ["CBSE"], snapshot=snapshot)
+        self.assertIs(engine.snapshot, snapshot)
+
+    def test_content_hash(self):
+        queryset = School.objects.select_related('curriculum')
+        snapshot = CorpusSnapshot.from_queryset(queryset, "school")
+        self.assertEqual(CorpusSnapshot.from_queryset(queryset, "school").content_hash, snapshot.content_hash)
+        self.assertEqual(CorpusSnapshot.from_dataframe(snapshot.df, "school").content_hash, snapshot.content_hash)
+
+        engine = SearchEngine(queryset, "school", ["CBSE"], snapshot=snapshot)
+        self.assertTrue(engine.is_current(CorpusSnapshot.from_queryset(queryset, "school")))
+
+        School.objects.create(name="Sacred Heart Convent School", address="Ludhiana", curriculum=self.cbse)
+        changed = CorpusSnapshot.from_queryset(queryset, "school")
+        self.assertNotEqual(changed.content_hash, snapshot.content_hash)
+        self.assertFalse(engine.is_current(changed))
+
+
+class PartitionBuildTests(SimpleTestCase):
+
+    """
+    build_search_index brings a partition up to date with its rows in one new version of its files,
+    whether rows were added, deleted, or both.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = EmbeddingStore(directory.name + "/")
+        patcher = mock.patch("services.src.data_loader.EmbeddingStore", lambda: EmbeddingStore(directory.name + "/"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.df = SyntheticCorpus(seed=9, curricula=1).generate("school", 200).drop_duplicates(["name", "address"])
+        benchmark = SearchBenchmark()
+        self.model_name = benchmark.model_name
+        self.store.save(benchmark.encode_partitions("school", self.df)["cbse"], "school_cbse_embeddings",
+                        model_name=self.model_name)
+
+    def build(self, df: pd.DataFrame) -> dict:
+        checker = CheckPickleExists(None, "school", ["CBSE"], build=False,
+                                    snapshot=CorpusSnapshot.from_dataframe(df, "school"))
+        checker.train.model_name = self.model_name
+        return checker.build_partition("cbse"), checker
+
+    def test_added_and_deleted_rows_are_built_in_one_version(self):
+        old_version = self.store.load_manifest("school_cbse_embeddings")["version"]
+        added = self.df.head(2).assign(name=["Zephyr Valley Academy", "Quill Hill School"])
+        df = pd.concat([self.df.iloc[3:], added], ignore_index=True)
+
+        report, checker = self.build(df)
+
+        self.assertEqual((report["encoded"], report["deleted"]), (2, 3))
+        manifest = self.store.load_manifest("school_cbse_embeddings")
+        self.assertEqual(manifest["previous_versions"], [old_version])
+        self.assertEqual(set(self.store.load("school_cbse_embeddings").keys), set(checker.snapshot.df["concat"]))
+        self.assertEqual(manifest["keys_hash"], checker.snapshot.partition_hash("cbse", checker.snapshot.df))
+
+        # The next build finds the file up to date
+        report, _ = self.build(df)
+        self.assertEqual((report["encoded"], report["deleted"], report["version"]), (0, 0, manifest["version"]))
+
+
+class SubjectPartitionTests(SimpleTestCase):
+
+    """
+    Subject searches with an education level only search the subjects of that level in their curriculum,
+    the ones without it search the whole curriculum.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        df = pd.DataFrame([
+            ("Physics", "CBSE", "hsc"),
+            ("Physics Honours", "CBSE", "ug"),
+            ("Chemistry", "CBSE", "hsc"),
+            ("Physics", "ICSE", "ssc"),
+        ], columns=["name", "curriculum__abbreviation", "education_level"])
+        benchmark = SearchBenchmark()
+        self.engine = SearchEngine.from_dataframe(df, "subject", benchmark.encode_partitions("subject", df),
+                                                  benchmark.model_name)
+        self.engine_manager = mock.patch("core.views.engine_manager").start()
+        self.engine_manager.get_engine.return_value = self.engine
+        self.addCleanup(mock.patch.stopall)
+        mock.patch("core.views.query_log").start()
+
+    def search(self, body: dict) -> list:
+        response = self.client.generic("GET", "/profile/school/subject", json.dumps(body), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return [result[0] for result in response.json()["data"]]
+
+    def test_education_level_filters_the_subjects(self):
+        self.assertEqual(self.search({"query": "physics honours", "curriculum": "cbse", "education_level": "ug"}),
+                         ["Physics Honours"])
+        self.assertEqual(sorted(self.search({"query": "physics honours", "curriculum": "cbse", "education_level": "hsc"})),
+                         ["Chemistry", "Physics"])
+        self.assertEqual(sorted(self.search({"query": "physics honours", "curriculum": "cbse"})),
+                         ["Chemistry", "Physics", "Physics Honours"])
+
+        # A level the curriculum has no subjects of matches nothing
+        self.assertEqual(self.search({"query": "physics", "curriculum": "icse", "education_level": "phd"}), [])
+
+    def test_batch_items_are_filtered_by_education_level(self):
+        response = self.client.post("/profile/school/subject/batch", data=json.dumps({"items": [
+            {"query": "physics honours", "curriculum": "cbse", "education_level": "ug"},
+            {"query": "physics honours", "curriculum": "icse"},
+        ]}), content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([[result[0] for result in results] for results in response.json()["data"]],
+                         [["Physics Honours"], ["Physics"]])
+
+
+class BulkIngestTests(TestCase):
+
+    """
+    The bulk ingestion endpoints write the valid rows chunk by chunk and report the others by their row number.
+    Once any row is written, the engine is reloaded and the partitions of the rows are recorded for build_search_index.
+    """
+
+    def setUp(self):
+        Curriculum.objects.create(name="Central Board of Secondary Education", abbreviation="CBSE")
+        Curriculum.objects.create(name="Indian Certificate of Secondary Education", abbreviation="ICSE")
+        patcher = mock.patch("core.views.engine_manager")
+        self.engine_manager = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, path: str, body: bytes, content_type: str = "text/csv"):
+        return self.client.post(path, data=body, content_type=content_type)
+
+    def assert_pending(self, dataset: str, partitions: list) -> None:
+        # Nothing is encoded by the web process, the partitions wait for build_search_index --pending
+        self.assertEqual(sorted(PendingIndexBuild.objects.values_list("dataset", "partition")),
+                         [(dataset, partition) for partition in partitions])
+        if dataset:
+            self.engine_manager.reload.assert_called_once_with(dataset)
+        else:
+            self.engine_manager.reload.assert_not_called()
+
+    def test_csv(self):
+        body = "name,address,curriculum\nDelhi Public School,R K Puram,CBSE\nSt Xavier's,\"Mumbai, MH\",ICSE\n"
+        response = self.post("/profile/school/bulk", body.encode("utf-8"))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"rows": 2, "created": 2, "error_count": 0, "errors": [],
+                                           "partitions": ["cbse", "icse"], "index": "pending", "result": "ok"})
+        self.assertEqual(list(School.objects.order_by("id").values_list("address", "curriculum__abbreviation")),
+                         [("R K Puram", "CBSE"), ("Mumbai, MH", "ICSE")])
+        self.assert_pending("school", ["cbse", "icse"])
+
+    def test_csv_without_the_required_columns(self):
+        response = self.post("/profile/school/bulk", b"name,curriculum\nDelhi Public School,CBSE\n")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(School.objects.count(), 0)
+        self.assert_pending(None, [])
+
+    def test_ndjson(self):
+        body = "\n".join([
+            json.dumps({"name": "IIT Bombay", "address": "Powai"}),
+            "",
+            "{not json",
+            json.dumps(["IIT Delhi", "Hauz Khas"]),
+            json.dumps({"name": "IIT Delhi"}),
+            json.dumps({"name": "IIT Madras", "address": "Chennai"}),
+        ])
+        response = self.post("/profile/college/bulk", body.encode("utf-8"), "application/x-ndjson")
+
+        self.assertEqual(response.status_code, 201)
+        report = response.json()
+        self.assertEqual((report["rows"], report["created"], report["result"]), (5, 2, "partial"))
+        self.assertEqual([error["row"] for error in report["errors"]], [2, 3, 4])
+        self.assertIn("address", report["errors"][2]["errors"])
+        self.assertEqual(College.objects.count(), 2)
+        self.assert_pending("college", ["college"])
+
+    def test_bad_row(self):
+        # A byte that is not UTF-8 in row 550, after the first chunk of 500 rows was written
+        lines = [b"name,address,curriculum"] + [
+            "School {},Street {},CBSE".format(row, row).encode("utf-8") for row in range(1, 602)]
+        lines[550] = b"School \xff,Street 550,CBSE"
+        response = self.post("/profile/school/bulk", b"\n".join(lines) + b"\n")
+
+        self.assertEqual(response.status_code, 201)
+        report = response.json()
+        self.assertEqual((report["rows"], report["created"], report["result"]), (601, 600, "partial"))
+        self.assertEqual(report["errors"], [{"row": 550, "errors": {"non_field_errors": ["The row is not valid UTF-8"]}}])
+        self.assertEqual(School.objects.count(), 600)
+        self.assert_pending("school", ["cbse"])
+
+    def test_unknown_curriculum(self):
+        response = self.post("/profile/school/bulk", b"name,address,curriculum\nGems World,Dubai,IB\n")
+
+        self.assertEqual(response.status_code, 400)
+        report = response.json()
+        self.assertEqual(report["result"], "error")
+        self.assertEqual(report["errors"], [{"row": 1, "errors": {"curriculum": ["Object with abbreviation=IB does not exist."]}}])
+        self.assertEqual(School.objects.count(), 0)
+        self.assert_pending(None, [])
+
+    def test_row_breaking_a_constraint(self):
+        # Without the duplicate check, the database rejects the duplicate subject and only its row
+        Subject.objects.create(name="Physics", curriculum=Curriculum.objects.get(abbreviation="CBSE"), education_level="hsc")
+        body = b"name,curriculum,education_level\nChemistry,CBSE,hsc\nPhysics,CBSE,hsc\nBiology,ICSE,ssc\n"
+        with mock.patch.object(SubjectBulkIngestAPIView, "drop_duplicates", lambda view, objects, report: objects):
+            response = self.post("/profile/school/subject/bulk", body)
+
+        self.assertEqual(response.status_code, 201)
+        report = response.json()
+        self.assertEqual((report["created"], [error["row"] for error in report["errors"]]), (2, [2]))
+        self.assertEqual(sorted(Subject.objects.values_list("name", flat=True)), ["Biology", "Chemistry", "Physics"])
+        self.assert_pending("subject", ["cbse", "icse"])
+
+    def test_rows_written_before_an_error_are_indexed(self):
+        # The second chunk fails unexpectedly, the first one stays written and is indexed
+        write_chunk = BulkIngestAPIView.write_chunk
+
+        def failing_write_chunk(view, chunk, report):
+            if report["created"]:
+                raise RuntimeError("The database is gone")
+            write_chunk(view, chunk, report)
+
+        lines = ["name,address,curriculum"] + ["School {},Street {},CBSE".format(row, row) for row in range(1, 602)]
+        with mock.patch.object(BulkIngestAPIView, "write_chunk", failing_write_chunk):
+            with self.assertRaises(RuntimeError):
+                self.post("/profile/school/bulk", "\n".join(lines).encode("utf-8"))
+
+        self.assertEqual(School.objects.count(), 500)
+        self.assert_pending("school", ["cbse"])
+
+
+class BuildPendingIndexTests(TestCase):
+
+    """
+    build_search_index --pending builds the partitions the web process recorded rows for, and deletes their records.
+    A partition recorded again while it was built stays pending for the next run.
+    """
+
+    def setUp(self):
+        checker = mock.Mock(dataset="school")
+        checker.get_file_names.return_value = ["cbse", "icse", "ib"]
+        patcher = mock.patch("core.management.commands.build_search_index.CheckPickleExists", return_value=checker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("core.management.commands.build_search_index.get_index_source", return_value=(None, []))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build(self, build_index_partition) -> list:
+        with mock.patch("core.management.commands.build_search_index.build_index_partition", build_index_partition):
+            call_command("build_search_index", "--pending", stdout=io.StringIO())
+        return sorted(PendingIndexBuild.objects.values_list("dataset", "partition"))
+
+    @staticmethod
+    def report(checker, option: str) -> dict:
+        return {"dataset": checker.dataset, "partition": option, "rows": 1, "encoded": 1, "deleted": 0,
+                "version": "1", "seconds": 0}
+
+    def test_only_pending_partitions_are_built(self):
+        mark_pending_partitions("school", ["icse"])
+        built = []
+
+        def build_index_partition(checker, option):
+            built.append(option)
+            return self.report(checker, option)
+
+        self.assertEqual(self.build(build_index_partition), [])
+        self.assertEqual(built, ["icse"])
+
+        # Nothing left to build
+        self.assertEqual(self.build(mock.Mock(side_effect=AssertionError("a partition was built"))), [])
+
+    def test_partitions_recorded_during_the_build_stay_pending(self):
+        mark_pending_partitions("school", ["cbse", "icse"])
+        # The ICSE rows are recorded again after the command read the rows
+        PendingIndexBuild.objects.filter(partition="icse").update(marked_at=timezone.now() + timedelta(minutes=1))
+
+        self.assertEqual(self.build(self.report), [("school", "icse")])
+
+
+class SearchAfterWriteTests(TransactionTestCase):
+
+    """
+    A row written through the API is found by the next searches once the engine is reloaded,
+    even when the same search was cached before the write.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        curriculum = Curriculum.objects.create(name="Central Board of Secondary Education", abbreviation="CBSE")
+        for name, address in [("Delhi Public School", "R K Puram"), ("Kendriya Vidyalaya", "Andheri")]:
+            School.objects.create(name=name, address=address, curriculum=curriculum)
+
+        benchmark = SearchBenchmark()
+
+        def build_engine(snapshot=None):
+            df = (snapshot or load_snapshot("school")).df
+            return SearchEngine.from_dataframe(df, "school", benchmark.encode_partitions("school", df), benchmark.model_name)
+
+        self.manager = EngineManager({"school": build_engine})
+        self.manager.build(["school"])
+        mock.patch("core.views.engine_manager", self.manager).start()
+        mock.patch("core.views.query_log").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def search(self, query: str) -> list:
+        response = self.client.generic("GET", "/profile/school", json.dumps({"query": query, "curriculum": "cbse"}),
+                                       content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return [result[0] for result in response.json()["data"]]
+
+    def wait_for_reload(self, engine, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while (self.manager.engines["school"] is engine or self.manager.reloading) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_written_row_is_found(self):
+        self.assertNotIn("Sacred Heart Convent School", self.search("sacred heart convent school ludhiana"))
+
+        engine = self.manager.engines["school"]
+        response = self.client.post("/profile/school", data=json.dumps(
+            {"name": "Sacred Heart Convent School", "address": "Ludhiana", "curriculum": "CBSE"}), content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(PendingIndexBuild.objects.values_list("dataset", "partition")), [("school", "cbse")])
+
+        self.wait_for_reload(engine)
+        self.assertIsNot(self.manager.engines["school"], engine)
+        self.assertEqual(self.search("sacred heart convent school ludhiana")[0], "Sacred Heart Convent School")
+
+    def test_results_are_cached_by_the_engine_version(self):
+        cache = SearchResultCache()
+        engine = self.manager.engines["school"]
+        filter_dict = {"curriculum__abbreviation": "CBSE"}
+
+        # An engine built from the same rows and embeddings shares the keys, one built from other rows does not
+        same = self.manager.factories["school"](load_snapshot("school"))
+        self.assertEqual(cache.make_key("school", same.version, "dps", filter_dict),
+                         cache.make_key("school", engine.version, "dps", filter_dict))
+        School.objects.create(name="Sacred Heart Convent School", address="Ludhiana", curriculum=Curriculum.objects.get())
+        other = self.manager.factories["school"](load_snapshot("school"))
+        self.assertNotEqual(cache.make_key("school", other.version, "dps", filter_dict),
+                            cache.make_key("school", engine.version, "dps", filter_dict))
+
+
+class AsyncSearchViewTests(SimpleTestCase):
+
+    """
+    The async search views return what the sync views return, run the search on the search executor,
+    and map the errors of the engine and of the search to the responses of the sync views.
+    """
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.engine = mock.Mock(version=uuid.uuid4().hex)
+        self.engine.search.side_effect = self.search
+        self.engine_manager = mock.patch("core.async_views.engine_manager").start()
+        self.engine_manager.get_engine.return_value = self.engine
+        self.query_log = mock.patch("core.async_views.query_log").start()
+        self.addCleanup(mock.patch.stopall)
+        self.threads = []
+
+    def search(self, query: str, filter_dict: dict = None, **options) -> list:
+        self.threads.append(threading.current_thread().name)
+        return [[query.title(), filter_dict["curriculum__abbreviation"], 100]]
+
+    async def get(self, body) -> JsonResponse:
+        body = body if isinstance(body, str) else json.dumps(body)
+        request = self.factory.generic("GET", "/profile/school", body, content_type="application/json")
+        return await AsyncSchoolSearchView.as_view()(request)
+
+    async def test_search(self):
+        response = await self.get({"query": "dps", "curriculum": "cbse", "limit": 3})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"data": [["Dps", "CBSE", 100]]})
+        self.engine.search.assert_called_once_with("dps", {"curriculum__abbreviation": "CBSE"}, limit=3)
+        self.assertTrue(self.threads[0].startswith("search"))
+        self.query_log.log.assert_called_once_with({"query": "dps", "curriculum": "cbse"}, dataset="school")
+
+    async def test_request_errors(self):
+        response = await self.get("{not json")
+        self.assertEqual((response.status_code, json.loads(response.content)["message"]), (400, "Json decoding error"))
+
+        response = await self.get({"query": "dps"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("curriculum", json.loads(response.content)["errors"])
+        self.engine.search.assert_not_called()
+        self.query_log.log.assert_not_called()
+
+    async def test_engine_errors(self):
+        self.engine_manager.get_engine.side_effect = EngineWarmingUp("The school search engine is loading")
+        response = await self.get({"query": "dps", "curriculum": "cbse"})
+        self.assertEqual((response.status_code, json.loads(response.content)["result"]), (503, "warming_up"))
+        self.assertEqual(response["Retry-After"], "5")
+
+        self.engine_manager.get_engine.side_effect = EngineUnavailable("school", "OperationalError()", 30)
+        response = await self.get({"query": "dps", "curriculum": "cbse"})
+        self.assertEqual(json.loads(response.content)["error"], "OperationalError()")
+        self.assertEqual((response.status_code, response["Retry-After"]), (503, "30"))
+
+    async def test_search_errors(self):
+        for error, status, result in ((IndexNotBuilt("The school embeddings of ib are not built"), 503, "unavailable"),
+                                      (SearchDeadlineExceeded("No matcher finished"), 504, "timeout")):
+            self.engine.search.side_effect = error
+            response = await self.get({"query": "dps", "curriculum": "ib"})
+            self.assertEqual((response.status_code, json.loads(response.content)["result"]), (status, result))
+        self.query_log.log.assert_not_called()
+
+
+def parse_metrics(text: str) -> dict:
+    # {(name, labels): value} of the samples of the Prometheus text format, every line must be a comment or a sample
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP ") or line.startswith("# TYPE "):
+            continue
+        match = re.fullmatch(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*\})? (\S+)', line)
+        assert match, line
+        samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+
+class SearchMetricsTests(SimpleTestCase):
+
+    """
+    The metrics are rendered in the Prometheus text format, the histograms with cumulative buckets, and the
+    metrics endpoint serves the timings of the searches with those of the collectors.
+    """
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("test_requests_total", "Requests", ("dataset", "result"))
+        size = registry.gauge("test_size", "Size")
+        seconds = registry.histogram("test_seconds", "Time", ("stage",), buckets=(0.1, 1))
+        registry.add_collector(lambda: render_samples("test_dropped_total", "counter", "Dropped", [({}, 3)]))
+
+        requests.inc("school", "hit")
+        requests.inc("school", "hit")
+        requests.inc('a "quoted"\nvalue', "miss", value=0.5)
+        size.set(7)
+        for value in (0.05, 0.1, 0.5, 5):
+            seconds.observe(value, "encode")
+
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP test_requests_total Requests",
+            "# TYPE test_requests_total counter",
+            'test_requests_total{dataset="a \\"quoted\\"\\nvalue",result="miss"} 0.5',
+            'test_requests_total{dataset="school",result="hit"} 2',
+            "# HELP test_size Size",
+            "# TYPE test_size gauge",
+            "test_size 7",
+            "# HELP test_seconds Time",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="encode",le="0.1"} 2',
+            'test_seconds_bucket{stage="encode",le="1"} 3',
+            'test_seconds_bucket{stage="encode",le="+Inf"} 4',
+            'test_seconds_sum{stage="encode"} 5.65',
+            'test_seconds_count{stage="encode"} 4',
+            "# HELP test_dropped_total Dropped",
+            "# TYPE test_dropped_total counter",
+            "test_dropped_total 3",
+        ]) + "\n")
+        parse_metrics(registry.render())
+
+        # Switched off, the metrics keep their values
+        registry.enabled = False
+        requests.inc("school", "hit")
+        seconds.observe(0.05, "encode")
+        self.assertEqual(parse_metrics(registry.render())[("test_seconds_count", '{stage="encode"}')], 4)
+
+    def test_metrics_endpoint(self):
+        use_portable_paths(self)
+        engine = build_school_engine(rows=200)
+        mock.patch("core.views.engine_manager").start().get_engine.return_value = engine
+        mock.patch("core.views.query_log").start()
+        self.addCleanup(mock.patch.stopall)
+
+        def searches() -> float:
+            response = self.client.get("/metrics")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+            samples = parse_metrics(response.content.decode("utf-8"))
+            self.assertIn(("search_query_log_rows_total", '{outcome="dropped"}'), samples)
+            self.assertIn(("search_query_embedding_cache_size", ""), samples)
+            return sum(value for (name, labels), value in samples.items()
+                       if name == "search_request_seconds_count" and 'dataset="school"' in labels)
+
+        before = searches()
+        query = "{} {}".format(engine.df["name"].iloc[0], uuid.uuid4().hex[:6])
+        response = self.client.generic("GET", "/profile/school", json.dumps({"query": query, "curriculum": "cbse"}),
+                                       content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(searches(), before + 1)
+
+
+class EmbeddingStoreTests(SimpleTestCase):
+
+    """
+    Every partition is a versioned matrix (.npy) and keys file, and a manifest that points to the current version.
+    The files of the last versions are kept, the older ones and the files written before versioning are deleted.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.store = EmbeddingStore(self.directory + "/")
+        self.embeddings = EmbeddingMatrix(["dps rk puram", "kv delhi"], EmbeddingMatrix.normalize([[3, 4], [1, 0]]))
+
+    def partition_files(self, file_name: str) -> list:
+        return sorted(dir_file for dir_file in os.listdir(self.directory) if dir_file.startswith(file_name))
+
+    def test_save_and_load(self):
+        self.store.save(self.embeddings, "school_cbse_embeddings", model_name="test-model")
+
+        manifest = self.store.load_manifest("school_cbse_embeddings")
+        version = manifest["version"]
+        self.assertEqual(self.partition_files("school_cbse_embeddings"), [
+            "school_cbse_embeddings.{}.npy".format(version),
+            "school_cbse_embeddings.{}_keys.json".format(version),
+            "school_cbse_embeddings_manifest.json",
+        ])
+        self.assertEqual((manifest["rows"], manifest["dim"], manifest["model_name"], manifest["previous_versions"]),
+                         (2, 2, "test-model", []))
+        self.assertEqual(manifest["keys_hash"], EmbeddingMatrix.keys_hash(["kv delhi", "dps rk puram"]))
+
+        loaded = self.store.load("school_cbse_embeddings")
+        # The matrix is a view of the memory mapped file, not a copy
+        self.assertIsInstance(loaded.matrix.base, np.memmap)
+        self.assertEqual(loaded.keys, ["dps rk puram", "kv delhi"])
+        np.testing.assert_allclose(loaded.matrix, [[0.6, 0.8], [1, 0]], rtol=1e-6)
+
+    def test_empty_partition(self):
+        self.store.save(EmbeddingMatrix([], np.zeros((0, 2), dtype=np.float32)), "school_ib_embeddings")
+        loaded = self.store.load("school_ib_embeddings")
+        self.assertEqual((loaded.keys, loaded.matrix.shape), ([], (0, 2)))
+
+    def test_versions_are_pruned(self):
+        # A file written before versioning is deleted by the first save
+        with open(os.path.join(self.directory, "college_embeddings.npy"), "wb") as f:
+            np.save(f, self.embeddings.matrix)
+
+        versions = []
+        for _ in range(3):
+            self.store.save(self.embeddings, "college_embeddings")
+            versions.append(self.store.load_manifest("college_embeddings")["version"])
+
+        self.assertEqual(len(set(versions)), 3)
+        manifest = self.store.load_manifest("college_embeddings")
+        self.assertEqual(manifest["previous_versions"], [versions[1]])
+        self.assertEqual(self.partition_files("college_embeddings"), sorted([
+            "college_embeddings.{}.npy".format(versions[1]), "college_embeddings.{}_keys.json".format(versions[1]),
+            "college_embeddings.{}.npy".format(versions[2]), "college_embeddings.{}_keys.json".format(versions[2]),
+            "college_embeddings_manifest.json",
+        ]))
+
+        # The manifest can be updated without writing a new version
+        self.store.update_manifest("college_embeddings", keys_hash="x")
+        self.assertEqual(self.store.load_manifest("college_embeddings")["version"], versions[2])
+        self.assertEqual(self.store.load_manifest("college_embeddings")["keys_hash"], "x")
+
+    def test_convert_pkl(self):
+        with open(os.path.join(self.directory, "major_embeddings.pkl"), "wb") as f:
+            pickle.dump({"computer science": np.array([0, 2], dtype=np.float32), "biology": [3, 4]}, f)
+
+        self.assertFalse(self.store.exists("major_embeddings"))
+        self.assertTrue(self.store.legacy_pkl_exists("major_embeddings"))
+        self.assertEqual(self.store.convert_all_pkl(model_name="test-model"), ["major_embeddings"])
+
+        loaded = self.store.load("major_embeddings")
+        self.assertEqual(loaded.keys, ["computer science", "biology"])
+        np.testing.assert_allclose(loaded.matrix, [[0, 1], [0.6, 0.8]], rtol=1e-6)
+        self.assertEqual(self.store.load_manifest("major_embeddings")["model_name"], "test-model")
+        self.assertTrue(self.store.legacy_pkl_exists("major_embeddings"))
+
+
+class EmbeddingMatrixTests(SimpleTestCase):
+
+    """
+    The top k rows of one matrix-vector product and argpartition are the ones of the former scoring,
+    one cosine similarity per row and a full sort.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.vectors = rng.normal(size=(500, 16)).astype(np.float32)
+        self.keys = ["row {}".format(row) for row in range(500)]
+        self.embeddings = EmbeddingMatrix.from_dict(dict(zip(self.keys, self.vectors)))
+        self.queries = rng.normal(size=(5, 16)).astype(np.float32)
+
+    def scan_top_k(self, query, k: int) -> list:
+        similarities = {key: float(np.dot(vector, query) / (np.linalg.norm(vector) * np.linalg.norm(query)))
+                        for key, vector in zip(self.keys, self.vectors)}
+        return sorted(similarities.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def test_same_top_k_as_the_scan(self):
+        for query in self.queries:
+            for k in (1, 25, 500, 600):
+                top_k = self.embeddings.top_k(query, k)
+                expected = self.scan_top_k(query, k)
+                self.assertEqual([key for key, _ in top_k], [key for key, _ in expected])
+                np.testing.assert_allclose([score for _, score in top_k], [score for _, score in expected], atol=1e-5)
+
+        for top_k, query in zip(self.embeddings.top_k_batch(list(self.queries), 25), self.queries):
+            self.assertEqual([key for key, _ in top_k], [key for key, _ in self.embeddings.top_k(query, 25)])
+
+    def test_ties_are_kept_in_row_order(self):
+        embeddings = EmbeddingMatrix(["a", "b", "c", "d"], EmbeddingMatrix.normalize([[1, 0], [0, 1], [1, 0], [2, 0]]))
+        self.assertEqual([key for key, _ in embeddings.top_k([1, 0], 2)], ["a", "c"])
+        self.assertEqual([key for key, _ in embeddings.top_k([1, 0], 4)], ["a", "c", "d", "b"])
+        self.assertEqual(EmbeddingMatrix([], np.zeros((0, 2))).top_k([1, 0], 5), [])
+
+
+class ModelRegistryTests(SimpleTestCase):
+
+    """
+    A model is loaded once per process, on first use, and the same instance is handed to the matchers and the trainer.
+    """
+
+    def setUp(self):
+        self.loads = []
+
+        def load(model_name):
+            time.sleep(0.05)
+            self.loads.append(model_name)
+            return HashingEncoder(dim=8)
+
+        patcher = mock.patch("services.src.model_registry.SentenceTransformer", side_effect=load)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_a_model_is_loaded_once(self):
+        registry = ModelRegistry()
+        models = []
+        threads = [threading.Thread(target=lambda: models.append(registry.get_model("test-model"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, ["test-model"])
+        self.assertEqual(len(models), 8)
+        self.assertTrue(all(model is models[0] for model in models))
+        self.assertEqual(registry.loaded_models(), ["test-model"])
+
+    def test_matchers_and_trainer_share_the_model(self):
+        trainer = TrainModel()
+        matcher = FuzzySchoolMatcher()
+        # Nothing is loaded until something is encoded
+        self.assertEqual(self.loads, [])
+
+        with mock.patch("services.src.fuzzy_school_matcher.model_registry", ModelRegistry()) as registry, \
+                mock.patch("services.src.train_model.model_registry", registry):
+            self.assertIs(trainer.model, matcher.model)
+            self.assertIs(FuzzySchoolMatcher().model, matcher.model)
+        self.assertEqual(self.loads, [DEFAULT_MODEL_NAME])
+
+
+class QueryEmbeddingCacheTests(SimpleTestCase):
+
+    """
+    The query embedding cache keeps the most recently used embeddings of each model, and counts its hits and misses.
+    """
+
+    def setUp(self):
+        self.cache = QueryEmbeddingCache(maxsize=2)
+        self.encoded = []
+
+    def encode(self, query: str) -> np.ndarray:
+        self.encoded.append(query)
+        return np.array([len(query)], dtype=np.float32)
+
+    def encode_many(self, queries: list) -> list:
+        self.encoded.append(list(queries))
+        return [np.array([len(query)], dtype=np.float32) for query in queries]
+
+    def test_least_recently_used_is_evicted(self):
+        for query in ("dps", "kv", "dps", "dav"):
+            self.cache.get_or_encode("model", query, self.encode)
+        # "kv" was used less recently than "dps", which was read again before "dav" was added
+        self.assertEqual(self.encoded, ["dps", "kv", "dav"])
+        self.assertEqual(list(self.cache.entries), [("model", "dps"), ("model", "dav")])
+        self.assertEqual(self.cache.stats(), {"size": 2, "maxsize": 2, "hits": 1, "misses": 3})
+
+        self.cache.get_or_encode("model", "kv", self.encode)
+        self.assertEqual(list(self.cache.entries), [("model", "dav"), ("model", "kv")])
+
+        # The embeddings of another model are not shared
+        self.cache.get_or_encode("other-model", "kv", self.encode)
+        self.assertEqual(self.encoded[-1], "kv")
+        self.assertEqual(self.cache.stats()["misses"], 5)
+
+    def test_many_queries_are_encoded_in_one_call(self):
+        self.cache.resize(10)
+        self.cache.get_or_encode("model", "dps", self.encode)
+        embeddings = self.cache.get_or_encode_many("model", ["kv", "dps", "dav", "kv"], self.encode_many)
+
+        self.assertEqual([float(embedding[0]) for embedding in embeddings], [2, 3, 3, 2])
+        self.assertEqual(self.encoded, ["dps", ["kv", "dav"]])
+        self.assertEqual((self.cache.stats()["hits"], self.cache.stats()["misses"]), (1, 3))
+
+        self.cache.resize(1)
+        self.assertEqual(list(self.cache.entries), [("model", "dav")])
+
+    def test_size_zero_disables_the_cache(self):
+        self.cache.resize(0)
+        self.cache.get_or_encode("model", "dps", self.encode)
+        self.cache.get_or_encode("model", "dps", self.encode)
+        self.assertEqual(self.encoded, ["dps", "dps"])
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+
+class RecordingEncoder(HashingEncoder):
+
+    # The hashing encoder, with the calls of the batched and the multi-process encode recorded
+
+    def __init__(self):
+        super().__init__(dim=8)
+        self.calls = []
+
+    def encode(self, values, batch_size: int = 64, show_progress_bar: bool = False, convert_to_numpy: bool = True):
+        self.calls.append(("encode", len(values), batch_size))
+        return super().encode(values)
+
+    def start_multi_process_pool(self, target_devices: list):
+        self.calls.append(("start", len(target_devices)))
+        return "pool"
+
+    def encode_multi_process(self, values, pool, batch_size: int = 64):
+        self.calls.append(("encode_multi_process", len(values), batch_size))
+        return super().encode(values)
+
+    def stop_multi_process_pool(self, pool):
+        self.calls.append(("stop",))
+
+
+class TrainModelTests(SimpleTestCase):
+
+    """
+    The strings of a partition are encoded in batches, in one call, or by a pool of processes for the large ones,
+    with the same embeddings as encoding them one at a time.
+    """
+
+    def setUp(self):
+        self.encoder = RecordingEncoder()
+        registry = ModelRegistry()
+        registry.register(DEFAULT_MODEL_NAME, self.encoder)
+        patcher = mock.patch("services.src.train_model.model_registry", registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = EmbeddingStore(directory.name + "/")
+
+    def train_model(self, **options) -> TrainModel:
+        train = TrainModel(**options)
+        train.loader.store = self.store
+        return train
+
+    def test_partition_is_encoded_in_one_batched_call(self):
+        df = pd.DataFrame({"concat": ["dps rk puram", "kv andheri", "dps rk puram", "dav pune"]})
+        report = self.train_model(batch_size=2).train(df, "school_cbse_embeddings")
+
+        self.assertEqual(self.encoder.calls, [("encode", 3, 2)])
+        self.assertEqual(report["rows"], 3)
+        self.assertIn("rows_per_second", report)
+
+        embeddings = self.store.load("school_cbse_embeddings")
+        self.assertEqual(embeddings.keys, ["dps rk puram", "kv andheri", "dav pune"])
+        expected = EmbeddingMatrix.normalize([self.encoder.encode_one(key) for key in embeddings.keys])
+        np.testing.assert_allclose(embeddings.matrix, expected, rtol=1e-6)
+
+    def test_large_partitions_are_encoded_by_a_pool(self):
+        train = self.train_model(batch_size=16, processes=4, pool_min_rows=3)
+        train.encode_values(["a", "b"])
+        train.encode_values(["a", "b", "c"])
+
+        self.assertEqual(self.encoder.calls, [("encode", 2, 16), ("start", 4), ("encode_multi_process", 3, 16), ("stop",)])
+
+    def test_new_values_are_encoded_in_one_call(self):
+        train = self.train_model()
+        train.train(pd.DataFrame({"concat": ["dps rk puram", "kv andheri"]}), "school_cbse_embeddings")
+        self.encoder.calls.clear()
+
+        report = train.update_embeddings({"dav pune", "st xaviers fort"}, {"kv andheri"}, "school_cbse_embeddings")
+        self.assertEqual(self.encoder.calls, [("encode", 2, 64)])
+        self.assertEqual(report["rows"], 2)
+        self.assertEqual(self.store.load("school_cbse_embeddings").keys, ["dps rk puram", "dav pune", "st xaviers fort"])
+
+
+class RowIndexTests(SimpleTestCase):
+
+    """
+    The fuzzy results are turned back into rows with the row index of the partition, and give the names and addresses
+    of the former lookup, the first row of the dataframe whose concatenated string is the match.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        df = pd.DataFrame([
+            ("St. Mary's School", "Pune", "CBSE"),
+            ("St Marys School", "Pune", "CBSE"),
+            ("Kendriya Vidyalaya", "Andheri", "CBSE"),
+            ("St Marys School", "Pune", "ICSE"),
+        ], columns=["name", "address", "curriculum__abbreviation"])
+        benchmark = SearchBenchmark()
+        self.engine = SearchEngine.from_dataframe(df, "school", benchmark.encode_partitions("school", df),
+                                                  benchmark.model_name)
+        self.partition = self.engine.select_partition({"curriculum__abbreviation": "CBSE"})
+
+    def test_rows_sharing_a_concat_string(self):
+        self.assertEqual(self.partition.concat[0], self.partition.concat[1])
+        self.assertEqual(self.partition.row_index, {self.partition.concat[0]: 0, self.partition.concat[2]: 2})
+
+        df = self.engine.df[self.engine.df["curriculum__abbreviation"] == "CBSE"]
+        entries = self.partition.embeddings.top_k(self.engine.model.encode("st marys school pune"), 25)
+        results = self.engine.rerank_entries("st marys school pune", self.partition, entries, 5)
+        expected = [(df.loc[df["concat"] == key, "name"].values[0].title(),
+                     df.loc[df["concat"] == key, "address"].values[0].title()) for key, _ in entries]
+        self.assertEqual([result[:2] for result in results], expected)
+
+    def test_strings_no_longer_in_the_partition_are_left_out(self):
+        entries = [("a school that was deleted", 0.9), (self.partition.concat[2], 0.5)]
+        results = self.engine.rerank_entries("kendriya vidyalaya", self.partition, entries, 5)
+        self.assertEqual([result[0] for result in results], ["Kendriya Vidyalaya"])
+
+
+def build_school_engine(rows: int = 600) -> SearchEngine:
+    # A school engine over a synthetic corpus, with the hashing encoder of the benchmarks
+    df = SyntheticCorpus(seed=21, curricula=2).generate("school", rows)
+    benchmark = SearchBenchmark()
+    return SearchEngine.from_dataframe(df, "school", benchmark.encode_partitions("school", df), benchmark.model_name)
+
+
+class MatcherPoolTests(SimpleTestCase):
+
+    """
+    The matchers of a hybrid search run on the shared pool until the deadline. A matcher that misses it is dropped,
+    the results of the other one are returned as PartialResults, and a school found by both is listed once.
+    """
+
+    def setUp(self):
+        use_portable_paths(self)
+        self.pool = MatcherPool(workers=2)
+        self.addCleanup(lambda: self.pool.get_executor().shutdown(wait=False))
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def slow(self, results: list):
+        # A matcher that checks its deadline between its steps, like the abbreviation and fuzzy searches
+        while not self.release.wait(0.01):
+            check_deadline()
+        return results
+
+    def test_results_in_order(self):
+        self.assertEqual(self.pool.run([lambda: "abbreviation", lambda: "fuzzy"], deadline=5), ["abbreviation", "fuzzy"])
+
+    def test_deadline(self):
+        start = time.monotonic()
+        results = self.pool.run([lambda: ["fast"], lambda: self.slow(["slow"])], deadline=0.1)
+        self.assertEqual(results, [["fast"], None])
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_time_in_the_queue_is_not_part_of_the_deadline(self):
+        # Every thread of the pool is busy, the request runs its matchers itself
+        pool = MatcherPool(workers=1)
+        self.addCleanup(lambda: pool.get_executor().shutdown(wait=False))
+        pool.get_executor().submit(self.release.wait, 5)
+
+        def matcher(result: str):
+            time.sleep(0.06)
+            return result
+
+        self.assertEqual(pool.run([lambda: matcher("abbreviation"), lambda: matcher("fuzzy")], deadline=0.1),
+                         ["abbreviation", "fuzzy"])
+
+    def test_a_matcher_past_its_deadline_stops(self):
+        stopped = threading.Event()
+
+        def matcher():
+            try:
+                while not self.release.is_set():
+                    check_deadline()
+                    time.sleep(0.01)
+            finally:
+                stopped.set()
+
+        self.assertEqual(self.pool.run([lambda: "abbreviation", matcher], deadline=0.1), ["abbreviation", None])
+        self.assertTrue(stopped.wait(1))
+
+    def test_errors_are_raised(self):
+        def fail():
+            raise ValueError("matcher failed")
+        with self.assertRaises(ValueError):
+            self.pool.run([lambda: [], fail], deadline=5)
+
+    def test_partial_results(self):
+        engine = build_school_engine()
+        school = ("Delhi Public School", "Rk Puram New Delhi", 80.0)
+        filter_dict = {"curriculum__abbreviation": "CBSE"}
+
+        with mock.patch("services.src.search_engine.matcher_pool", MatcherPool(workers=2, deadline=0.1)), \
+                mock.patch.object(engine, "abbreviation_search", return_value=[school]), \
+                mock.patch.object(engine, "fuzzy_search", side_effect=lambda **kwargs: self.slow([])):
+            results = engine.search("dps rk puram delhi", filter_dict)
+            # The results of the abbreviation matcher alone, with the bias of the hybrid search
+            self.assertIsInstance(results, PartialResults)
+            self.assertEqual(list(results), [("Delhi Public School", "Rk Puram New Delhi", 90.0)])
+
+        with mock.patch("services.src.search_engine.matcher_pool", MatcherPool(workers=2, deadline=0.1)), \
+                mock.patch.object(engine, "abbreviation_search", side_effect=lambda **kwargs: self.slow([])), \
+                mock.patch.object(engine, "fuzzy_search", side_effect=lambda **kwargs: self.slow([])):
+            with self.assertRaises(SearchDeadlineExceeded):
+                engine.search("dps rk puram delhi", filter_dict)
+
+    def test_hybrid_results_are_deduplicated(self):
+        engine = build_school_engine()
+        abbreviation = [("Delhi Public School", "Rk Puram", 80.0), ("Kendriya Vidyalaya", "Delhi", 60.0)]
+        fuzzy = [("Delhi Public School", "Rk Puram", 85.0), ("Doon Public School", "Delhi", 70.0)]
+
+        with mock.patch.object(engine, "abbreviation_search", return_value=abbreviation), \
+                mock.patch.object(engine, "fuzzy_search", return_value=fuzzy):
+            results = engine.search("dps delhi", {"curriculum__abbreviation": "CBSE"})
+
+        # As many short as long words: the abbreviation results get the bias of 10
+        self.assertNotIsInstance(results, PartialResults)
+        self.assertEqual(results, [("Delhi Public School", "Rk Puram", 90.0), ("Doon Public School", "Delhi", 70.0),
+                                   ("Kendriya Vidyalaya", "Delhi", 70.0)])
+
+
+class SearchBatchTests(SimpleTestCase):
+
+    """
+    The batch endpoints return the results of every item in the input order, the same as the single searches,
+    in one response or streamed as NDJSON lines.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with mock.patch.object(CorpusSnapshot, "json_file", os.path.join("services", "data", "input", "query_data.json")):
+            cls.engine = build_school_engine()
+
+    def setUp(self):
+        self.engine_manager = mock.patch("core.views.engine_manager").start()
+        self.engine_manager.get_engine.return_value = self.engine
+        self.addCleanup(mock.patch.stopall)
+        self.query_log = mock.patch("core.views.query_log").start()
+
+        df = self.engine.df
+        self.items = [{"query": query, "curriculum": filter_dict["curriculum__abbreviation"].lower()}
+                      for query, filter_dict in SyntheticCorpus(seed=21).queries("school", df, 12)]
+
+    def expected(self) -> list:
+        results = [self.engine.search(item["query"], {"curriculum__abbreviation": item["curriculum"].upper()}, limit=3)
+                   for item in self.items]
+        return json.loads(json.dumps(results))
+
+    def post(self, body: dict):
+        return self.client.post("/profile/school/batch", data=json.dumps(body), content_type="application/json")
+
+    def test_batch(self):
+        response = self.post({"items": self.items, "limit": 3})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"], self.expected())
+        self.engine_manager.get_engine.assert_called_once_with("school")
+        self.assertEqual(len(self.query_log.log_many.call_args[0][0]), len(self.items))
+
+    def test_stream(self):
+        response = self.post({"items": self.items, "limit": 3, "stream": True})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).decode("utf-8").splitlines()]
+        self.assertEqual([line["index"] for line in lines], list(range(len(self.items))))
+        self.assertEqual([line["results"] for line in lines], self.expected())
+
+    def test_invalid_items(self):
+        response = self.post({"items": [{"query": "dps"}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("items", response.json()["errors"])
+
+        response = self.post({"items": []})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_curriculum(self):
+        items = self.items[:2] + [{"query": "dps", "curriculum": "xyz"}]
+        for stream in (False, True):
+            response = self.post({"items": items, "stream": stream})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["errors"], {"items": {"2": {"curriculum": ["There is no school curriculum xyz"]}}})
+        self.query_log.log_many.assert_not_called()
+
+    def test_item_options_are_rejected(self):
+        items = self.items[:2] + [dict(self.items[2], limit=1)]
+        response = self.post({"items": items, "limit": 3})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["errors"]["items"], ["Item 2: limit must be set for the whole batch, next to items"])
+
+
+class AnnIndexTests(SimpleTestCase):
+
+    """
+    The IVF index only scores the rows of the lists it probes. Probing every list gives the exact top k,
+    and the lists are widened when the probed ones hold fewer than k rows.
+    """
+
+    def setUp(self):
+        # Rows around 20 cluster centers, like the embeddings of similar school names
+        random = np.random.default_rng(3)
+        centers = random.normal(size=(20, 32))
+        matrix = centers[random.integers(0, 20, size=4000)] + random.normal(0, 0.3, size=(4000, 32))
+        self.embeddings = EmbeddingMatrix(["row {}".format(row) for row in range(4000)], EmbeddingMatrix.normalize(matrix))
+        self.index = IVFIndex.build(self.embeddings.keys, self.embeddings.matrix, n_lists=40)
+        self.queries = EmbeddingMatrix.normalize(matrix[:50] + random.normal(0, 0.1, size=(50, 32)))
+
+    def recall(self, n_probe: int, k: int = 25) -> float:
+        recalls = []
+        for query in self.queries:
+            exact = {key for key, _ in self.embeddings.exact_top_k(query, k)}
+            approximate = self.embeddings.ann_top_k(query, k, self.index, n_probe)
+            self.assertEqual(len(approximate), k)
+            recalls.append(len(exact & {key for key, _ in approximate}) / k)
+        return float(np.mean(recalls))
+
+    def test_recall_against_the_exact_top_k(self):
+        self.assertEqual(self.recall(n_probe=40), 1.0)
+        self.assertGreaterEqual(self.recall(n_probe=8), 0.9)
+        self.assertLessEqual(self.recall(n_probe=1), self.recall(n_probe=8))
+
+        # The scores of the rows that are found are the exact scores
+        exact = dict(self.embeddings.exact_top_k(self.queries[0], 25))
+        for key, score in self.embeddings.ann_top_k(self.queries[0], 25, self.index, 8):
+            if key in exact:
+                self.assertAlmostEqual(score, exact[key], places=5)
+
+    def test_small_lists_are_widened_to_k_rows(self):
+        # A skewed index: the list closest to the query holds a single row, the other one all the rest
+        query = self.embeddings.matrix[0]
+        index = IVFIndex(np.vstack([query, -query]), np.array([0, 1, 4000]), np.arange(4000, dtype=np.int32),
+                         self.index.fingerprint)
+        self.assertEqual(index.candidate_rows(query, 1).tolist(), [0])
+
+        self.embeddings.attach_index(index, 1)
+        self.assertEqual([key for key, _ in self.embeddings.top_k(query, 25)],
+                         [key for key, _ in self.embeddings.exact_top_k(query, 25)])
+
+    def test_n_probe_is_validated(self):
+        with self.assertRaises(ValueError):
+            self.index.candidate_rows(self.queries[0], 0)
+        with self.assertRaises(ValueError):
+            self.embeddings.ann_top_k(self.queries[0], 25, self.index, -1)
+
+    def test_recall_report_leaves_the_attached_index(self):
+        self.embeddings.attach_index(self.index, 8)
+        report = recall_report(self.embeddings, self.index, n_probe_values=(1, 40), sample_size=20)
+
+        self.assertEqual((self.embeddings.ann_index, self.embeddings.n_probe), (self.index, 8))
+        self.assertEqual([line["n_probe"] for line in report], [1, 40])
+        self.assertEqual(report[1]["recall"], 1.0)
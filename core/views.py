@@ -1,21 +1,66 @@
+import codecs
+import csv
+import json
+import re
 from json import JSONDecodeError
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from .serializers import *
 from rest_framework.parsers import JSONParser
 from rest_framework import views, status
 from rest_framework.response import Response
-from services.src import search_engine
+from services.src.query_embedding_cache import query_embedding_cache
+from services.src.matcher_pool import matcher_pool, SearchDeadlineExceeded
+from services.src.search_metrics import search_metrics
+from services.src.check_pickle_exists import IndexNotBuilt
 from core.models import *
+from core.search_cache import search_cache
+from core.query_log import query_log
+from core.engines import engine_manager, mark_pending_partitions, EngineWarmingUp, EngineUnavailable
 
 
-curriculum_queryset = Curriculum.objects.all()
-curriculum_list = list(curriculum_queryset.values_list("abbreviation", flat=True))
+# The search engines are built by the engine_manager, in the background or on first use, see core/engines.py
+query_embedding_cache.resize(settings.SEARCH_QUERY_EMBEDDING_CACHE_SIZE)
+matcher_pool.configure(settings.SEARCH_HYBRID['WORKERS'], settings.SEARCH_HYBRID['DEADLINE'])
+search_metrics.enabled = bool(settings.SEARCH_METRICS_ENABLED)
 
 
-school_search = search_engine.SearchEngine(School.objects.select_related('curriculum'), "school", curriculum_list)
-college_search = search_engine.SearchEngine(College.objects.all(), "college")
-subject_search = search_engine.SearchEngine(Subject.objects.select_related('curriculum'), "subject", curriculum_list)
-major_search = search_engine.SearchEngine(Major.objects.all(), "major")
+def warming_up_response(error: EngineWarmingUp) -> JsonResponse:
+    response = JsonResponse({"result": "warming_up", "message": str(error)}, status=503)
+    response["Retry-After"] = "5"
+    return response
+
+
+def unavailable_response(error: EngineUnavailable) -> JsonResponse:
+    # The engine failed to load, the error is returned instead of the warming up response that would never end
+    response = JsonResponse({"result": "unavailable", "message": str(error), "error": error.reason}, status=503)
+    response["Retry-After"] = str(max(1, int(error.retry_in)))
+    return response
+
+
+def not_built_response(error: IndexNotBuilt) -> JsonResponse:
+    # Only the partition without embeddings is unavailable, the rest of the dataset is served
+    return JsonResponse({"result": "unavailable", "message": str(error)}, status=503)
+
+
+def deadline_response(error: SearchDeadlineExceeded) -> JsonResponse:
+    return JsonResponse({"result": "timeout", "message": str(error)}, status=504)
+
+
+def subject_filter_dict(data: dict) -> dict:
+    # Subjects are partitioned by curriculum and education level, a search without an education level gets the whole curriculum
+    filter_dict = {'curriculum__abbreviation': data.get('curriculum').upper()}
+    if data.get('education_level'):
+        filter_dict['education_level'] = data.get('education_level').lower()
+    return filter_dict
+
+
+def refresh_search(dataset: str, partitions: list) -> None:
+    # The engine is reloaded so the abbreviation search finds the new rows, and the results cached from the previous
+    # engine are no longer used. The partitions of the rows wait for build_search_index --pending to be encoded
+    mark_pending_partitions(dataset, partitions)
+    engine_manager.reload(dataset)
 
 
 class SchoolAPIView(views.APIView):
@@ -35,13 +80,23 @@ class SchoolAPIView(views.APIView):
                 query = serializer.validated_data.get('query')
                 # all arguments after query are passed as filter_dictionary
                 curriculum = serializer.validated_data.get('curriculum')
-                results = school_search.search(query, {'curriculum__abbreviation': curriculum.upper()}) 
-                serializer.save()
+                results = search_cache.search("school", engine_manager.get_engine("school"), query,
+                                              {'curriculum__abbreviation': curriculum.upper()},
+                                              **serializer.get_search_options())
+                query_log.log(serializer.get_query_fields(), dataset="school")
                 return Response(results, status=status.HTTP_200_OK)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except JSONDecodeError:
             return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
+        except EngineWarmingUp as error:
+            return warming_up_response(error)
+        except EngineUnavailable as error:
+            return unavailable_response(error)
+        except IndexNotBuilt as error:
+            return not_built_response(error)
+        except SearchDeadlineExceeded as error:
+            return deadline_response(error)
 
     # keep this above for now
     
@@ -50,7 +105,8 @@ class SchoolAPIView(views.APIView):
             data = JSONParser().parse(request)
             serializer = self.post_serializer_class(data=data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
+                obj = serializer.save()
+                refresh_search("school", [obj.curriculum.abbreviation.lower()])
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -73,17 +129,21 @@ class SubjectAPIView(views.APIView):
             serializer = self.get_serializer_class(data=data)
             if serializer.is_valid(raise_exception=True):
                 query = serializer.validated_data.get('query')
-                curriculum = serializer.validated_data.get('curriculum')
-                education_level = serializer.validated_data.get('education_level')
-                results = subject_search.search(query,
-                                                {'curriculum__abbreviation': curriculum.upper(),},
-                                                subject=True)
-                serializer.save()
+                results = search_cache.search("subject", engine_manager.get_engine("subject"), query,
+                                              subject_filter_dict(serializer.validated_data),
+                                              subject=True, **serializer.get_search_options())
+                query_log.log(serializer.get_query_fields(), dataset="subject")
                 return Response(results, status=status.HTTP_200_OK)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except JSONDecodeError:
             return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
+        except EngineWarmingUp as error:
+            return warming_up_response(error)
+        except EngineUnavailable as error:
+            return unavailable_response(error)
+        except IndexNotBuilt as error:
+            return not_built_response(error)
 
 
     def post(self, request):
@@ -91,7 +151,8 @@ class SubjectAPIView(views.APIView):
             data = JSONParser().parse(request)
             serializer = self.post_serializer_class(data=data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
+                obj = serializer.save()
+                refresh_search("subject", [obj.curriculum.abbreviation.lower()])
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -114,13 +175,22 @@ class CollegeAPIView(views.APIView):
             serializer = self.get_serializer_class(data=data)
             if serializer.is_valid(raise_exception=True):
                 query = serializer.validated_data.get('query')
-                results = college_search.search(query)
-                serializer.save()
+                results = search_cache.search("college", engine_manager.get_engine("college"), query,
+                                              **serializer.get_search_options())
+                query_log.log(serializer.get_query_fields(), dataset="college")
                 return Response(results, status=status.HTTP_200_OK)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except JSONDecodeError:
             return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
+        except EngineWarmingUp as error:
+            return warming_up_response(error)
+        except EngineUnavailable as error:
+            return unavailable_response(error)
+        except IndexNotBuilt as error:
+            return not_built_response(error)
+        except SearchDeadlineExceeded as error:
+            return deadline_response(error)
         
 
     def post(self, request):
@@ -128,7 +198,8 @@ class CollegeAPIView(views.APIView):
             data = JSONParser().parse(request)
             serializer = self.post_serializer_class(data=data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
+                obj = serializer.save()
+                refresh_search("college", ["college"])
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -152,13 +223,22 @@ class MajorAPIView(views.APIView):
                 serializer = self.get_serializer_class(data=data)
                 if serializer.is_valid(raise_exception=True):
                     query = serializer.validated_data.get('query')
-                    results = major_search.search(query)
-                    serializer.save()
+                    results = search_cache.search("major", engine_manager.get_engine("major"), query,
+                                                  **serializer.get_search_options())
+                    query_log.log(serializer.get_query_fields(), dataset="major")
                     return Response(results, status=status.HTTP_200_OK)
                 else:
                     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             except JSONDecodeError:
                 return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
+            except EngineWarmingUp as error:
+                return warming_up_response(error)
+            except EngineUnavailable as error:
+                return unavailable_response(error)
+            except IndexNotBuilt as error:
+                return not_built_response(error)
+            except SearchDeadlineExceeded as error:
+                return deadline_response(error)
 
 
     def post(self, request):
@@ -166,7 +246,8 @@ class MajorAPIView(views.APIView):
             data = JSONParser().parse(request)
             serializer = self.post_serializer_class(data=data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
+                obj = serializer.save()
+                refresh_search("major", ["major"])
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -175,6 +256,317 @@ class MajorAPIView(views.APIView):
             return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
 
 
+class SearchBatchAPIView(views.APIView):
+    dataset = None
+    serializer_class = None
+    subject = False
+
+    """
+    Searches a list of queries of one dataset in one request, for the profile import jobs.
+    The body is {"items": [{"query": ..., "curriculum": ...}, ...]}, with the optional "limit", "candidates"
+    and "stream". The results of the items come back in the input order. With "stream": true they are sent
+    as NDJSON lines {"index": ..., "results": [...]}, as soon as each chunk of items is searched.
+    Batches do not go through the result cache, import jobs rarely repeat their queries.
+    """
+
+    def filter_dict(self, item: dict):
+        return None
+
+    def post(self, request):
+        try:
+            data = JSONParser().parse(request)
+            serializer = self.serializer_class(data=data)
+            # Not raised, the JSON:API exception handler can not format the errors of nested items
+            if serializer.is_valid():
+                engine = engine_manager.get_engine(self.dataset)
+                items = serializer.validated_data.get('items')
+                batch = [(item['query'], self.filter_dict(item)) for item in items]
+                options = serializer.get_search_options()
+
+                # Checked before the response starts, a streamed response can no longer change its status
+                for index, (_, filter_dict) in enumerate(batch):
+                    try:
+                        engine.select_partition(filter_dict)
+                    except KeyError:
+                        return JsonResponse({"result": "error", "errors": {"items": {
+                            str(index): {"curriculum": ["There is no {} curriculum {}".format(
+                                self.dataset, items[index]['curriculum'])]}}}}, status=400)
+                self.log_queries(items)
+
+                if serializer.validated_data.get('stream'):
+                    return StreamingHttpResponse(self.stream_results(engine, batch, options),
+                                                 content_type="application/x-ndjson")
+
+                results = engine.search_batch(batch, subject=self.subject, **options)
+                return Response(results, status=status.HTTP_200_OK)
+            else:
+                return JsonResponse({"result": "error", "errors": serializer.errors}, status=400)
+        except JSONDecodeError:
+            return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
+        except EngineWarmingUp as error:
+            return warming_up_response(error)
+        except EngineUnavailable as error:
+            return unavailable_response(error)
+        except IndexNotBuilt as error:
+            return not_built_response(error)
+
+    def stream_results(self, engine, batch: list, options: dict):
+        results = engine.iter_search_batch(batch, subject=self.subject,
+                                           chunk_size=settings.SEARCH_BATCH['STREAM_CHUNK_SIZE'], **options)
+        for index, item_results in enumerate(results):
+            yield json.dumps({"index": index, "results": item_results}) + "\n"
+
+    def log_queries(self, items: list) -> None:
+        # The items are logged like single searches, through the query log buffer
+        query_log.log_many([
+            {field: value for field, value in item.items() if field not in SearchOptionsMixin.option_fields}
+            for item in items
+            ], dataset=self.dataset)
+
+
+class SchoolBatchAPIView(SearchBatchAPIView):
+    dataset = "school"
+    serializer_class = SchoolBatchSerializer
+
+    def filter_dict(self, item: dict):
+        return {'curriculum__abbreviation': item['curriculum'].upper()}
+
+
+class SubjectBatchAPIView(SearchBatchAPIView):
+    dataset = "subject"
+    serializer_class = SubjectBatchSerializer
+    subject = True
+
+    def filter_dict(self, item: dict):
+        return subject_filter_dict(item)
+
+
+class CollegeBatchAPIView(SearchBatchAPIView):
+    dataset = "college"
+    serializer_class = CollegeBatchSerializer
+
+
+class MajorBatchAPIView(SearchBatchAPIView):
+    dataset = "major"
+    serializer_class = MajorBatchSerializer
+
+
+# The surrogates that stand for the bytes of a bulk ingestion body that are not UTF-8
+UNDECODED_BYTES = re.compile("[\udc80-\udcff]")
+
+
+class BulkIngestAPIView(views.APIView):
+    dataset = None
+    model = None
+    row_serializer_class = None
+    # (field, related model, slug field) of the relation that is resolved for every chunk, if any
+    relation = None
+    # The datasets split by curriculum have one embeddings partition per curriculum, the others a single one
+    partitioned = False
+
+    """
+    Adds many rows of one dataset in one request, for loading a new board or a new list of colleges.
+    The body is CSV with a header row (Content-Type: text/csv) or one JSON object per line (application/x-ndjson).
+    The rows are read and validated one at a time, and the valid ones are written with bulk_create in chunks,
+    resolving the curriculum or category of a whole chunk with one query. Each chunk is written in a transaction,
+    a row that breaks a database constraint is rejected alone. A row with bytes that are not UTF-8 is rejected too,
+    and the rows after it are still read. The response reports the number of rows created and the errors
+    of every rejected row, by its number (starting at 1, without the CSV header).
+    Once the rows are written, the search engine of the dataset is reloaded, so the abbreviation search finds them.
+    Their embeddings are not encoded here: the partitions they were added to are recorded as pending, and
+    "build_search_index --pending" builds them offline. The engines of every worker reload once the new versions
+    of the embedding files appear, see EngineManager.watch(). The response lists those partitions, with "index": "pending".
+    """
+
+    def post(self, request):
+        content_type = request.content_type.split(";")[0].strip()
+        if content_type not in ("text/csv", "application/x-ndjson"):
+            return JsonResponse({"result": "error", "message": "The body must be text/csv or application/x-ndjson"}, status=415)
+
+        # The body is read line by line, the DRF parsers are not used.
+        # Bytes that are not UTF-8 are kept as surrogates, so only the row they are in is rejected
+        lines = codecs.iterdecode(request.stream or [], "utf-8", errors="surrogateescape")
+        report = {"rows": 0, "created": 0, "error_count": 0, "errors": [], "partitions": set()}
+        try:
+            rows = self.read_csv(lines) if content_type == "text/csv" else self.read_ndjson(lines)
+            self.ingest(rows, report)
+        except ValueError as error:
+            return JsonResponse({"result": "error", "message": str(error)}, status=400)
+        finally:
+            # The chunks written before an error are committed, they are searched and encoded all the same
+            report["partitions"] = sorted(report["partitions"])
+            if report["created"]:
+                self.refresh_search(report)
+
+        report["result"] = "ok" if not report["error_count"] else "partial"
+        if not report["created"] and report["error_count"]:
+            report["result"] = "error"
+            return JsonResponse(report, status=400)
+        return JsonResponse(report, status=201)
+
+    def read_csv(self, lines):
+        reader = csv.DictReader(lines)
+        fields = self.required_fields()
+        missing = [field for field in fields if field not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError("The CSV header is missing the columns: {}".format(", ".join(missing)))
+
+        for row, record in enumerate(reader, start=1):
+            yield row, {field: record[field] for field in fields}
+
+    def read_ndjson(self, lines):
+        row = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                record = json.loads(line)
+            except JSONDecodeError:
+                yield row, None
+                continue
+            yield row, record if isinstance(record, dict) else None
+
+    def required_fields(self) -> list:
+        serializer = self.row_serializer_class()
+        return [name for name, field in serializer.fields.items() if not field.read_only]
+
+    def refresh_search(self, report: dict) -> None:
+        refresh_search(self.dataset, report["partitions"])
+        report["index"] = "pending"
+
+    def ingest(self, rows, report: dict) -> dict:
+        chunk_size = settings.SEARCH_BULK_INGEST['CHUNK_SIZE']
+
+        chunk = []
+        for row, record in rows:
+            report["rows"] += 1
+            if record is None:
+                self.add_error(report, row, {"non_field_errors": ["The line is not a JSON object"]})
+                continue
+            if any(isinstance(value, str) and UNDECODED_BYTES.search(value) for value in record.values()):
+                self.add_error(report, row, {"non_field_errors": ["The row is not valid UTF-8"]})
+                continue
+
+            serializer = self.row_serializer_class(data=record)
+            if not serializer.is_valid():
+                self.add_error(report, row, serializer.errors)
+                continue
+
+            chunk.append((row, serializer.validated_data))
+            if len(chunk) >= chunk_size:
+                self.write_chunk(chunk, report)
+                chunk = []
+
+        if chunk:
+            self.write_chunk(chunk, report)
+
+        if not report["rows"]:
+            raise ValueError("The body has no rows")
+
+        # Rows rejected when their chunk was written are reported after the rows rejected by validation
+        report["errors"].sort(key=lambda error: error["row"])
+        return report
+
+    def add_error(self, report: dict, row: int, errors: dict) -> None:
+        report["error_count"] += 1
+        if len(report["errors"]) < settings.SEARCH_BULK_INGEST['MAX_ERRORS']:
+            report["errors"].append({"row": row, "errors": errors})
+
+    def write_chunk(self, chunk: list, report: dict) -> None:
+        if self.relation:
+            field, related_model, slug_field = self.relation
+            values = {data[field] for _, data in chunk}
+            related = {getattr(obj, slug_field): obj
+                       for obj in related_model.objects.filter(**{slug_field + "__in": values})}
+
+        objects = []
+        for row, data in chunk:
+            data = dict(data)
+            if self.relation:
+                obj = related.get(data[field])
+                if obj is None:
+                    self.add_error(report, row, {field: ["Object with {}={} does not exist.".format(slug_field, data[field])]})
+                    continue
+                data[field] = obj
+            objects.append((row, self.model(**data)))
+
+        objects = self.drop_duplicates(objects, report)
+        try:
+            with transaction.atomic():
+                self.model.objects.bulk_create([obj for _, obj in objects])
+        except IntegrityError:
+            # The chunk was rolled back, its rows are written one at a time to reject only the ones at fault
+            objects = self.write_rows(objects, report)
+        report["created"] += len(objects)
+        report["partitions"].update(self.partition_of(obj) for _, obj in objects)
+
+    def write_rows(self, objects: list, report: dict) -> list:
+        written = []
+        for row, obj in objects:
+            try:
+                with transaction.atomic():
+                    self.model.objects.bulk_create([obj])
+            except IntegrityError as error:
+                self.add_error(report, row, {"non_field_errors": [str(error)]})
+                continue
+            written.append((row, obj))
+        return written
+
+    def partition_of(self, obj) -> str:
+        # The option of the embeddings file the row is encoded into, see CheckPickleExists.file_name_generator()
+        if self.partitioned:
+            return obj.curriculum.abbreviation.lower()
+        return self.dataset
+
+    def drop_duplicates(self, objects: list, report: dict) -> list:
+        return objects
+
+
+class SchoolBulkIngestAPIView(BulkIngestAPIView):
+    dataset = "school"
+    model = School
+    row_serializer_class = SchoolRowSerializer
+    relation = ("curriculum", Curriculum, "abbreviation")
+    partitioned = True
+
+
+class SubjectBulkIngestAPIView(BulkIngestAPIView):
+    dataset = "subject"
+    model = Subject
+    row_serializer_class = SubjectRowSerializer
+    relation = ("curriculum", Curriculum, "abbreviation")
+    partitioned = True
+
+    def drop_duplicates(self, objects: list, report: dict) -> list:
+        # Subjects are unique by name, curriculum and education level, in the database and within the upload
+        names = {obj.name for _, obj in objects}
+        existing = set(Subject.objects.filter(name__in=names).values_list('name', 'curriculum_id', 'education_level'))
+
+        unique = []
+        for row, obj in objects:
+            key = (obj.name, obj.curriculum_id, obj.education_level)
+            if key in existing:
+                self.add_error(report, row, {"non_field_errors": ["The fields name, curriculum, education_level must make a unique set."]})
+                continue
+            existing.add(key)
+            unique.append((row, obj))
+        return unique
+
+
+class CollegeBulkIngestAPIView(BulkIngestAPIView):
+    dataset = "college"
+    model = College
+    row_serializer_class = CollegeRowSerializer
+
+
+class MajorBulkIngestAPIView(BulkIngestAPIView):
+    dataset = "major"
+    model = Major
+    row_serializer_class = MajorRowSerializer
+    relation = ("category", MajorCategory, "name")
+
+
 class SaveMajorCategoryAPIView(views.APIView):
     def __init__(self):
         self.serializer_class = MajorCategorySerializer
@@ -218,3 +610,29 @@ class SaveCurriculumAPIView(views.APIView):
             print(serializer.errors)
             return JsonResponse({"result": "error","message": "Json decoding error"}, status= 400)
 
+
+class ReadinessAPIView(views.APIView):
+
+    """
+    Reports the state of the search engine of each dataset.
+    Returns 200 once every engine is ready, and 503 while any of them is still warming up or has failed.
+    An engine serving only the partitions whose embeddings are built is ready, it lists the others in missing_partitions.
+    """
+
+    def get(self, request):
+        ready = engine_manager.is_ready()
+        return JsonResponse(
+            {"ready": ready, "datasets": engine_manager.status()},
+            status=200 if ready else 503
+            )
+
+
+class MetricsAPIView(views.APIView):
+
+    """
+    The search metrics in the Prometheus text format: the time of each search and of each of its stages
+    per dataset and route, the candidates of the last search, and the hits of the result and query embedding caches.
+    """
+
+    def get(self, request):
+        return HttpResponse(search_metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -5,3 +5,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'search_api.settings')
 
 application = get_asgi_application()
+
+# Build the search engines on a background thread, so the process can serve requests while they load
+from django.conf import settings
+from core.engines import engine_manager
+
+engine_manager.warm_up(settings.SEARCH_ENGINE_WARMUP)
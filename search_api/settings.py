@@ -84,6 +84,27 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# The 'search' cache holds the search results, point it at a shared backend to share it between workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': os.environ.get("SEARCH_CACHE_BACKEND", default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get("SEARCH_CACHE_LOCATION", default='search-results'),
+        'TIMEOUT': int(os.environ.get("SEARCH_CACHE_TIMEOUT", default=300)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", default=10000)),
+        },
+    },
+}
+
+SEARCH_RESULT_CACHE_ALIAS = 'search'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -126,6 +147,96 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# "background" builds every search engine on a thread when the web process starts,
+# "lazy" builds each engine when its first request arrives. See core/engines.py
+SEARCH_ENGINE_WARMUP = os.environ.get("SEARCH_ENGINE_WARMUP", default="background")
+
+# A search engine that failed to load is built again after SECONDS, doubled after each failure up to MAX_SECONDS.
+# Its requests get a 503 "unavailable" response with the error meanwhile. See core/engines.py
+SEARCH_ENGINE_RETRY = {
+    'SECONDS': float(os.environ.get("SEARCH_ENGINE_RETRY_SECONDS", default=60)),
+    'MAX_SECONDS': float(os.environ.get("SEARCH_ENGINE_RETRY_MAX_SECONDS", default=3600)),
+}
+
+
+# Approximate nearest neighbour index for the embedding search, see services/src/ann_index.py.
+# N_PROBE trades recall for speed, partitions smaller than MIN_ROWS always use exact search.
+SEARCH_ANN_INDEX = {
+    'ENABLED': int(os.environ.get("SEARCH_ANN_ENABLED", default=0)),
+    'N_PROBE': int(os.environ.get("SEARCH_ANN_N_PROBE", default=8)),
+    'MIN_ROWS': int(os.environ.get("SEARCH_ANN_MIN_ROWS", default=20000)),
+}
+
+
+# Batched encoding of the embeddings, see services/src/train_model.py.
+# Partitions with at least POOL_MIN_ROWS rows are encoded by PROCESSES worker processes when PROCESSES > 1.
+SEARCH_TRAIN_OPTIONS = {
+    'BATCH_SIZE': int(os.environ.get("SEARCH_ENCODE_BATCH_SIZE", default=64)),
+    'PROCESSES': int(os.environ.get("SEARCH_ENCODE_PROCESSES", default=0)),
+    'POOL_MIN_ROWS': int(os.environ.get("SEARCH_ENCODE_POOL_MIN_ROWS", default=50000)),
+}
+
+
+# The embeddings and ANN indexes are built offline with "python manage.py build_search_index".
+# The web process only loads them, unless BUILD_ON_LOAD is set. WORKERS is the number of partitions the command builds at once.
+# Every WATCH_SECONDS each web process reloads the engines whose embeddings have a new version, 0 disables it.
+# Rows added through the API are recorded as pending, "build_search_index --pending" (from cron or a worker) builds them.
+SEARCH_INDEX = {
+    'BUILD_ON_LOAD': int(os.environ.get("SEARCH_INDEX_BUILD_ON_LOAD", default=0)),
+    'WORKERS': int(os.environ.get("SEARCH_INDEX_WORKERS", default=4)),
+    'WATCH_SECONDS': float(os.environ.get("SEARCH_INDEX_WATCH_SECONDS", default=30)),
+}
+
+
+# Number of query embeddings kept in the per process LRU cache, 0 disables it
+SEARCH_QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("SEARCH_QUERY_EMBEDDING_CACHE_SIZE", default=4096))
+
+
+# Mixed queries run abbreviation and fuzzy search concurrently, see services/src/matcher_pool.py.
+# WORKERS bounds the matcher threads of the process, DEADLINE is the number of seconds each matcher gets once it starts.
+SEARCH_HYBRID = {
+    'WORKERS': int(os.environ.get("SEARCH_HYBRID_WORKERS", default=4)),
+    'DEADLINE': float(os.environ.get("SEARCH_HYBRID_DEADLINE", default=5.0)),
+}
+
+
+# Batch search endpoints: the largest number of items of a batch, and the number of items
+# that are encoded and scored together when the results are streamed as NDJSON.
+SEARCH_BATCH = {
+    'MAX_ITEMS': int(os.environ.get("SEARCH_BATCH_MAX_ITEMS", default=5000)),
+    'STREAM_CHUNK_SIZE': int(os.environ.get("SEARCH_BATCH_STREAM_CHUNK_SIZE", default=256)),
+}
+
+
+# Logging of the searches into SearchQuery, see core/query_log.py. The rows are queued in memory (at most MAX_QUEUE,
+# the rest are dropped and counted) and written in batches of BATCH_SIZE, or FLUSH_INTERVAL seconds after the first one.
+SEARCH_QUERY_LOG = {
+    'MAX_QUEUE': int(os.environ.get("SEARCH_QUERY_LOG_MAX_QUEUE", default=10000)),
+    'BATCH_SIZE': int(os.environ.get("SEARCH_QUERY_LOG_BATCH_SIZE", default=500)),
+    'FLUSH_INTERVAL': float(os.environ.get("SEARCH_QUERY_LOG_FLUSH_INTERVAL", default=1.0)),
+}
+
+
+# Per-stage search metrics, served in the Prometheus text format on /metrics.
+SEARCH_METRICS_ENABLED = int(os.environ.get("SEARCH_METRICS_ENABLED", default=1))
+
+
+# Bulk ingestion endpoints: the number of rows that are resolved and inserted together,
+# and the largest number of row errors listed in the report (the others are only counted).
+SEARCH_BULK_INGEST = {
+    'CHUNK_SIZE': int(os.environ.get("SEARCH_BULK_INGEST_CHUNK_SIZE", default=500)),
+    'MAX_ERRORS': int(os.environ.get("SEARCH_BULK_INGEST_MAX_ERRORS", default=1000)),
+}
+
+
+# Under an ASGI server, ENABLED routes the search endpoints to the async views of core/async_views.py.
+# WORKERS is the number of threads that run the searches of those views.
+SEARCH_ASYNC_VIEWS = {
+    'ENABLED': int(os.environ.get("SEARCH_ASYNC_VIEWS", default=0)),
+    'WORKERS': int(os.environ.get("SEARCH_ASYNC_WORKERS", default=4)),
+}
+
+
 REST_FRAMEWORK = {
     'EXCEPTION_HANDLER': 'rest_framework_json_api.exceptions.exception_handler',
     'DEFAULT_PARSER_CLASSES': (
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib import admin
 from core import views as core_views
@@ -8,12 +9,39 @@ router = routers.DefaultRouter()
 
 urlpatterns = router.urls
 
+if settings.SEARCH_ASYNC_VIEWS['ENABLED']:
+    # Async search views for ASGI servers, see core/async_views.py
+    from core import async_views
+    search_views = {
+        'school': async_views.AsyncSchoolSearchView.as_view(),
+        'subject': async_views.AsyncSubjectSearchView.as_view(),
+        'college': async_views.AsyncCollegeSearchView.as_view(),
+        'major': async_views.AsyncMajorSearchView.as_view(),
+    }
+else:
+    search_views = {
+        'school': core_views.SchoolAPIView.as_view(),
+        'subject': core_views.SubjectAPIView.as_view(),
+        'college': core_views.CollegeAPIView.as_view(),
+        'major': core_views.MajorAPIView.as_view(),
+    }
+
 urlpatterns += [
     path('admin/', admin.site.urls),
-    path('profile/school', core_views.SchoolAPIView.as_view()),
-    path('profile/school/subject', core_views.SubjectAPIView.as_view()),
-    path('profile/college', core_views.CollegeAPIView.as_view()),
-    path('profile/college/major', core_views.MajorAPIView.as_view()),
+    path('profile/school', search_views['school']),
+    path('profile/school/subject', search_views['subject']),
+    path('profile/college', search_views['college']),
+    path('profile/college/major', search_views['major']),
+    path('profile/school/batch', core_views.SchoolBatchAPIView.as_view()),
+    path('profile/school/subject/batch', core_views.SubjectBatchAPIView.as_view()),
+    path('profile/college/batch', core_views.CollegeBatchAPIView.as_view()),
+    path('profile/college/major/batch', core_views.MajorBatchAPIView.as_view()),
+    path('profile/school/bulk', core_views.SchoolBulkIngestAPIView.as_view()),
+    path('profile/school/subject/bulk', core_views.SubjectBulkIngestAPIView.as_view()),
+    path('profile/college/bulk', core_views.CollegeBulkIngestAPIView.as_view()),
+    path('profile/college/major/bulk', core_views.MajorBulkIngestAPIView.as_view()),
     path('profile/save/curriculum', core_views.SaveCurriculumAPIView.as_view()),
     path('profile/save/majorcategory', core_views.SaveMajorCategoryAPIView.as_view()),
+    path('profile/ready', core_views.ReadinessAPIView.as_view()),
+    path('metrics', core_views.MetricsAPIView.as_view()),
 ]
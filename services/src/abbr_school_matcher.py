@@ -1,24 +1,41 @@
-import pandas as pd
+import functools
+import heapq
 import regex as re
 import jaro
+from .address_index import AddressIndex
+from .search_metrics import candidate_count
+from .matcher_pool import check_deadline
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern: str, flags: int = 0):
+    # Queries repeat, so their patterns are compiled once and reused
+    return re.compile(pattern, flags)
 
 
 class AbbrSchoolMatcher:
 
     """
-    This function takes in an abbreviation (query) and returns a list of schools that match the abbreviation.
+    This function takes in an abbreviation (query) and a CorpusPartition,
+    and returns a list of schools of the partition that match the abbreviation.
     It first goes through the school names to find the ones that match the school-name part of the string.
     This returns the selected school names and their addresses.
     Then it goes through the school addresses in the selected school to find the ones that match the
     address part of the string.
+    Only the top 'limit' results are kept, in bounded heaps, instead of sorting the whole list after every match.
+    Ties keep the order in which the schools were found, like a stable sort.
+    The addresses are matched with a fuzzy regex, the partition's AddressIndex skips the rows it can not match.
+    The loops call check_deadline() every few hundred rows, so a search that missed its deadline stops.
     """
     def __init__(self):
         self.common_words_set = {'sec', 'st', 'sr', 'the', 'of', 'new', 'no'}
+        self.metrics_dataset = getattr(self, "dataset", None)
 
 
     def abbreviation_search(self,
                             query: str,
-                            df: pd.DataFrame) -> list:
+                            partition,
+                            limit: int = 10) -> list:
         
         selected = []
         query = query.strip().lower().split(" ")
@@ -57,6 +74,7 @@ class AbbrSchoolMatcher:
             # Flatten the list of letters
             list_of_letters = [letter for sublist in list_of_letters for letter in sublist]
             pattern = r"^(\b" + r"[a-z]*\s+".join(list_of_letters) + r"[a-z]*\b)"
+            anchored = True
             query = "".join(list_of_letters) + " " + " ".join(full_words)
         else:
             
@@ -65,6 +83,8 @@ class AbbrSchoolMatcher:
             place = ""
             query = query[0]
             pattern = r"\b" + r"[a-z]*\s+".join(query) + r"[a-z]*\b"
+            list_of_letters = list(query)
+            anchored = False
         
         # If place is equal to full_words, it means that place variable is not required,
         # so we can just use the full_words variable
@@ -74,11 +94,22 @@ class AbbrSchoolMatcher:
         """
         First we loop through the school names to find the ones that match the name regex,
         then we loop through the selected schools addresses to find the ones that match the address regex.
-        Below, we loop over the school names in the dataset to check if the name matches the regex
+        The partition's acronym index gives the rows whose word initials can match the letters,
+        so the regex only runs on those candidates. When the letters can not be looked up, every row is scanned.
+        Below, we loop over the candidate school names to check if the name matches the regex
         """
-        if "address" in df.columns:
-            for school in zip(df["name"], df["address"]):
-                for match in re.finditer(pattern, school[0].strip().lower()):
+        rows = partition.acronym_index.candidates(list_of_letters, anchored=anchored)
+        if rows is None:
+            rows = range(len(partition))
+        candidate_count.set(len(rows), self.metrics_dataset, "abbreviation")
+        name_pattern = compile_pattern(pattern)
+
+        if partition.has_address:
+            for position, row in enumerate(rows):
+                if not position % 256:
+                    check_deadline()
+                school = (partition.names[row], partition.addresses[row])
+                for match in name_pattern.finditer(partition.search_names[row]):
                     full_name = match.group(0).strip()
                     split_name = full_name.split(" ")
 
@@ -97,12 +128,19 @@ class AbbrSchoolMatcher:
                     # We compare the abbreviation with the query using jaro-winkler metric
                     # and then append the school name, address and score to the selected_school list
                     score = jaro.jaro_winkler_metric(query, full_name_abbr.strip().lower()) * 100
-                    selected.append((school[0].title(), school[1].title(), round(score, 4)))
-                    selected.sort(key=lambda x: x[2], reverse=True)
+                    score = round(score, 4)
+
+                    # The heap pops the best name score first, and the earliest match among equal scores
+                    heapq.heappush(selected, (-score, len(selected), row, (school[0].title(), school[1].title(), score)))
 
         else:
-            for school in df["name"]:
-                for match in re.finditer(pattern, school.strip().lower()):
+            # Min-heap of the best 'limit' matches, the weakest (lowest score, latest found) on top
+            order = 0
+            for position, row in enumerate(rows):
+                if not position % 256:
+                    check_deadline()
+                school = partition.names[row]
+                for match in name_pattern.finditer(partition.search_names[row]):
                     full_name = match.group(0).strip()
                     split_name = full_name.split(" ")
 
@@ -113,11 +151,20 @@ class AbbrSchoolMatcher:
                         full_name_abbr = full_name
 
                     score = jaro.jaro_winkler_metric(query, full_name_abbr.strip().lower()) * 100
-                    selected.append((school.title(), round(score, 4)))
-                    selected.sort(key=lambda x: x[1], reverse=True)
-            
-            # Since we are not using the address, we can return the top 10 results from here only
-            return selected[:10]
+                    entry = (round(score, 4), -order, (school.title(), round(score, 4)))
+                    order += 1
+
+                    if len(selected) < limit:
+                        heapq.heappush(selected, entry)
+                    elif entry[:2] > selected[0][:2]:
+                        heapq.heapreplace(selected, entry)
+
+                # A later school can not beat a full set of perfect scores, ties go to the earlier ones
+                if len(selected) == limit and selected[0][0] >= 100:
+                    break
+
+            # Since we are not using the address, we can return the top results from here only
+            return [entry[2] for entry in sorted(selected, reverse=True)]
 
         """
         School names have been selected, now we need to select the top addresses.
@@ -130,17 +177,41 @@ class AbbrSchoolMatcher:
         elif full_words:
             pattern = r"(\b" + r"[a-z]*\s+".join(full_words) + r"[a-z]*\b){e<=2}"
 
-        final_list = []
+        # Single word queries have no place or full words, they keep matching the name pattern against the address
+        address_pattern = compile_pattern(pattern, re.IGNORECASE)
+        address_matches = lambda row, address: address_pattern.search(address.strip().lower()) is not None
 
-        # Loop over the schools in the selected_schools list to check if the address matches the regex
+        # The letters and digits of the place and full words let the AddressIndex skip the rows the regex can not match
+        pieces = [char for char in place if not char.isspace()] + full_words
+        if pieces and AddressIndex.supports(pieces):
+            bits = partition.address_index.pattern_bits(pieces)
+            regex_matches = address_matches
+            address_matches = lambda row, address: partition.address_index.may_match(row, bits) and regex_matches(row, address)
+
+        final_list = []
+        ranked = []
+        order = 0
 
-        for school in selected:
+        """
+        Loop over the selected schools from the best name score down, to check if the address matches.
+        final_list is a min-heap of the best 'limit' schools by name score and then address score.
+        Once it is full, a school with a lower name score than its weakest entry can not get in,
+        and neither can any school after it, so the loop stops there.
+        """
+        while selected:
+            if not len(ranked) % 256:
+                check_deadline()
+            _, _, row, school = heapq.heappop(selected)
             name = school[0]
             address = school[1]
             score_name = school[2]
 
+            if len(final_list) == limit and score_name < final_list[0][0]:
+                break
+            ranked.append(school)
+
             # Check if the address matches the regex
-            if re.search(pattern, address.strip().lower(), re.IGNORECASE):
+            if address_matches(row, address):
                 full_address = address.strip().lower()
                 split_address = full_address.split(" ")
 
@@ -164,17 +235,23 @@ class AbbrSchoolMatcher:
                 if input_address in address.strip().lower() or input_address in full_address_abbr.strip().lower():
                     score_address += 5
 
-                final_list.append((name, address, round(score_name, 4), round(score_address, 4)))
+                entry = (round(score_name, 4), round(score_address, 4), -order,
+                         (school[0], school[1], round(score_name, 4), round(score_address, 4)))
+                order += 1
 
-                # Sort the final_list by name score and then address score in descending order
-                final_list.sort(key=lambda x: (x[2], x[3]), reverse=True)
+                # Keep the top schools by name score and then address score
+                if len(final_list) < limit:
+                    heapq.heappush(final_list, entry)
+                elif entry[:3] > final_list[0][:3]:
+                    heapq.heapreplace(final_list, entry)
 
-        # If the final_list is empty, it means that no address matched the regex, so return the top 10 school matches
+        # If the final_list is empty, it means that no address matched the regex, so return the top school matches.
+        # The loop can only stop early with a full final_list, so every selected school is in ranked here
         if final_list == []:
-            return selected[:10]
+            return ranked[:limit]
 
-        # If the final_list is not empty, return the top 10 from the final_list
-        top_ten = final_list[:10]
+        # If the final_list is not empty, return it from the best to the weakest
+        top_ten = [entry[3] for entry in sorted(final_list, reverse=True)]
 
         # Append the mean score of name and address to the top_ten list
         top_ten = [(school[0].title(), school[1].title(), round((school[2] + school[3]) / 2, 4)) for school in top_ten]
@@ -0,0 +1,79 @@
+from collections import defaultdict
+import numpy as np
+import regex as re
+
+
+class AcronymIndex:
+
+    """
+    Index of the word initials of every name in a partition, built once at load time.
+    The abbreviation search matches the query letters against the initials of consecutive words
+    of a name. Instead of running that regex over every name, the index maps each sequence of
+    initials (up to max_letters long) to the rows of the names containing it, so the candidates
+    of a query are found with one dictionary lookup. The regex is then only run on the candidates.
+
+    The candidates are a superset of the names the regex can match, so the results do not change:
+    - the first letter can start any word, or follow a non-word character inside it ("x-delhi")
+    - every following letter must start the next whitespace separated word
+    - queries longer than max_letters are looked up by their first max_letters letters
+    The "prefix" postings only hold sequences starting at the first word, for the anchored pattern.
+    """
+
+    whitespace = re.compile(r"\s+")
+    boundary_letter = re.compile(r"\b[a-z]")
+
+    def __init__(self, search_names: list, max_letters: int = 4):
+        self.max_letters = max_letters
+        self.size = len(search_names)
+
+        postings = defaultdict(list)
+        prefix_postings = defaultdict(list)
+
+        for row, name in enumerate(search_names):
+            words = self.whitespace.split(name)
+            initials = [word[:1] for word in words]
+
+            for position, word in enumerate(words):
+                starts = set(self.boundary_letter.findall(word))
+                if not starts:
+                    continue
+
+                # Initials of the following words, as long as they can continue a match
+                following = ""
+                for initial in initials[position + 1:position + max_letters]:
+                    if not "a" <= initial <= "z":
+                        break
+                    following += initial
+
+                for start in starts:
+                    key = start
+                    postings[key].append(row)
+                    for initial in following:
+                        key += initial
+                        postings[key].append(row)
+
+                    if position == 0 and start == word[0]:
+                        key = start
+                        prefix_postings[key].append(row)
+                        for initial in following:
+                            key += initial
+                            prefix_postings[key].append(row)
+
+        # Sorted, de-duplicated int32 rows keep the original row order and take little memory
+        self.postings = {key: np.unique(np.array(rows, dtype=np.int32)) for key, rows in postings.items()}
+        self.prefix_postings = {key: np.unique(np.array(rows, dtype=np.int32)) for key, rows in prefix_postings.items()}
+
+
+    def candidates(self, letters: list, anchored: bool = False):
+
+        """
+        Return the sorted rows whose names may match the letters, or None when the letters
+        can not be looked up (empty, or not all a-z), in which case every row is a candidate.
+        """
+
+        if not letters or not all("a" <= letter <= "z" for letter in letters):
+            return None
+
+        key = "".join(letters[:self.max_letters])
+        postings = self.prefix_postings if anchored else self.postings
+        return postings.get(key, np.empty(0, dtype=np.int32))
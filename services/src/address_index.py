@@ -0,0 +1,74 @@
+import functools
+import regex as re
+
+
+# The bit of each character the address patterns are made of
+CHARACTER_BITS = {char: 1 << position for position, char in enumerate("abcdefghijklmnopqrstuvwxyz0123456789")}
+
+
+@functools.lru_cache(maxsize=4096)
+def character_bits(char: str) -> int:
+    # The bits of the pattern characters that match the character, ignoring case the way the address regex does
+    bits = CHARACTER_BITS.get(char, 0)
+    if not bits and not char.isascii():
+        for pattern_char, bit in CHARACTER_BITS.items():
+            if re.fullmatch(pattern_char, char, re.IGNORECASE):
+                bits |= bit
+    return bits
+
+
+class AddressIndex:
+
+    """
+    Index of the characters of every address in a partition, built once at load time.
+    The address phase of the abbreviation search matches the selected schools with a fuzzy regex
+    ({e<=2}) of the letters of the place and the full words of the query. The regex decides the ranking,
+    so the index does not replace it, it only skips the rows the regex can not match.
+
+    Every character of the pattern is matched as it is, substituted or deleted, and at most max_edits of them
+    are edited. So an address the regex matches holds all the characters of the pattern but max_edits at most.
+    The characters of each address are kept as a bit mask, and a row missing more than max_edits
+    of the characters of the pattern is rejected without running the regex.
+    """
+
+    token_pattern = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, addresses: list, max_edits: int = 2):
+        self.max_edits = max_edits
+        self.masks = [self.character_mask(address) for address in addresses]
+
+
+    @staticmethod
+    def character_mask(address: str) -> int:
+        mask = 0
+        for char in set(address.strip().lower()):
+            mask |= character_bits(char)
+        return mask
+
+
+    @classmethod
+    def supports(cls, pieces: list) -> bool:
+        # Pieces with other characters than letters and digits are only matched by the regex
+        return all(cls.token_pattern.fullmatch(piece) for piece in pieces)
+
+
+    def pattern_bits(self, pieces: list) -> list:
+        # The bit of every character of the pieces, a character repeated in the pattern is counted every time
+        return [CHARACTER_BITS[char] for piece in pieces for char in piece]
+
+
+    def may_match(self, row: int, bits: list) -> bool:
+
+        """
+        False when the address of the row misses more than max_edits of the characters of the pattern,
+        so the regex can not match it. True does not mean it matches, the regex still has to be run.
+        """
+
+        mask = self.masks[row]
+        missing = 0
+        for bit in bits:
+            if not mask & bit:
+                missing += 1
+                if missing > self.max_edits:
+                    return False
+        return True
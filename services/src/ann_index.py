@@ -0,0 +1,223 @@
+import hashlib
+import os
+import sys
+import time
+import numpy as np
+from .embedding_store import EmbeddingStore
+
+
+class IVFIndex:
+
+    """
+    An inverted file (IVF) index for approximate nearest neighbour search over a normalized embedding matrix.
+    The rows are clustered around n_lists centroids with spherical k-means. A query is only scored against
+    the rows of its n_probe closest centroids, instead of every row of the partition.
+    n_probe is the recall/speed knob: a bigger n_probe scores more rows and finds more of the exact top k.
+    The index only holds the centroids and the row ids of each list, the embeddings stay in the matrix.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray, fingerprint: str):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.fingerprint = fingerprint
+
+
+    @staticmethod
+    def fingerprint_keys(keys: list) -> str:
+        return hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()
+
+
+    @classmethod
+    def build(cls,
+              keys: list,
+              matrix: np.ndarray,
+              n_lists: int = None,
+              iterations: int = 10,
+              sample_size: int = 50000,
+              seed: int = 0):
+
+        """
+        Train the centroids on a sample of the rows, then assign every row to its closest centroid.
+        By default the number of lists is the square root of the number of rows.
+        """
+
+        rows = matrix.shape[0]
+        n_lists = n_lists or max(1, int(np.sqrt(rows)))
+        n_lists = min(n_lists, rows)
+
+        random = np.random.default_rng(seed)
+        sample = matrix[np.sort(random.choice(rows, size=min(rows, sample_size), replace=False))]
+        centroids = sample[random.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for list_id in range(n_lists):
+                members = sample[assignment == list_id]
+                # An empty list keeps its old centroid
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[list_id] = centroid / (np.linalg.norm(centroid) or 1)
+
+        # Assign all the rows in chunks, so a big partition does not need a rows x n_lists matrix at once
+        assignment = np.empty(rows, dtype=np.int32)
+        for start in range(0, rows, 65536):
+            assignment[start:start + 65536] = np.argmax(matrix[start:start + 65536] @ centroids.T, axis=1)
+
+        list_rows = np.argsort(assignment, kind="stable").astype(np.int32)
+        list_offsets = np.searchsorted(assignment[list_rows], np.arange(n_lists + 1)).astype(np.int64)
+
+        return cls(centroids.astype(np.float32), list_offsets, list_rows, cls.fingerprint_keys(keys))
+
+
+    def candidate_rows(self, query_embedding: np.ndarray, n_probe: int, min_rows: int = 0) -> np.ndarray:
+
+        """
+        The rows of the n_probe lists closest to the query. When those lists hold fewer than min_rows rows,
+        for example because the clustering is skewed, the next closest lists are probed too until there are
+        min_rows candidates, or every list is probed, which is the exact search.
+        """
+
+        if n_probe < 1:
+            raise ValueError("n_probe must be at least 1, got {}".format(n_probe))
+
+        centroid_scores = self.centroids @ query_embedding
+        probe_order = np.argsort(-centroid_scores, kind="stable")
+        list_sizes = np.diff(self.list_offsets)[probe_order]
+        n_probe = max(n_probe, int(np.searchsorted(np.cumsum(list_sizes), min_rows)) + 1)
+
+        return np.concatenate([
+            self.list_rows[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+            for list_id in probe_order[:n_probe]
+        ])
+
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     centroids=self.centroids,
+                     list_offsets=self.list_offsets,
+                     list_rows=self.list_rows,
+                     fingerprint=np.array(self.fingerprint))
+        os.replace(tmp_path, path)
+
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"], str(data["fingerprint"]))
+
+
+class AnnIndexBuilder:
+
+    """
+    This class builds, or loads, the IVF index of a partition next to its embeddings, as "<name>_ivf.npz".
+    A saved index is only reused when it was built from the same keys as the current embeddings.
+    Partitions with less than min_rows rows, like majors and colleges, keep using exact search.
+    With build=False a missing or outdated index is not built, the partition keeps using exact search
+    until the build_search_index command builds it.
+    """
+
+    def __init__(self,
+                 n_probe: int = 8,
+                 min_rows: int = 20000,
+                 n_lists: int = None,
+                 store: EmbeddingStore = None,
+                 build: bool = True):
+        if n_probe < 1:
+            raise ValueError("n_probe must be at least 1, got {}".format(n_probe))
+        self.n_probe = n_probe
+        self.min_rows = min_rows
+        self.n_lists = n_lists
+        self.store = store or EmbeddingStore()
+        self.build = build
+
+
+    def index_path(self, file_name: str) -> str:
+        return self.store.dir_path + file_name + "_ivf.npz"
+
+
+    def get_index(self, embeddings, file_name: str):
+        if len(embeddings) < self.min_rows:
+            return None
+
+        path = self.index_path(file_name)
+        if os.path.exists(path):
+            index = IVFIndex.load(path)
+            if index.fingerprint == IVFIndex.fingerprint_keys(embeddings.keys):
+                return index
+
+        if not self.build:
+            print("The ANN index of", file_name, "is not built, using exact search")
+            return None
+
+        print("Building the ANN index for", file_name)
+        index = IVFIndex.build(embeddings.keys, embeddings.matrix, n_lists=self.n_lists)
+        index.save(path)
+        return index
+
+
+    def attach(self, embeddings, file_name: str) -> None:
+        index = self.get_index(embeddings, file_name)
+        if index is not None:
+            embeddings.attach_index(index, self.n_probe)
+
+
+def recall_report(embeddings,
+                  index: IVFIndex,
+                  n_probe_values: list = (1, 2, 4, 8, 16, 32),
+                  k: int = 25,
+                  sample_size: int = 200,
+                  noise: float = 0.05,
+                  seed: int = 0) -> list:
+
+    """
+    Compare the ANN top k with the exact top k for a sample of queries, for each n_probe value.
+    The queries are rows of the partition with some gaussian noise added, so they are close to,
+    but not exactly on, the stored embeddings. Returns one dict per n_probe value with the mean
+    recall and the mean latency of both searches in milliseconds.
+    The index is passed to each search, the index and n_probe attached to the embeddings are left as they are.
+    """
+
+    random = np.random.default_rng(seed)
+    rows = random.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False)
+    queries = embeddings.matrix[rows] + random.normal(0, noise, size=(len(rows), embeddings.matrix.shape[1]))
+    queries = embeddings.normalize(queries)
+
+    exact_results = []
+    start = time.perf_counter()
+    for query in queries:
+        exact_results.append({key for key, _ in embeddings.exact_top_k(query, k)})
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for n_probe in n_probe_values:
+        recalls = []
+        start = time.perf_counter()
+        for query, exact in zip(queries, exact_results):
+            approximate = {key for key, _ in embeddings.ann_top_k(query, k, index, n_probe)}
+            recalls.append(len(approximate & exact) / len(exact))
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        report.append({
+            "n_probe": n_probe,
+            "recall": round(float(np.mean(recalls)), 4),
+            "ann_ms": round(ann_ms, 4),
+            "exact_ms": round(exact_ms, 4),
+        })
+
+    return report
+
+
+# Print the recall-vs-exact report of a partition, the cache directory can be given as a second argument.
+# python -m services.src.ann_index school_cbse_embeddings services/data/cache/
+if __name__ == "__main__":
+    store = EmbeddingStore(*sys.argv[2:3])
+    embeddings = store.load(sys.argv[1])
+    index = AnnIndexBuilder(min_rows=0, store=store).get_index(embeddings, sys.argv[1])
+
+    print("rows:", len(embeddings), "lists:", len(index.centroids))
+    print("n_probe", "recall", "ann_ms", "exact_ms", sep="\t")
+    for line in recall_report(embeddings, index):
+        print(line["n_probe"], line["recall"], line["ann_ms"], line["exact_ms"], sep="\t")
@@ -1,30 +1,50 @@
 from .data_loader import DataLoader
 import pandas as pd
-import json
-import os
+import time
 from .train_model import TrainModel
-import warnings
+from .corpus_snapshot import CorpusSnapshot
+
+
+class IndexNotBuilt(Exception):
+    """Raised when the embeddings of a partition have not been built, and building them on load is disabled."""
 
 
 class CheckPickleExists():
-    def __init__(self, queryset, dataset: str, options: list=None):
+
+    """
+    Finds the embeddings file of each partition of a dataset. With build=True (the default), the partitions
+    without a file are encoded and the others are reconciled with the rows of the queryset, when the object is created.
+    With build=False nothing is encoded: check_built() only checks which files exist, and the
+    build_search_index command builds the partitions one by one with build_partition().
+    The rows come from a CorpusSnapshot, the one of the SearchEngine when it is given one,
+    otherwise it is read from the queryset when it is first needed, see load_snapshot().
+    """
+
+    def __init__(self, queryset, dataset: str, options: list=None, train_options: dict=None, build: bool=True,
+                 snapshot: CorpusSnapshot=None):
+
+        # train_options sets the encoding batch size and pool, for example {"BATCH_SIZE": 64, "PROCESSES": 0}
+        train_options = train_options or {}
 
         self.loader = DataLoader()
-        self.train = TrainModel()
+        self.train = TrainModel(
+            batch_size=train_options.get("BATCH_SIZE", 64),
+            processes=train_options.get("PROCESSES", 0),
+            pool_min_rows=train_options.get("POOL_MIN_ROWS", 50000)
+            )
 
         self.options = options
         self.dataset = dataset
         self.queryset = queryset
 
-        self.get_column_list()
-        self.df = self.create_dataframe_from_queryset(queryset=queryset)
+        self.snapshot = snapshot
 
         self.generate_file_names()
-        self.file_in_dir_list = self.get_dir_file_names()
-        self.file_not_in_dir = self.check_file_exists()
+        # The rows of each option, split when a partition is built, see get_option_df()
+        self.option_dfs = None
 
-        self.run_encode_df()
-        self.check_each_pkl()
+        if build:
+            self.build_all()
 
     
     def generate_file_names(self):
@@ -37,125 +57,169 @@ class CheckPickleExists():
             self.file_names = self.file_name_generator(dataset_name=self.dataset)
 
 
-    def get_column_list(self) -> None:
-        self.json_file = r"services\data\input\query_data.json"
-        self.json_data = json.load(open(self.json_file))
-        self.required_columns = self.json_data[self.dataset]["columns_required"]
-
-    
-    def create_dataframe_from_queryset(self, queryset: list) -> pd.DataFrame:
-        data = list(queryset.values_list(*self.required_columns))
-        df = pd.DataFrame(data, columns=self.required_columns)
-
-        if "address" in self.required_columns:
-            df["concat"] = df["name"] + " " + df["address"]
-            df["concat"] = df["concat"].apply(self.loader.clean_string)
-        else:
-            df["concat"] = df["name"] 
-            df["concat"] = df["concat"].apply(self.loader.clean_string)
-
-        return df
-
-    
     def file_name_generator(self, dataset_name: str, options: list=None) -> dict:
 
         """
-        This function generates name of the pkl file based on the dataset.
-        If the dataset is "college", then the pkl file name will be "college_embeddings.pkl"
-        if the dataset is "school" and the options are "cbse", "icse", then the pkl file names will be
-        "school_cbse_embeddings.pkl", "school_icse_embeddings.pkl".
+        This function generates name of the embeddings files based on the dataset.
+        If the dataset is "college", then the file name will be "college_embeddings"
+        if the dataset is "school" and the options are "cbse", "icse", then the file names will be
+        "school_cbse_embeddings", "school_icse_embeddings".
+        The EmbeddingStore adds the extension of each file it writes for the partition.
         """
 
         if not options:
             file_names_with_curriculum = {}
-            file_names_with_curriculum[dataset_name] = dataset_name + "_embeddings.pkl"
+            file_names_with_curriculum[dataset_name] = dataset_name + "_embeddings"
         else:
             file_names_with_curriculum = {}
             for option in options:
-                file_names_with_curriculum[option.lower()] = "{}_{}_embeddings.pkl"\
+                file_names_with_curriculum[option.lower()] = "{}_{}_embeddings"\
                     .format(dataset_name, option.lower())
 
         print("File names generated are:", file_names_with_curriculum)
         return file_names_with_curriculum
 
 
-    def get_dir_file_names(self) -> list:
-        path = r"services\data\cache\\"
-        dir_list = os.listdir(path)
-        return dir_list
+    def check_file_exists(self) -> dict:
 
+        """
+        The partitions without an embeddings file. A partition that only has a legacy "<name>.pkl" file
+        is not built yet: the web process does not convert it, build_search_index does.
+        """
 
-    def check_file_exists(self) -> dict:
         file_not_found = {}
         for option, file_name in self.file_names.items():
-            if file_name not in self.file_in_dir_list:
+            if not self.file_exists(file_name):
                 file_not_found[option] = file_name
 
         return file_not_found
+
+
+    def file_exists(self, file_name: str, convert: bool = False) -> bool:
+
+        """
+        With convert=True, when a partition is built, a legacy "<name>.pkl" file is converted
+        to the new format once, so it does not have to be encoded again.
+        """
+
+        if self.loader.store.exists(file_name):
+            return True
+
+        if convert and self.loader.store.legacy_pkl_exists(file_name):
+            self.loader.store.convert_pkl(file_name, model_name=self.train.model_name)
+            return True
+
+        return False
+
+
+    def check_built(self) -> dict:
+
+        """
+        Returns the file names of the partitions whose embeddings are not built, by option.
+        The engine serves the other partitions meanwhile, so a new curriculum does not take the whole dataset
+        down until build_search_index has run. Raises IndexNotBuilt when none of the partitions is built.
+        """
+
+        file_not_found = self.check_file_exists()
+        if len(file_not_found) == len(self.file_names):
+            raise IndexNotBuilt("The {} embeddings {} are not built, run: python manage.py build_search_index"
+                                .format(self.dataset, ", ".join(file_not_found.values())))
+        return file_not_found
+
+
+    def load_snapshot(self) -> CorpusSnapshot:
+        # The rows are read on first use, so the files can be checked before the queryset is
+        if self.snapshot is None:
+            self.snapshot = CorpusSnapshot.from_queryset(self.queryset, self.dataset)
+        return self.snapshot
     
 
-    def filter_df(self, filters: dict) -> list:
-        filtered_df = self.df
-        for key, value in filters.items():
-            if key in filtered_df.columns:
-                filtered_df = filtered_df[filtered_df[key] == value]
-            else:
-                warnings.warn("The column " + key + " is not present in the dataframe",
-                              stacklevel=2)
-        return filtered_df
+    def get_option_df(self, option: str) -> pd.DataFrame:
+        # The rows are only split when a partition is built, an engine that only loads its files never needs them
+        if self.option_dfs is None:
+            self.option_dfs = self.load_snapshot().split(self.file_names)
+        return self.option_dfs[option]
 
 
-    def run_encode_df(self) -> None:
-        for option, file_name in self.file_not_in_dir.items():
-            print("Encoding dataframe for", self.dataset, "dataset and", option.upper(), "option")
-            filters = {"curriculum__abbreviation": option.upper()}
-            self.encode_df(filters=filters, file_name=file_name)
+    def build_all(self) -> list:
+        reports = [self.build_partition(option) for option in self.file_names]
+        # The rows of the options are not kept for the life of the engine, the snapshot already holds them
+        self.option_dfs = None
+        return reports
+
 
+    def build_partition(self, option: str) -> dict:
+
+        """
+        Encode the partition of an option when it has no embeddings file, otherwise bring its file up to date
+        with the rows of the queryset. A file whose keys hash is the hash of the rows is already up to date,
+        its keys are not even read. Returns what was done, with the new version of the file.
+        """
 
-    def encode_df(self, filters: dict, file_name: str) -> None:
-        filtered_df = self.filter_df(filters=filters)
-        self.train.train(df=filtered_df, file_name=file_name)
+        start = time.perf_counter()
+        file_name = self.file_names[option]
+        df = self.get_option_df(option)
+
+        if not self.file_exists(file_name, convert=True):
+            print("Encoding dataframe for", self.dataset, "dataset and", option.upper(), "option")
+            encoded = self.encode_df(option=option, file_name=file_name)["rows"]
+            deleted = 0
+        elif self.loader.store.load_manifest(file_name).get("keys_hash") == self.snapshot.partition_hash(option, df):
+            print("For", self.dataset, "dataset and", option, "option")
+            print("No update required")
+            print()
+            encoded, deleted = 0, 0
+        else:
+            print("For", self.dataset, "dataset and", option, "option")
+            encoded, deleted = self.check_pickle_updated(df=df, pkl_path=file_name)
+            if not encoded and not deleted:
+                # A file written before the manifests had a keys hash, recorded so the next build skips it
+                self.loader.store.update_manifest(file_name, keys_hash=self.snapshot.partition_hash(option, df))
+
+        return {
+            "dataset": self.dataset,
+            "partition": option,
+            "file_name": file_name,
+            "rows": len(df),
+            "encoded": encoded,
+            "deleted": deleted,
+            "version": self.loader.store.load_manifest(file_name).get("version"),
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+
+
+    def encode_df(self, option: str, file_name: str) -> dict:
+        return self.train.train(df=self.get_option_df(option), file_name=file_name)
     
 
     def get_file_names(self) -> dict:
         return self.file_names
     
 
-    def check_pickle_updated(self, df: pd.DataFrame, pkl_path: str) -> None:
+    def check_pickle_updated(self, df: pd.DataFrame, pkl_path: str) -> tuple:
 
         """
         First create a set of the concat column values in df,
-        then create a set of the keys in pkl file.
-        Then perform set arithmetic to check if the values in df are in pkl file or not.
-        if the values in df are not in pkl file, then encode the new values and update the pkl file
-        if there are more values in pkl file than in df, then delete the extra values from pkl file
+        then create a set of the keys in the stored embeddings.
+        Then perform set arithmetic to check if the values in df are in the stored embeddings or not.
+        The values in df that are not stored are encoded, and the stored values that are no longer in df are deleted,
+        both in the same new version, so the file always matches the rows it was built from.
+        Returns the number of values encoded and deleted.
         """
 
-        pkl_data = self.loader.load_pkl(file_name=pkl_path)
+        pkl_data = self.loader.load_embeddings(file_name=pkl_path)
         df_values = set(df["concat"].values)
-        pkl_keys = set(pkl_data.keys())
+        pkl_keys = set(pkl_data.keys)
 
         values_to_encode = df_values - pkl_keys
         values_to_delete = pkl_keys - df_values
 
-        if df_values == pkl_keys:
+        if not values_to_encode and not values_to_delete:
             print("No update required")
             print()
-        
-        elif values_to_encode:
-            print("Encoding new values")
-            print()
-            self.train.update_pickle_values(data=values_to_encode, file_name=pkl_path)
-            
-        elif values_to_delete:
-            print("Deleting extra values")
-            print()
-            self.train.delete_extra_values(data=values_to_delete, file_name=pkl_path)
+            return 0, 0
 
-
-    def check_each_pkl(self) -> None:
-        for option, file_name in self.file_names.items():
-            print("For", self.dataset, "dataset and", option, "option")
-            filters = {"curriculum__abbreviation": option.upper()}
-            filtered_df = self.filter_df(filters=filters)
-            self.check_pickle_updated(df=filtered_df, pkl_path=file_name)
+        print("Encoding {} new values and deleting {} extra values".format(len(values_to_encode), len(values_to_delete)))
+        print()
+        self.train.update_embeddings(values_to_encode=values_to_encode, values_to_delete=values_to_delete, file_name=pkl_path)
+        return len(values_to_encode), len(values_to_delete)
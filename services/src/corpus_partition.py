@@ -0,0 +1,75 @@
+import pandas as pd
+from .embedding_matrix import EmbeddingMatrix
+from .acronym_index import AcronymIndex
+from .address_index import AddressIndex
+from .fuzzy_school_matcher import FuzzySchoolMatcher
+
+
+class CorpusPartition:
+
+    """
+    One slice of a dataset for a combination of filter values, for example the CBSE schools,
+    or the ICSE subjects of the "ssc" education level. It is built once when the data is loaded
+    and holds everything a filtered search needs: the names and addresses, the cleaned
+    concatenated strings, the embedding matrix, the row index of each concatenated string,
+    the lowercased names that the abbreviation search matches against, their acronym index
+    and the address index.
+    A filtered search only touches its own partition, without building masks or copies per request.
+    """
+
+    def __init__(self,
+                 filters: dict,
+                 names: list,
+                 addresses: list,
+                 concat: list,
+                 embeddings: EmbeddingMatrix):
+
+        self.filters = filters
+        self.names = names
+        self.addresses = addresses
+        self.concat = concat
+        self.embeddings = embeddings
+
+        # Names as the abbreviation search compares them, and the index of their word initials
+        self.search_names = [name.strip().lower() for name in names]
+        self.acronym_index = AcronymIndex(self.search_names)
+
+        # Address characters for the address phase of the abbreviation search
+        self.address_index = AddressIndex(addresses) if addresses is not None else None
+
+        # The concatenated strings as the fuzzy rerank scores them, processed once instead of on every request
+        self.rerank_strings = FuzzySchoolMatcher.rerank_strings(concat)
+
+        """
+        concat -> row of the partition, so a match is turned back into a name and address
+        with a dictionary lookup. When several rows share a concatenated string, the first of them is kept.
+        """
+        self.row_index = {}
+        for row, value in enumerate(concat):
+            self.row_index.setdefault(value, row)
+
+
+    @classmethod
+    def from_dataframe(cls, filters: dict, df: pd.DataFrame, embeddings: EmbeddingMatrix):
+        addresses = df["address"].tolist() if "address" in df.columns else None
+        return cls(filters, df["name"].tolist(), addresses, df["concat"].tolist(), embeddings)
+
+
+    @property
+    def has_address(self) -> bool:
+        return self.addresses is not None
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def subset_embeddings(self, embeddings: EmbeddingMatrix) -> EmbeddingMatrix:
+
+        """
+        Keep only the rows of a bigger partition's embeddings that belong to this partition,
+        for partitions that have no embeddings file of their own.
+        """
+
+        rows = [row for row, key in enumerate(embeddings.keys) if key in self.row_index]
+        return EmbeddingMatrix([embeddings.keys[row] for row in rows], embeddings.matrix[rows])
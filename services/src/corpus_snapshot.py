@@ -0,0 +1,83 @@
+import hashlib
+import json
+import pandas as pd
+from .data_loader import DataLoader
+from .embedding_matrix import EmbeddingMatrix
+
+
+class CorpusSnapshot:
+
+    """
+    The rows of a dataset as they were read from the database once: the required columns of query_data.json
+    and the cleaned "concat" string of each row, that its embedding is stored under.
+    One snapshot is shared by the CheckPickleExists that reconciles the embedding files and the SearchEngine
+    that serves the rows, so the query, the DataFrame and the cleaning are done once per load.
+
+    content_hash identifies the rows: two snapshots with the same hash have the same rows in the same order,
+    so an engine built from the first one does not need to be rebuilt for the second.
+    partition_hash() is the hash of the set of concat strings of a partition, which is what its embedding file
+    holds (see EmbeddingMatrix.keys_hash), so a partition whose file has the same hash needs no reconciliation.
+    """
+
+    json_file = r"services\data\input\query_data.json"
+
+    def __init__(self, dataset: str, df: pd.DataFrame):
+        self.dataset = dataset
+        self.df = df
+        self.content_hash = hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+        self.partition_hashes = {}
+
+
+    @classmethod
+    def required_columns(cls, dataset: str) -> list:
+        with open(cls.json_file) as f:
+            return json.load(f)[dataset]["columns_required"]
+
+
+    @classmethod
+    def from_queryset(cls, queryset, dataset: str):
+        columns = cls.required_columns(dataset)
+        df = pd.DataFrame(list(queryset.values_list(*columns)), columns=columns)
+        return cls(dataset, add_concat_column(df))
+
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, dataset: str):
+        # A dataframe with the required columns of the dataset, for example a synthetic corpus
+        return cls(dataset, add_concat_column(df[cls.required_columns(dataset)].copy()))
+
+
+    def split(self, options) -> dict:
+
+        """
+        The rows of each option, split with a single groupby instead of a boolean mask per option.
+        A dataset without a curriculum column has one option holding every row.
+        """
+
+        if "curriculum__abbreviation" not in self.df.columns:
+            return {option: self.df for option in options}
+
+        groups = dict(list(self.df.groupby("curriculum__abbreviation", sort=False)))
+        return {option: groups.get(option.upper(), self.df.iloc[0:0]) for option in options}
+
+
+    def partition_hash(self, option: str, df: pd.DataFrame) -> str:
+        # Computed once per option, the build_search_index command asks for them from several threads
+        if option not in self.partition_hashes:
+            self.partition_hashes[option] = EmbeddingMatrix.keys_hash(df["concat"])
+        return self.partition_hashes[option]
+
+
+def add_concat_column(df: pd.DataFrame) -> pd.DataFrame:
+    # The cleaned string of each row, that its embedding is stored under
+    loader = DataLoader()
+    if "address" in df.columns:
+        df["concat"] = df["name"] + " " + df["address"]
+        # clean all the data in concat column
+        df["concat"] = loader.clean_series(df["concat"])
+    else:
+        df["concat"] = df["name"]
+        # clean all the data in concat column
+        df["concat"] = loader.clean_series(df["concat"])
+
+    return df
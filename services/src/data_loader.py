@@ -1,16 +1,67 @@
+import numpy as np
 import pandas as pd
 import pickle
 import re
+from .embedding_matrix import EmbeddingMatrix
+from .embedding_store import EmbeddingStore
+
+
+# The two patterns of clean_string: the characters it removes, and the runs of single letters it joins ("d p s" -> "dps")
+PUNCTUATION = re.compile(r'[\.\,\"\'\(\)\-]')
+SINGLE_LETTERS = re.compile(r'\b\D\b(\s+\b\D\b)+')
+
+# Joins the strings of a column in clean_series. It is neither a word character nor a space, like the start of a string
+SEPARATOR = "\x00"
+
+# Flags of a character for clean_series, the way the re module sees it
+WORD, DIGIT, SPACE, PUNCTUATION_FLAG = 1, 2, 4, 8
+
+
+def join_letters(match) -> str:
+    return match.group(0).replace(' ', '')
+
+
+def character_flags(chars) -> np.ndarray:
+    return np.array([(WORD if re.match(r'\w', char) else 0)
+                     | (DIGIT if re.match(r'\d', char) else 0)
+                     | (SPACE if re.match(r'\s', char) else 0)
+                     | (PUNCTUATION_FLAG if PUNCTUATION.match(char) else 0)
+                     for char in chars], dtype=np.uint8)
+
+
+LATIN_FLAGS = character_flags(chr(code) for code in range(256))
+
+
+def lookup_flags(codes: np.ndarray) -> np.ndarray:
+    # The latin-1 characters are looked up in a table, the others are classified once per distinct character
+    if codes.dtype == np.uint8:
+        return LATIN_FLAGS[codes]
+
+    flags = LATIN_FLAGS[np.minimum(codes, 255)]
+    wide = codes > 255
+    if wide.any():
+        unique, inverse = np.unique(codes[wide], return_inverse=True)
+        flags[wide] = character_flags(chr(code) for code in unique)[inverse]
+    return flags
 
 
 class DataLoader:
 
     """
-    The following class is used to load the data from the csv files, as well as the encoded pkl files.
+    The following class is used to load the data from the csv files, as well as the encoded embeddings.
     It cleans the data in dataframe by removing unwanted characters and converting the string to lowercase.
     """
 
-    # Function to load the pkl file using pickle
+    def __init__(self):
+        self.store = EmbeddingStore()
+
+
+    # Function to load the embeddings of a partition, the matrix is memory mapped by default
+    def load_embeddings(self, file_name: str, mmap: bool = True) -> EmbeddingMatrix:
+        return self.store.load(file_name, mmap=mmap)
+
+
+    # Function to load a legacy pkl file using pickle
     def load_pkl(self, file_name: str):
         dir_path = r"services\data\cache\\"
         file_path = dir_path + file_name
@@ -20,7 +71,7 @@ class DataLoader:
 
     # Function to clean the data in the dataframe
     def clean_data(self, df: pd.DataFrame, column: str) -> pd.DataFrame:
-        df[column] = df[column].apply(self.clean_string)
+        df[column] = self.clean_series(df[column])
         return df
 
 
@@ -29,8 +80,56 @@ class DataLoader:
         # Convert the string to lowercase and remove unwanted characters using regular expressions.
         # Remove periods, quotes, hyphens, brackets from string using regex
         s = s.lower().strip()
-        s = re.sub(r'[\.\,\"\'\(\)\-]', '', s)
-        s = re.sub(r'\b\D\b(\s+\b\D\b)+', lambda x: x.group(0).replace(' ', ''), s)
+        s = PUNCTUATION.sub('', s)
+        s = SINGLE_LETTERS.sub(join_letters, s)
         return s
-    
-    
\ No newline at end of file
+
+
+    def clean_series(self, series: pd.Series) -> pd.Series:
+
+        """
+        clean_string for a whole column of strings, with the same output for every string, without a regex per row.
+        The stripped strings are joined into one string, lowercased at once, and turned into an array of characters:
+        - the characters of PUNCTUATION are removed with one mask
+        - SINGLE_LETTERS only ever matches single letter words (a non digit word character between non word characters)
+          separated by whitespace, so the spaces it removes are the spaces between two consecutive single letter words
+          that have only whitespace between them
+        A column with a string containing the separator is cleaned row by row.
+        """
+
+        values = [value.strip() for value in series.tolist()]
+        joined = SEPARATOR.join(values)
+        if not values or joined.count(SEPARATOR) != len(values) - 1:
+            return series.apply(self.clean_string)
+
+        # One byte per character when they all fit in latin-1, which is the common case
+        lowered = joined.lower()
+        try:
+            encoding = "latin-1"
+            codes = np.frombuffer(lowered.encode(encoding), dtype=np.uint8)
+        except UnicodeEncodeError:
+            encoding = "utf-32-le"
+            codes = np.frombuffer(lowered.encode(encoding, "surrogatepass"), dtype=np.uint32)
+
+        flags = lookup_flags(codes)
+        kept = (flags & PUNCTUATION_FLAG) == 0
+        codes, flags = codes[kept], flags[kept]
+
+        word = (flags & WORD) != 0
+        single_letter = word & ((flags & DIGIT) == 0)
+        single_letter[1:] &= ~word[:-1]
+        single_letter[:-1] &= ~word[1:]
+        letters = np.flatnonzero(single_letter)
+
+        # Pairs of consecutive single letters with at least one character, and only whitespace, between them
+        non_space = np.cumsum((flags & SPACE) == 0, dtype=np.int64)
+        first, second = letters[:-1], letters[1:]
+        joined_pairs = (second - first > 1) & (non_space[second - 1] == non_space[first])
+        starts, lengths = first[joined_pairs] + 1, second[joined_pairs] - first[joined_pairs] - 1
+
+        gaps = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        kept = np.ones(len(codes), dtype=bool)
+        kept[gaps[codes[gaps] == ord(' ')]] = False
+
+        cleaned = codes[kept].tobytes().decode(encoding, "surrogatepass").split(SEPARATOR)
+        return pd.Series(cleaned, index=series.index, name=series.name, dtype=object)
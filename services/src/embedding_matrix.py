@@ -0,0 +1,142 @@
+import hashlib
+import numpy as np
+
+
+class EmbeddingMatrix:
+
+    """
+    This class holds the embeddings of one dataset partition as a single contiguous, L2 normalized
+    float32 matrix, along with the list of concatenated strings that each row belongs to.
+    Since every row is normalized, the cosine similarity of a query with the whole partition is
+    a single matrix-vector product.
+    """
+
+    def __init__(self, keys: list, matrix: np.ndarray):
+        self.keys = list(keys)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+        if self.matrix.ndim != 2 or self.matrix.shape[0] != len(self.keys):
+            raise ValueError("The embedding matrix must have one row for each key")
+
+        # Optional approximate nearest neighbour index, see ann_index.py
+        self.ann_index = None
+        self.n_probe = None
+
+
+    @classmethod
+    def from_dict(cls, embeddings: dict):
+
+        """
+        Build the matrix from the {concat_string: embedding} dictionary stored in the pkl files.
+        The rows are kept in the insertion order of the dictionary.
+        """
+
+        keys = list(embeddings.keys())
+        if not keys:
+            return cls(keys, np.zeros((0, 0), dtype=np.float32))
+
+        matrix = np.vstack([np.asarray(embeddings[key], dtype=np.float32) for key in keys])
+        return cls(keys, cls.normalize(matrix))
+
+
+    @staticmethod
+    def normalize(matrix: np.ndarray) -> np.ndarray:
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+
+    @staticmethod
+    def keys_hash(keys) -> str:
+
+        """
+        Hash of the set of keys: the same strings give the same hash, whatever their order and repetitions.
+        Stored in the manifest of a partition, and compared with the strings of the rows to skip reconciling it.
+        """
+
+        digest = hashlib.sha256()
+        for key in sorted(set(keys)):
+            digest.update(key.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def similarities(self, query_embedding) -> np.ndarray:
+        query_embedding = self.normalize(query_embedding).reshape(-1)
+        return self.matrix @ query_embedding
+
+
+    def attach_index(self, ann_index, n_probe: int) -> None:
+        self.ann_index = ann_index
+        self.n_probe = n_probe
+
+
+    def top_k(self, query_embedding, k: int) -> list:
+
+        """
+        Return the (key, similarity) pairs of the k rows most similar to the query, best first.
+        If an ANN index is attached, only the rows of the lists it probes are scored,
+        otherwise every row of the partition is scored.
+        """
+
+        if self.ann_index is None:
+            return self.exact_top_k(query_embedding, k)
+        return self.ann_top_k(query_embedding, k, self.ann_index, self.n_probe)
+
+
+    def ann_top_k(self, query_embedding, k: int, ann_index, n_probe: int) -> list:
+        # The probed lists are widened until they hold at least k rows, so a skewed index does not return fewer matches
+        if len(self) == 0 or k <= 0:
+            return []
+
+        query_embedding = self.normalize(query_embedding).reshape(-1)
+        rows = ann_index.candidate_rows(query_embedding, n_probe, min_rows=k)
+        return self.select_top_k(self.matrix[rows] @ query_embedding, rows, k)
+
+
+    def top_k_batch(self, query_embeddings: list, k: int) -> list:
+
+        """
+        top_k for several queries, in the same order. Without an ANN index, the similarities of all
+        the queries are computed with a single matrix product instead of one product per query.
+        """
+
+        if self.ann_index is not None:
+            return [self.top_k(query_embedding, k) for query_embedding in query_embeddings]
+
+        if len(self) == 0 or k <= 0 or len(query_embeddings) == 0:
+            return [[] for _ in query_embeddings]
+
+        query_matrix = self.normalize(np.vstack(query_embeddings))
+        similarities = query_matrix @ self.matrix.T
+        rows = np.arange(len(self))
+        return [self.select_top_k(row_similarities, rows, k) for row_similarities in similarities]
+
+
+    def exact_top_k(self, query_embedding, k: int) -> list:
+        if len(self) == 0 or k <= 0:
+            return []
+
+        similarities = self.similarities(query_embedding)
+        return self.select_top_k(similarities, np.arange(len(similarities)), k)
+
+
+    def select_top_k(self, similarities: np.ndarray, rows: np.ndarray, k: int) -> list:
+
+        """
+        Instead of sorting all the similarities, argpartition selects the k best rows
+        and only those k rows are sorted. Ties are kept in row order.
+        """
+
+        if k < len(similarities):
+            indices = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            indices = np.arange(len(similarities))
+
+        indices = indices[np.lexsort((rows[indices], -similarities[indices]))]
+        return [(self.keys[rows[index]], float(similarities[index])) for index in indices]
@@ -0,0 +1,186 @@
+import json
+import os
+import pickle
+import sys
+import time
+import uuid
+import numpy as np
+from .embedding_matrix import EmbeddingMatrix
+
+
+class EmbeddingStore:
+
+    """
+    The following class reads and writes the embeddings of a dataset partition on disk.
+    Each partition, for example "school_cbse_embeddings", is stored as three files:
+    - "<name>.npy": a raw float32 matrix with one normalized embedding per row
+    - "<name>_keys.json": the concatenated strings, where the position of a key is its row id
+    - "<name>_manifest.json": a small manifest describing the matrix and pointing to the two files above
+    The matrix is opened with mmap, so the workers of a process share one page-cached copy
+    of it instead of each unpickling its own copy into the heap.
+
+    Every save is a new version: the matrix and the keys are written as "<name>.<version>.npy" and
+    "<name>.<version>_keys.json", and the manifest is switched to them last. The files of the last
+    keep_versions versions are kept, so a worker that still has the previous matrix mapped can keep using it.
+    """
+
+    format_version = 1
+    keep_versions = 2
+
+    def __init__(self, dir_path: str = r"services\data\cache\\"):
+        self.dir_path = dir_path
+
+
+    def manifest_path(self, file_name: str) -> str:
+        return self.dir_path + file_name + "_manifest.json"
+
+
+    def exists(self, file_name: str) -> bool:
+        return os.path.exists(self.manifest_path(file_name))
+
+
+    def legacy_pkl_exists(self, file_name: str) -> bool:
+        return os.path.exists(self.dir_path + file_name + ".pkl")
+
+
+    def load_manifest(self, file_name: str) -> dict:
+        with open(self.manifest_path(file_name), "r") as f:
+            return json.load(f)
+
+
+    def load(self, file_name: str, mmap: bool = True) -> EmbeddingMatrix:
+        manifest = self.load_manifest(file_name)
+
+        with open(self.dir_path + manifest["keys_file"], "r", encoding="utf-8") as f:
+            keys = json.load(f)
+
+        # An empty matrix can not be memory mapped, so it is read normally
+        mmap_mode = "r" if mmap and manifest["rows"] > 0 else None
+        matrix = np.load(self.dir_path + manifest["matrix_file"], mmap_mode=mmap_mode)
+
+        return EmbeddingMatrix(keys, matrix)
+
+
+    def save(self, embeddings: EmbeddingMatrix, file_name: str, model_name: str = None) -> None:
+
+        """
+        Write the matrix and the keys first and the manifest last. Every file is written to a
+        temporary path and then moved into place, so a process that already has the old matrix
+        mapped keeps reading the old file, and a reader never sees a half written partition.
+        """
+
+        version = time.strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        matrix_file = "{}.{}.npy".format(file_name, version)
+        keys_file = "{}.{}_keys.json".format(file_name, version)
+
+        previous_versions = []
+        if self.exists(file_name):
+            previous = self.load_manifest(file_name)
+            previous_versions = [previous.get("version")] + previous.get("previous_versions", [])
+            previous_versions = previous_versions[:self.keep_versions - 1]
+
+        manifest = {
+            "format_version": self.format_version,
+            "version": version,
+            "previous_versions": previous_versions,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "model_name": model_name,
+            "rows": len(embeddings),
+            "keys_hash": EmbeddingMatrix.keys_hash(embeddings.keys),
+            "dim": int(embeddings.matrix.shape[1]) if embeddings.matrix.ndim == 2 else 0,
+            "dtype": "float32",
+            "normalized": True,
+            "matrix_file": matrix_file,
+            "keys_file": keys_file,
+        }
+
+        self.write_atomic(matrix_file, lambda f: np.save(f, embeddings.matrix), binary=True)
+        self.write_atomic(keys_file, lambda f: json.dump(embeddings.keys, f, ensure_ascii=False))
+        self.write_atomic(file_name + "_manifest.json", lambda f: json.dump(manifest, f, indent=4))
+
+        self.prune(file_name, [version] + previous_versions)
+
+
+    def update_manifest(self, file_name: str, **fields) -> None:
+        # Change fields of the manifest of the current version, without writing a new version
+        manifest = self.load_manifest(file_name)
+        manifest.update(fields)
+        self.write_atomic(file_name + "_manifest.json", lambda f: json.dump(manifest, f, indent=4))
+
+
+    def prune(self, file_name: str, versions: list) -> None:
+
+        """
+        Delete the matrix and keys files of a partition that are not part of the given versions.
+        The files written before versioning ("<name>.npy") have no version, so they are deleted too.
+        A file that can not be deleted yet, like a matrix still mapped on Windows, is left for the next save.
+        """
+
+        # dir_path is a path prefix, so the files are listed in the directory it ends in
+        directory, prefix = os.path.split(self.dir_path + file_name)
+
+        kept = set()
+        for version in versions:
+            kept.add("{}.{}.npy".format(prefix, version))
+            kept.add("{}.{}_keys.json".format(prefix, version))
+
+        for dir_file in os.listdir(directory or "."):
+            if dir_file in kept or not dir_file.startswith(prefix):
+                continue
+
+            version = dir_file[len(prefix):]
+            unversioned = version in (".npy", "_keys.json")
+            versioned = version.startswith(".") and (version.endswith(".npy") or version.endswith("_keys.json"))
+            if unversioned or versioned:
+                try:
+                    os.remove(os.path.join(directory, dir_file))
+                except OSError:
+                    pass
+
+
+    def write_atomic(self, file_name: str, write, binary: bool = False) -> None:
+        dest_path = self.dir_path + file_name
+        tmp_path = dest_path + ".tmp"
+
+        if binary:
+            with open(tmp_path, "wb") as f:
+                write(f)
+        else:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                write(f)
+
+        os.replace(tmp_path, dest_path)
+
+
+    def convert_pkl(self, file_name: str, model_name: str = None) -> EmbeddingMatrix:
+
+        """
+        One time conversion of a legacy "<name>.pkl" file holding a {concat_string: embedding} dict
+        into the new format. The pkl file is left in place.
+        """
+
+        with open(self.dir_path + file_name + ".pkl", "rb") as f:
+            pkl_data = pickle.load(f)
+
+        embeddings = EmbeddingMatrix.from_dict(pkl_data)
+        self.save(embeddings, file_name, model_name=model_name)
+
+        print("Converted", file_name + ".pkl", "with", len(embeddings), "rows")
+        return embeddings
+
+
+    def convert_all_pkl(self, model_name: str = None) -> list:
+        converted = []
+        for dir_file in sorted(os.listdir(self.dir_path)):
+            if dir_file.endswith("_embeddings.pkl"):
+                file_name = dir_file[:-len(".pkl")]
+                self.convert_pkl(file_name, model_name=model_name)
+                converted.append(file_name)
+        return converted
+
+
+# Convert the existing *_embeddings.pkl files, the cache directory can be given as a command line argument.
+# python -m services.src.embedding_store services/data/cache/
+if __name__ == "__main__":
+    store = EmbeddingStore(*sys.argv[1:2])
+    store.convert_all_pkl()
@@ -1,6 +1,10 @@
-from sentence_transformers import SentenceTransformer, util
-import pandas as pd
-from fuzzywuzzy import fuzz, process
+import numpy as np
+from fuzzywuzzy import fuzz, utils
+from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process
+from .model_registry import model_registry, DEFAULT_MODEL_NAME
+from .query_embedding_cache import query_embedding_cache
+from .search_metrics import search_metrics, stage_seconds, candidate_count
+from .matcher_pool import check_deadline
 
 
 class FuzzySchoolMatcher:
@@ -8,57 +12,128 @@ class FuzzySchoolMatcher:
     """
     In the below class, we have used sentence transformer model to encode the school names
     and addresses into embeddings. Then we use the cosine similarity between the input query and
-    the dataset embeddings to find the top k most similar embeddings. After that, use fuzzywuzzy
-    to find the top 5 most similar strings from the top k matches, using the token_set_ratio scorer.
-    We assume name and address columns to be present. If address column is not present, we only
+    the dataset embeddings to find the top k most similar embeddings. The embeddings of a partition
+    are held in an EmbeddingMatrix, so the similarities come from a single matrix-vector product.
+    After that, the top k candidates are reranked with the token_set_ratio scorer, and the best 'limit' are kept.
+    The candidate strings are processed once, when the partition is built, and all of them are scored
+    in one batched rapidfuzz call, with the same scores as fuzzywuzzy's token_set_ratio.
+    We assume name and address columns to be present. If the partition has no addresses, we only
     perform fuzzy matching on the name column.
+    The encode, similarity and rerank stages are timed in the search metrics, under the dataset of the engine.
     """
     def __init__(self):
 
         # Define the model name for sentence transformation
-        self.model_name = 'all-MiniLM-L6-v2'
+        self.model_name = DEFAULT_MODEL_NAME
+        self.metrics_dataset = getattr(self, "dataset", None)
 
-        # Initialize the sentence transformer model
-        self.model = SentenceTransformer(self.model_name)
+
+    @property
+    def model(self):
+        # The model is loaded on first use and shared by every matcher of the process
+        return model_registry.get_model(self.model_name)
 
 
     def fuzzy_using_ST(self,
                        query: str,
-                       df: pd.DataFrame,
-                       embeddings) -> list:
+                       partition,
+                       candidates: int = 25,
+                       limit: int = 5) -> list:
+
+        # Repeated queries reuse the embedding cached by any engine of the process
+        with search_metrics.timer(stage_seconds, self.metrics_dataset, "encode"):
+            query_embedding = query_embedding_cache.get_or_encode(self.model_name, query, self.model.encode)
+
+        # Get the top k most similar embeddings, using a partial selection instead of a full sort
+        # A search that missed its deadline during a stage stops before the next one
+        check_deadline()
+        with search_metrics.timer(stage_seconds, self.metrics_dataset, "similarity"):
+            top_k_entries = partition.embeddings.top_k(query_embedding, candidates)
+        check_deadline()
+        return self.rerank(query, partition, top_k_entries, limit)
+
+
+    def encode_queries(self, queries: list) -> list:
+        # The queries that are not cached are encoded with one model call
+        with search_metrics.timer(stage_seconds, self.metrics_dataset, "encode"):
+            return query_embedding_cache.get_or_encode_many(self.model_name, queries, self.model.encode)
 
-        query_embedding = self.model.encode(query)
 
-        similarities = {}
+    def fuzzy_using_embeddings(self,
+                               queries: list,
+                               query_embeddings: list,
+                               partition,
+                               candidates: int = 25,
+                               limit: int = 5) -> list:
 
-        for name, embedding in embeddings.items():
-            similarity = util.pytorch_cos_sim(query_embedding, embedding)
-            similarities[name] = similarity.item()
-        
-        # Get the indices of the top k most similar embeddings
-        sorted_similarities = sorted(similarities.items(), key=lambda x: x[1], reverse=True)
+        # fuzzy_using_ST for several queries of one partition, scored with a single matrix product
+        with search_metrics.timer(stage_seconds, self.metrics_dataset, "similarity"):
+            top_k_lists = partition.embeddings.top_k_batch(query_embeddings, candidates)
+        return [self.rerank(query, partition, top_k_entries, limit) for query, top_k_entries in zip(queries, top_k_lists)]
 
-        k = 25
-        # Get the indices top k most similar embeddings
-        top_k_entries = sorted_similarities[:k]
 
-        top_k_strings = [entry[0] for entry in top_k_entries]
+    def rerank(self, query: str, partition, top_k_entries: list, limit: int) -> list:
+        with search_metrics.timer(stage_seconds, self.metrics_dataset, "rerank"):
+            return self.rerank_entries(query, partition, top_k_entries, limit)
 
-        # Perform fuzzy matching on the top k addresses
-        top_5_matches = process.extractBests(query, top_k_strings, scorer=fuzz.token_set_ratio, limit=5)
+
+    def rerank_entries(self, query: str, partition, top_k_entries: list, limit: int) -> list:
+
+        """
+        The partition's row index turns a candidate back into its row.
+        The embeddings may still hold a string that is no longer in the partition, it is left out.
+        """
+        rows = [partition.row_index.get(entry[0]) for entry in top_k_entries]
+        rows = [row for row in rows if row is not None]
+        candidate_count.set(len(rows), self.metrics_dataset, "fuzzy")
+
+        # Rerank the candidates, ties keep the order of the embedding similarity
+        scores = self.rerank_scores(query, [partition.rerank_strings[row] for row in rows])
+        best = np.argsort(-scores, kind="stable")[:limit]
 
         final_list = []
 
-        # Extract the school name, address, and score for the top 5 matches and append
-        # them to the final list.
-        for match in top_5_matches:
-            name = df.loc[df["concat"] == match[0], "name"].values[0]
-            score = match[1]
-            try:
-                address = df.loc[df["concat"] == match[0], "address"].values[0]
+        # Extract the school name, address, and score of the best matches and append them to the final list
+        for position in best:
+            row = rows[position]
+            name = partition.names[row]
+            score = int(scores[position])
+            if partition.has_address:
+                address = partition.addresses[row]
                 final_list.append((name.title(), address.title(), score))
-            except KeyError:
-                # If the dataframe does not have the address column, then append only the name and score
+            else:
+                # If the partition does not have the address column, then append only the name and score
                 final_list.append((name.title(), score))
 
-        return final_list
\ No newline at end of file
+        return final_list
+
+
+    @staticmethod
+    def rerank_strings(values: list) -> list:
+        # The strings as fuzzywuzzy's token_set_ratio processes them, computed once when a partition is built
+        return [utils.full_process(value, force_ascii=True) for value in values]
+
+
+    @staticmethod
+    def rerank_scores(query: str, choices: list) -> np.ndarray:
+
+        """
+        Score the query against all the processed choices in one batched call.
+        fuzzywuzzy rounds each ratio to an integer. rapidfuzz computes the same ratios, but a score
+        that falls exactly on .5 can round the other way, so those few are scored by fuzzywuzzy itself.
+        """
+
+        if not choices:
+            return np.zeros(0)
+
+        processed_query = utils.full_process(query, force_ascii=True)
+        scores = rapid_process.cdist([processed_query], choices,
+                                     scorer=rapid_fuzz.token_set_ratio,
+                                     processor=None,
+                                     dtype=np.float64)[0]
+
+        rounded = np.rint(scores)
+        for position in np.flatnonzero(np.abs(scores % 1 - 0.5) < 1e-6):
+            rounded[position] = fuzz.token_set_ratio(processed_query, choices[position], full_process=False)
+
+        return rounded
@@ -0,0 +1,147 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class SearchDeadlineExceeded(Exception):
+    """Raised when none of the matchers of a search finished before the deadline."""
+
+
+class PartialResults(list):
+
+    """
+    Results of a search where some of the matchers missed the deadline.
+    They are returned to the request, but are not worth caching.
+    """
+
+    partial = True
+
+
+class MatcherCancelled(Exception):
+    """Raised inside a matcher that missed its deadline, so it stops and frees its thread."""
+
+
+# The deadline of the matcher running on each thread, see check_deadline()
+current = threading.local()
+
+
+def check_deadline() -> None:
+
+    """
+    Called by the matchers between their steps. Raises MatcherCancelled when the matcher that runs
+    on this thread has missed its deadline, and does nothing outside of a MatcherPool.
+    """
+
+    deadline = getattr(current, "deadline", None)
+    if deadline is not None:
+        deadline.check()
+
+
+class MatcherTask:
+
+    """
+    One matcher call of MatcherPool.run(), with its own deadline counted from the moment it starts running.
+    A matcher past its deadline, or cancelled by run(), stops at its next check_deadline() and returns None.
+    """
+
+    def __init__(self, call, deadline: float = None):
+        self.call = call
+        self.deadline = deadline
+        self.started_at = None
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+
+
+    def run(self):
+        self.started_at = time.monotonic()
+        self.started.set()
+        previous, current.deadline = getattr(current, "deadline", None), self
+        try:
+            return self.call()
+        except MatcherCancelled:
+            return None
+        finally:
+            current.deadline = previous
+
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - (time.monotonic() - self.started_at))
+
+
+    def check(self) -> None:
+        if self.cancelled.is_set() or self.remaining() == 0:
+            raise MatcherCancelled()
+
+
+class MatcherPool:
+
+    """
+    A bounded pool of threads that runs the matchers of a hybrid search (abbreviation and fuzzy search) concurrently.
+    The pool is shared by every search engine of the process, so the number of matcher threads stays bounded
+    however many requests come in. Each matcher gets the deadline from the moment it starts running, so time spent
+    waiting for a free thread does not count against it. A matcher that is still queued when run() gets to it
+    is taken back from the pool and run on the thread of the request, which would otherwise only wait for it.
+    A matcher that misses its deadline is cancelled: its result is dropped, and it stops at its next check_deadline().
+    """
+
+    def __init__(self, workers: int = 4, deadline: float = None):
+        self.workers = workers
+        self.deadline = deadline
+        self.executor = None
+        self.lock = threading.Lock()
+
+
+    def configure(self, workers: int, deadline: float = None) -> None:
+        with self.lock:
+            old_executor = None
+            if workers != self.workers:
+                old_executor, self.executor = self.executor, None
+            self.workers = workers
+            self.deadline = deadline
+
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="search-matcher")
+            return self.executor
+
+
+    def run(self, calls: list, deadline: float = None) -> list:
+
+        """
+        Run every call on the pool and return their results in the same order.
+        A call that has not finished by its deadline gets None. Exceptions of the calls are raised here.
+        """
+
+        deadline = deadline if deadline is not None else self.deadline
+        executor = self.get_executor()
+        tasks = [MatcherTask(call, deadline) for call in calls]
+        futures = [executor.submit(task.run) for task in tasks]
+
+        try:
+            # The calls that no thread has picked up yet run here, one after the other
+            results = [task.run() if future.cancel() else None for task, future in zip(tasks, futures)]
+
+            for position, (task, future) in enumerate(zip(tasks, futures)):
+                if future.cancelled():
+                    continue
+                task.started.wait()
+                try:
+                    results[position] = future.result(timeout=task.remaining())
+                except TimeoutError:
+                    task.cancelled.set()
+            return results
+        except BaseException:
+            # A failed call fails the search, the other matchers are stopped
+            for task in tasks:
+                task.cancelled.set()
+            raise
+
+
+matcher_pool = MatcherPool()
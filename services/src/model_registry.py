@@ -0,0 +1,43 @@
+import threading
+from sentence_transformers import SentenceTransformer
+
+
+class ModelRegistry:
+
+    """
+    Process wide registry of the sentence transformer models.
+    Each model name is loaded once, the first time it is asked for, and the same instance is
+    handed to every matcher and trainer of the process, so the weights are held in memory only once.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.Lock()
+
+
+    def get_model(self, model_name: str) -> SentenceTransformer:
+        model = self.models.get(model_name)
+        if model is not None:
+            return model
+
+        # Only one thread loads a model, the others wait for it and reuse the loaded instance
+        with self.lock:
+            if model_name not in self.models:
+                print("Loading the sentence transformer model", model_name)
+                self.models[model_name] = SentenceTransformer(model_name)
+            return self.models[model_name]
+
+
+    def register(self, model_name: str, model) -> None:
+        # Any object with the encode() method of SentenceTransformer, for example the encoder of the benchmarks
+        with self.lock:
+            self.models[model_name] = model
+
+
+    def loaded_models(self) -> list:
+        return list(self.models.keys())
+
+
+DEFAULT_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+model_registry = ModelRegistry()
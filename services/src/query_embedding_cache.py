@@ -0,0 +1,118 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from .search_metrics import search_metrics, render_samples
+
+
+class QueryEmbeddingCache:
+
+    """
+    Bounded, thread safe LRU cache of query embeddings, keyed by the model name and the cleaned query.
+    A single instance is shared by all the search engines of the process, so a repeated query
+    skips the transformer forward pass whichever endpoint it comes from.
+    Setting maxsize to 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get_or_encode(self, model_name: str, query: str, encode):
+        key = (model_name, query)
+
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            self.misses += 1
+
+        # Encode outside the lock, so a slow encode does not block the cache hits of other threads
+        embedding = encode(query)
+        self.store(model_name, query, embedding)
+        return embedding
+
+
+    def get_or_encode_many(self, model_name: str, queries: list, encode_many) -> list:
+
+        """
+        Return the embeddings of several queries, in the same order.
+        The queries that are not cached are encoded together, with a single encode_many call on the list of them.
+        """
+
+        embeddings = {}
+        missing = []
+
+        with self.lock:
+            for query in dict.fromkeys(queries):
+                embedding = self.entries.get((model_name, query))
+                if embedding is not None:
+                    self.entries.move_to_end((model_name, query))
+                    self.hits += 1
+                    embeddings[query] = embedding
+                else:
+                    self.misses += 1
+                    missing.append(query)
+
+        if missing:
+            for query, embedding in zip(missing, encode_many(missing)):
+                embedding = np.array(embedding)
+                self.store(model_name, query, embedding)
+                embeddings[query] = embedding
+
+        return [embeddings[query] for query in queries]
+
+
+    def store(self, model_name: str, query: str, embedding) -> None:
+        key = (model_name, query)
+        embedding.flags.writeable = False
+
+        with self.lock:
+            if self.maxsize > 0:
+                self.entries[key] = embedding
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+
+
+    def resize(self, maxsize: int) -> None:
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > max(maxsize, 0):
+                self.entries.popitem(last=False)
+
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+    def metrics(self) -> list:
+        # Lines of the search metrics endpoint
+        stats = self.stats()
+        return (render_samples("search_query_embedding_cache_requests_total", "counter",
+                               "Lookups of the query embedding cache",
+                               [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])])
+                + render_samples("search_query_embedding_cache_size", "gauge",
+                                 "Query embeddings held by the cache", [({}, stats["size"])]))
+
+
+query_embedding_cache = QueryEmbeddingCache()
+search_metrics.add_collector(query_embedding_cache.metrics)
@@ -0,0 +1,299 @@
+import argparse
+import gc
+import hashlib
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from .embedding_matrix import EmbeddingMatrix
+from .address_index import AddressIndex
+from .model_registry import model_registry, DEFAULT_MODEL_NAME
+from .query_embedding_cache import query_embedding_cache
+from .search_engine import SearchEngine
+from .corpus_snapshot import CorpusSnapshot
+from .synthetic_corpus import SyntheticCorpus
+
+
+class HashingEncoder:
+
+    """
+    A deterministic stand-in for the sentence transformer: character trigrams hashed into 'dim' buckets.
+    Strings sharing trigrams get similar vectors, so the fuzzy search finds sensible candidates,
+    and a 500k row corpus is encoded in seconds instead of hours. Use it to benchmark the matchers;
+    the real model ("--encoder model") is needed to benchmark the encode stage itself.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+
+    def encode_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = "  {}  ".format(text)
+        for position in range(len(text) - 2):
+            digest = hashlib.md5(text[position:position + 3].encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dim] += 1
+        return vector
+
+
+    def encode(self, values, batch_size: int = 64, show_progress_bar: bool = False, convert_to_numpy: bool = True):
+        if isinstance(values, str):
+            return self.encode_one(values)
+        if not len(values):
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack([self.encode_one(value) for value in values])
+
+
+class SearchBenchmark:
+
+    """
+    Benchmarks SearchEngine on synthetic corpora (see SyntheticCorpus), for each dataset and corpus size:
+    - the time to encode the corpus, and the time and memory (traced Python and numpy allocations) to build the engine
+    - the p50/p95/p99 and mean latency, and the throughput, of every search path the query mix goes through
+      (abbreviation, fuzzy, hybrid, and subject for the subject dataset)
+    - for the datasets with addresses, the abbreviation search of queries whose place no address can match
+      ("address_miss"), and of the same queries with every address left to the fuzzy regex ("address_miss_regex"),
+      which is the work the AddressIndex prefilter saves
+    The query embedding cache is cleared before the queries are run, so every query is encoded.
+    The results are plain JSON, so two runs (two commits) can be compared with compare().
+    """
+
+    def __init__(self, encoder: str = "hashing", seed: int = 0, curricula: int = 3, queries: int = 400, warmup: int = 20):
+        self.encoder = encoder
+        self.seed = seed
+        self.corpus = SyntheticCorpus(seed=seed, curricula=curricula)
+        self.query_count = queries
+        self.warmup = warmup
+
+        if encoder == "hashing":
+            self.model_name = "benchmark-hashing"
+            model_registry.register(self.model_name, HashingEncoder())
+        else:
+            self.model_name = DEFAULT_MODEL_NAME
+
+
+    def encode_partitions(self, dataset: str, df) -> dict:
+
+        """
+        The EmbeddingMatrix of every option of the dataset, the way TrainModel builds them:
+        one row per distinct concatenated string, in the order they first appear.
+        """
+
+        model = model_registry.get_model(self.model_name)
+        concat_df = CorpusSnapshot.from_dataframe(df, dataset).df
+
+        if "curriculum__abbreviation" in concat_df.columns:
+            groups = {option.lower(): group for option, group in concat_df.groupby("curriculum__abbreviation", sort=False)}
+        else:
+            groups = {dataset: concat_df}
+
+        embeddings = {}
+        for option, group in groups.items():
+            keys = list(dict.fromkeys(group["concat"]))
+            matrix = model.encode(keys, batch_size=64, show_progress_bar=False, convert_to_numpy=True)
+            embeddings[option] = EmbeddingMatrix(keys, EmbeddingMatrix.normalize(np.asarray(matrix)))
+        return embeddings
+
+
+    def run_dataset(self, dataset: str, rows: int) -> dict:
+        print("Benchmarking", dataset, "with", rows, "rows", file=sys.stderr)
+        df = self.corpus.generate(dataset, rows)
+
+        start = time.perf_counter()
+        embeddings = self.encode_partitions(dataset, df)
+        encode_seconds = time.perf_counter() - start
+
+        # The build is timed without tracing, then repeated under tracemalloc for its memory
+        gc.collect()
+        start = time.perf_counter()
+        engine = SearchEngine.from_dataframe(df, dataset, embeddings, model_name=self.model_name)
+        build_seconds = time.perf_counter() - start
+
+        del engine
+        gc.collect()
+        tracemalloc.start()
+        engine = SearchEngine.from_dataframe(df, dataset, embeddings, model_name=self.model_name)
+        build_memory, build_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        subject = dataset == "subject"
+        queries = self.corpus.queries(dataset, df, self.query_count + self.warmup)
+        for query, filter_dict in queries[:self.warmup]:
+            engine.search(query, filter_dict, subject=subject)
+
+        query_embedding_cache.clear()
+        timings = {}
+        total_start = time.perf_counter()
+        for query, filter_dict in queries[self.warmup:]:
+            route = "subject" if subject else engine.query_route(query.split())
+            start = time.perf_counter()
+            engine.search(query, filter_dict, subject=subject)
+            timings.setdefault(route, []).append(time.perf_counter() - start)
+        total_seconds = time.perf_counter() - total_start
+        timings.update(self.run_address_misses(engine, dataset, df))
+
+        return {
+            "dataset": dataset,
+            "rows": rows,
+            "partitions": len(engine.partitions),
+            "encode_seconds": round(encode_seconds, 4),
+            "build_seconds": round(build_seconds, 4),
+            "build_memory_bytes": build_memory,
+            "build_peak_bytes": build_peak,
+            "queries": self.query_count,
+            "queries_per_second": round(self.query_count / total_seconds, 2) if total_seconds > 0 else None,
+            "paths": {route: latency_summary(seconds) for route, seconds in sorted(timings.items())},
+        }
+
+
+    def address_miss_queries(self, dataset: str, df) -> list:
+
+        """
+        The name acronyms of the query mix, followed by a place made of the four letters that are the rarest
+        in the addresses, for example "dps qxzj". The AddressIndex rejects the addresses missing three of them
+        without running the fuzzy regex, so those queries time the prefilter itself.
+        """
+
+        counts = {letter: 0 for letter in "abcdefghijklmnopqrstuvwxyz"}
+        for char in "".join(df["address"]).lower():
+            if char in counts:
+                counts[char] += 1
+        place = "".join(sorted(counts, key=lambda letter: (counts[letter], letter))[:4])
+
+        queries = []
+        for query, filter_dict in self.corpus.queries(dataset, df, self.query_count):
+            name = query.split(" ")[0]
+            if 1 < len(name) <= 4 and name.isalpha():
+                queries.append(("{} {}".format(name, place), filter_dict))
+        return queries
+
+
+    def run_address_misses(self, engine: SearchEngine, dataset: str, df) -> dict:
+        if "address" not in df.columns:
+            return {}
+
+        queries = self.address_miss_queries(dataset, df)
+        partitions = [engine.select_partition(filter_dict) for _, filter_dict in queries]
+        indexes = {key: partition.address_index for key, partition in engine.partitions.items()}
+
+        timings = {"address_miss": [], "address_miss_regex": []}
+        try:
+            for route in ("address_miss", "address_miss_regex"):
+                if route == "address_miss_regex":
+                    # An index that never rejects a row, so the regex runs on every selected address
+                    for partition in engine.partitions.values():
+                        if partition.has_address:
+                            partition.address_index = AddressIndex(partition.addresses, max_edits=sys.maxsize)
+
+                for (query, _), partition in zip(queries, partitions):
+                    start = time.perf_counter()
+                    engine.abbreviation_search(query, partition)
+                    timings[route].append(time.perf_counter() - start)
+        finally:
+            for key, partition in engine.partitions.items():
+                partition.address_index = indexes[key]
+
+        return {route: seconds for route, seconds in timings.items() if seconds}
+
+
+    def run(self, datasets: list, sizes: list) -> dict:
+        results = [self.run_dataset(dataset, rows) for rows in sizes for dataset in datasets]
+        return {"meta": self.meta(), "results": results}
+
+
+    def meta(self) -> dict:
+        return {
+            "commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "encoder": self.encoder,
+            "seed": self.seed,
+            "curricula": self.corpus.curricula,
+            "queries": self.query_count,
+        }
+
+
+def latency_summary(seconds: list) -> dict:
+    milliseconds = np.array(seconds) * 1000
+    return {
+        "queries": len(seconds),
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 4),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 4),
+        "p99_ms": round(float(np.percentile(milliseconds, 99)), 4),
+        "mean_ms": round(float(milliseconds.mean()), 4),
+        "queries_per_second": round(len(seconds) / milliseconds.sum() * 1000, 2) if milliseconds.sum() > 0 else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, threshold: float = 1.2) -> list:
+
+    """
+    Compare two benchmark results, entry by entry (dataset, rows and path).
+    Returns one line per measure that got slower by more than the threshold ratio.
+    """
+
+    regressions = []
+    baseline_results = {(result["dataset"], result["rows"]): result for result in baseline["results"]}
+
+    for result in current["results"]:
+        base = baseline_results.get((result["dataset"], result["rows"]))
+        if base is None:
+            continue
+
+        measures = [("build_seconds", base["build_seconds"], result["build_seconds"])]
+        for route, summary in result["paths"].items():
+            if route in base["paths"]:
+                for name in ("p50_ms", "p95_ms", "p99_ms"):
+                    measures.append(("{} {}".format(route, name), base["paths"][route][name], summary[name]))
+
+        for name, before, after in measures:
+            if before and after / before > threshold:
+                regressions.append("{} {} rows: {} {} -> {} ({:.2f}x)".format(
+                    result["dataset"], result["rows"], name, before, after, after / before))
+
+    return regressions
+
+
+# Run the benchmarks and write the results as JSON, optionally failing on regressions against an earlier run.
+# python -m services.src.search_benchmark --sizes 1000 10000 --output benchmark.json --compare baseline.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the search engine on synthetic corpora")
+    parser.add_argument("--datasets", nargs="+", default=["school", "college", "subject", "major"],
+                        choices=["school", "college", "subject", "major"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--curricula", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--encoder", choices=["hashing", "model"], default="hashing")
+    parser.add_argument("--output", help="File to write the JSON results to, stdout by default")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slow down ratio reported as a regression")
+    args = parser.parse_args()
+
+    benchmark = SearchBenchmark(encoder=args.encoder, seed=args.seed, curricula=args.curricula, queries=args.queries)
+    report = benchmark.run(args.datasets, args.sizes)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for line in regressions:
+            print("Regression:", line, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
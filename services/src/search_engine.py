@@ -1,39 +1,119 @@
 from .abbr_school_matcher import AbbrSchoolMatcher
 from .fuzzy_school_matcher import FuzzySchoolMatcher
+import hashlib
 import json
 from .data_loader import DataLoader
 import pandas as pd
-from .check_pickle_exists import CheckPickleExists
+from .check_pickle_exists import CheckPickleExists, IndexNotBuilt
+from .embedding_matrix import EmbeddingMatrix
+from .corpus_partition import CorpusPartition
+from .corpus_snapshot import CorpusSnapshot
+from .ann_index import AnnIndexBuilder
+from .matcher_pool import matcher_pool, PartialResults, SearchDeadlineExceeded
+from .search_metrics import search_metrics, search_seconds, stage_seconds, partial_results
+import time
 
 
 class SearchEngine(AbbrSchoolMatcher, FuzzySchoolMatcher):
 
     """
-    This class loads the Dataframe and PKL files into memory and performs search.
+    This class loads the Dataframe and the embeddings into memory, splits them into partitions
+    by the filter values of the dataset, and performs search on the partition a request filters on.
     The 'search()' method performs search based on the word lengths in the query.
+    'ann_index' optionally enables an approximate nearest neighbour index for the big partitions,
+    for example {"ENABLED": True, "N_PROBE": 8, "MIN_ROWS": 20000}.
+    'train_options' are passed to the TrainModel that encodes missing partitions.
+    With build_index=False nothing is encoded or trained: the embeddings and ANN indexes built by
+    the build_search_index command are only loaded. The partitions without embeddings are kept in
+    missing_partitions and their searches raise IndexNotBuilt, the engine fails only when none is built.
+    The rows are read once into a CorpusSnapshot, shared with the CheckPickleExists, unless one is given.
     """
 
-    def __init__(self, queryset, dataset: str, options: list = None):
+    def __init__(self,
+                 queryset,
+                 dataset: str,
+                 options: list = None,
+                 ann_index: dict = None,
+                 train_options: dict = None,
+                 build_index: bool = True,
+                 snapshot: CorpusSnapshot = None):
 
         self.loader = DataLoader()
         self.checker = CheckPickleExists(
             queryset=queryset,
             dataset=dataset,
-            options=options
+            options=options,
+            train_options=train_options,
+            build=build_index,
+            snapshot=snapshot
             )
-        self.file_names = self.checker.get_file_names()
 
-        # load data from json file
-        self.json_file = r"services\data\input\query_data.json"
+        # The files are checked before the rows are read, a dataset without any embeddings fails right away
+        self.missing_partitions = {} if build_index else self.checker.check_built()
+        if self.missing_partitions:
+            print("The", dataset, "embeddings", ", ".join(self.missing_partitions.values()),
+                  "are not built, their partitions are not served until build_search_index has run")
+        self.snapshot = self.checker.load_snapshot()
+        self.file_names = {option: file_name for option, file_name in self.checker.get_file_names().items()
+                           if option not in self.missing_partitions}
+
+        # load data from json file, the one the snapshots read their columns from
+        self.json_file = CorpusSnapshot.json_file
         self.json_data = json.load(open(self.json_file))
 
+        self.ann_builder = None
+        if ann_index and ann_index.get("ENABLED"):
+            self.ann_builder = AnnIndexBuilder(
+                n_probe=ann_index.get("N_PROBE", 8),
+                min_rows=ann_index.get("MIN_ROWS", 20000),
+                store=self.loader.store,
+                build=build_index
+                )
+
         self.pkl_data_holder = {}
+        self.embedding_versions = {}
         self.pkl_data_loader()
 
         self.dataset = dataset
         self.required_columns = self.get_required_column_list(dataset=self.dataset)
         self.queryset = queryset
-        self.df = self.create_dataframe_from_queryset(self.queryset)
+        self.setup(self.snapshot.df)
+
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, dataset: str, embeddings: dict, model_name: str = None):
+
+        """
+        Build an engine from a dataframe with the required columns of the dataset, and the EmbeddingMatrix
+        of each option (or of the dataset, when it has no options), without the database and the embedding files.
+        Used by the benchmarks, on synthetic corpora. model_name is the model registry entry that encodes the queries.
+        """
+
+        engine = cls.__new__(cls)
+        engine.loader = DataLoader()
+        engine.snapshot = CorpusSnapshot.from_dataframe(df, dataset)
+        engine.json_file = CorpusSnapshot.json_file
+        engine.json_data = json.load(open(engine.json_file))
+        engine.pkl_data_holder = dict(embeddings)
+        engine.embedding_versions = {}
+        engine.file_names = {}
+        engine.missing_partitions = {}
+        engine.dataset = dataset
+        engine.required_columns = engine.get_required_column_list(dataset=dataset)
+        engine.queryset = None
+        engine.setup(engine.snapshot.df)
+        if model_name:
+            engine.model_name = model_name
+        return engine
+
+
+    def setup(self, df: pd.DataFrame) -> None:
+        self.partition_columns = self.json_data[self.dataset].get("partition_by", [])
+        self.df = df
+
+        # The corpus is split once by the filter values it supports, instead of masking the dataframe per request
+        self.partitions = {}
+        self.build_partitions()
 
         # Initialize the AbbrSchoolMatcher and FuzzySchoolMatcher classes
         super().__init__()
@@ -44,29 +124,47 @@ class SearchEngine(AbbrSchoolMatcher, FuzzySchoolMatcher):
         return self.json_data[dataset]["columns_required"]
 
 
-    def create_dataframe_from_queryset(self, queryset):
-        data = list(queryset.values_list(*self.required_columns))
-        df = pd.DataFrame(data, columns=self.required_columns)
+    def is_current(self, snapshot: CorpusSnapshot) -> bool:
 
-        if "address" in self.required_columns:
-            df["concat"] = df["name"] + " " + df["address"]
-            # clean all the data in concat column
-            df["concat"] = df["concat"].apply(self.loader.clean_string)
-        else:
-            df["concat"] = df["name"] 
-            # clean all the data in concat column
-            df["concat"] = df["concat"].apply(self.loader.clean_string)
+        """
+        True when the engine was built from the same rows as the snapshot, and from the versions of the
+        embedding files that are current on disk, so rebuilding it would give the same engine.
+        A missing partition whose embeddings were built since makes the engine out of date.
+        """
+
+        if snapshot.content_hash != self.snapshot.content_hash:
+            return False
+        return not self.embeddings_changed()
+
+
+    @property
+    def version(self) -> str:
+        # The rows, the embedding file versions and the model the engine serves, the search results are cached by it
+        served = json.dumps([self.snapshot.content_hash, self.embedding_versions, self.model_name], sort_keys=True)
+        return hashlib.sha1(served.encode("utf-8")).hexdigest()
 
-        return df
+
+    def embeddings_changed(self) -> bool:
+        # A new version of an embeddings file, or the file of a missing partition, was written since the engine loaded
+        if any(self.loader.store.exists(file_name) for file_name in self.missing_partitions.values()):
+            return True
+        return any(self.loader.store.load_manifest(file_name).get("version") != self.embedding_versions.get(option)
+                   for option, file_name in self.file_names.items())
 
 
     def pkl_data_loader(self):
+
+        # The embedding matrix of each partition is memory mapped, so it is shared by all the workers
+        # Partitions big enough for the ANN index get it attached, the others keep using exact search
         for dataset_name, file_name in self.file_names.items():
-            pkl_data = self.loader.load_pkl(file_name)
-            self.pkl_data_holder[dataset_name] = pkl_data
+            embeddings = self.loader.load_embeddings(file_name)
+            self.embedding_versions[dataset_name] = self.loader.store.load_manifest(file_name).get("version")
+            if self.ann_builder:
+                self.ann_builder.attach(embeddings, file_name)
+            self.pkl_data_holder[dataset_name] = embeddings
 
 
-    def select_dataset(self, option: str = None) -> tuple:
+    def select_dataset(self, option: str = None) -> EmbeddingMatrix:
         if not option:
             pkl_data = self.pkl_data_holder[self.dataset]
             return pkl_data
@@ -74,39 +172,101 @@ class SearchEngine(AbbrSchoolMatcher, FuzzySchoolMatcher):
             pkl_data = self.pkl_data_holder[option]
             return pkl_data
 
+
+    @staticmethod
+    def partition_key(filters: dict) -> tuple:
+        return tuple(sorted(filters.items()))
+
+
+    def build_partitions(self) -> None:
+
+        """
+        Datasets without options have a single partition holding the whole corpus.
+        Otherwise there is one partition per option, with the embeddings of its file, and, for the
+        other filter columns of the dataset (education_level for subjects), one partition for each of
+        their values inside an option, holding the matching rows of the option's embeddings.
+        """
+
+        if self.dataset in self.pkl_data_holder:
+            self.partitions[()] = CorpusPartition.from_dataframe({}, self.df, self.select_dataset())
+            return
+
+        first_column = self.partition_columns[0]
+        option_dfs = dict(list(self.df.groupby(first_column, sort=False)))
+
+        for option in self.pkl_data_holder:
+            filters = {first_column: option.upper()}
+            option_df = option_dfs.get(option.upper(), self.df.iloc[0:0])
+            partition = CorpusPartition.from_dataframe(filters, option_df, self.select_dataset(option=option))
+            self.partitions[self.partition_key(filters)] = partition
+
+            for column in self.partition_columns[1:]:
+                for value, value_df in option_df.groupby(column, sort=False):
+                    value_filters = {first_column: option.upper(), column: value}
+                    sub_partition = CorpusPartition.from_dataframe(value_filters, value_df, None)
+                    sub_partition.embeddings = sub_partition.subset_embeddings(partition.embeddings)
+                    self.partitions[self.partition_key(value_filters)] = sub_partition
+
+
+    def select_partition(self, filter_dict: dict = None) -> CorpusPartition:
+        try:
+            return self.partitions[self.partition_key(filter_dict or {})]
+        except KeyError:
+            filters = filter_dict or {}
+            option = filters.get(self.partition_columns[0]) if self.partition_columns else None
+            if option and option.lower() in self.missing_partitions:
+                raise IndexNotBuilt("The {} embeddings of {} are not built yet, run: python manage.py "
+                                    "build_search_index".format(self.dataset, option)) from None
+
+            # A value of the other filter columns that no row of the option has, for example an education level
+            # a board does not teach, matches nothing
+            option_key = self.partition_key({self.partition_columns[0]: option}) if option else None
+            if option_key in self.partitions and set(filters) <= set(self.partition_columns):
+                return self.empty_partition(filters, self.partitions[option_key])
+            raise
+
+
+    @staticmethod
+    def empty_partition(filters: dict, option_partition: CorpusPartition) -> CorpusPartition:
+        embeddings = EmbeddingMatrix([], option_partition.embeddings.matrix[:0])
+        return CorpusPartition(filters, [], [] if option_partition.has_address else None, [], embeddings)
+
     
     # function to subject search using fuzzy only
-    def subject_search(self, query: str, filters: dict, embeddings) -> list:
+    def subject_search(self, query: str, partition: CorpusPartition, candidates: int = None, limit: int = None) -> list:
 
-        filtered_df = self.filter_df(filters=filters)
         query = self.loader.clean_string(query)
-        results = self.fuzzy_search(query=query,
-                                    df=filtered_df,
-                                    embeddings=embeddings)
+        results = self.fuzzy_search(query=query, partition=partition, candidates=candidates, limit=limit)
         return results
     
 
     def search(self,
                query: str,
                filter_dict: dict = None,
-               subject: bool = False) -> list:
-        
-        if filter_dict:
-            embeddings = self.select_dataset(
-                option=filter_dict["curriculum__abbreviation"].lower()
-                )
-            filtered_df = self.filter_df(filters=filter_dict)
-        else:
-            filtered_df = self.df
-            embeddings = self.select_dataset()
-        
-        
-        if subject:
-            return self.subject_search(
-                query=query,
-                filters=filter_dict,
-                embeddings=embeddings
-                )
+               subject: bool = False,
+               limit: int = None,
+               candidates: int = None) -> list:
+
+        # The time of the whole search is recorded per dataset and route, the stages record their own
+        start = time.perf_counter()
+        route = "subject" if subject else self.query_route(query.split())
+        try:
+            with search_metrics.timer(stage_seconds, self.dataset, "partition"):
+                partition = self.select_partition(filter_dict)
+            return self.search_partition(query, partition, route, limit=limit, candidates=candidates)
+        finally:
+            search_seconds.observe(time.perf_counter() - start, self.dataset, route)
+
+
+    def search_partition(self,
+                         query: str,
+                         partition: CorpusPartition,
+                         route: str,
+                         limit: int = None,
+                         candidates: int = None) -> list:
+
+        if route == "subject":
+            return self.subject_search(query=query, partition=partition, candidates=candidates, limit=limit)
 
 
         """
@@ -115,40 +275,68 @@ class SearchEngine(AbbrSchoolMatcher, FuzzySchoolMatcher):
         if all words are greater than 4 characters, perform fuzzy search
         else perform both and combine the results.
         Fuzzy search requires a cleaned string, abbreviation search does not.
+        limit is the number of matches each of them keeps, 10 for abbreviation search and 5 for fuzzy search
+        when it is not given. candidates is the number of embedding matches that fuzzy search reranks, 25 by default.
         """
 
         words = query.split()
-        if all(len(word) <= 4 for word in words):
-            results = self.abbreviation_search(query=query, df=filtered_df)
+        if route == "abbreviation":
+            results = self.abbreviation_search(query=query, partition=partition, limit=limit)
+            return self.sort_results(results)
 
-        elif all(len(word) > 4 for word in words):
+        elif route == "fuzzy":
             query = self.loader.clean_string(query)
-            results = self.fuzzy_search(query=query,
-                                        df=filtered_df,
-                                        embeddings=embeddings)
+            results = self.fuzzy_search(query=query, partition=partition, candidates=candidates, limit=limit)
+            return self.sort_results(results)
+
+        """
+        Mixed queries run both matchers concurrently on the shared matcher pool.
+        A matcher that misses the deadline gives None; the other one's results are still returned,
+        marked as partial so they are not cached.
+        """
+        cleaned_query = self.loader.clean_string(query)
+        abbreviation_results, fuzzy_results = matcher_pool.run([
+            lambda: self.abbreviation_search(query=query, partition=partition, limit=limit),
+            lambda: self.fuzzy_search(query=cleaned_query, partition=partition, candidates=candidates, limit=limit),
+        ])
+
+        if abbreviation_results is None and fuzzy_results is None:
+            raise SearchDeadlineExceeded("The search for '{}' did not finish before the deadline".format(query))
+
+        results = self.sort_results(self.combine_results(words, abbreviation_results or [], fuzzy_results or []), merged=True)
+        if abbreviation_results is None or fuzzy_results is None:
+            partial_results.inc(self.dataset)
+            return PartialResults(results)
+        return results
+
+
+    @staticmethod
+    def query_route(words: list) -> str:
+        if all(len(word) <= 4 for word in words):
+            return "abbreviation"
+        elif all(len(word) > 4 for word in words):
+            return "fuzzy"
+        return "hybrid"
+
+
+    def combine_results(self, words: list, abbreviation_results: list, fuzzy_results: list) -> list:
+
+        # Count the number of words with length <= 4 and > 4
+        count_short_words = sum(1 for word in words if len(word) <= 4)
+        count_long_words = sum(1 for word in words if len(word) > 4)
+
+        """
+        Adjust the score based on the count of short and long words.
+        If the count of short words is less than the count of long words, adjust the score of fuzzy results,
+        else adjust the score of abbreviation results.
+        """
+        if count_short_words < count_long_words:
+            return self.add_bias(fuzzy_results) + abbreviation_results
+        return fuzzy_results + self.add_bias(abbreviation_results)
+
+
+    def sort_results(self, results: list, merged: bool = False) -> list:
 
-        else:
-            abbreviation_results = self.abbreviation_search(query=query, df=filtered_df)
-            query = self.loader.clean_string(query)
-            fuzzy_results = self.fuzzy_search(query=query,
-                                              df=filtered_df,
-                                              embeddings=embeddings)
-
-            # Count the number of words with length <= 4 and > 4
-            count_short_words = sum(1 for word in words if len(word) <= 4)
-            count_long_words = sum(1 for word in words if len(word) > 4)
-
-            """
-            Adjust the score based on the count of short and long words.
-            If the count of short words is less than the count of long words, adjust the score of fuzzy results,
-            else adjust the score of abbreviation results.
-            """
-            if count_short_words < count_long_words:
-                results = [(name, address, score + 10) if score is not None else None for name, address, score in fuzzy_results] + abbreviation_results
-            else:
-                results = fuzzy_results + [(name, address, score + 10) if score is not None else None for name, address, score in abbreviation_results]
-                # results = fuzzy_results + abbreviation_results
-        
         # Filter out non-null results, sort by score, and return
         non_null_results = [result for result in results if result is not None]
         try:
@@ -157,38 +345,117 @@ class SearchEngine(AbbrSchoolMatcher, FuzzySchoolMatcher):
             non_null_results.sort(key=lambda x: x[1], reverse=True)
         except Exception:
             return non_null_results
-        
+
+        if merged:
+            # A school found by both matchers keeps only its best scored entry
+            non_null_results = self.drop_duplicates(non_null_results)
+
         return non_null_results
 
 
+    def search_batch(self,
+                     items: list,
+                     subject: bool = False,
+                     limit: int = None,
+                     candidates: int = None) -> list:
+        return list(self.iter_search_batch(items, subject=subject, limit=limit, candidates=candidates))
+
+
+    def iter_search_batch(self,
+                          items: list,
+                          subject: bool = False,
+                          limit: int = None,
+                          candidates: int = None,
+                          chunk_size: int = None):
+
+        """
+        Search a list of (query, filter_dict) items and yield the results of each item, in the input order,
+        the same as search() would return them.
+        The queries that need fuzzy search are encoded with a single model call, and the queries of each
+        partition are scored against its matrix with a single matrix product. With a chunk_size,
+        the items are processed chunk_size at a time, so the first results can be sent before the last are computed.
+        """
+
+        chunk_size = chunk_size or max(len(items), 1)
+        for chunk_start in range(0, len(items), chunk_size):
+            chunk = items[chunk_start:chunk_start + chunk_size]
+
+            # Find out which matchers and partition every item needs
+            plans = []
+            partitions = {}
+            for query, filter_dict in chunk:
+                words = query.split()
+                route = "subject" if subject else self.query_route(words)
+                cleaned_query = self.loader.clean_string(query) if route != "abbreviation" else None
+                key = self.partition_key(filter_dict or {})
+                if key not in partitions:
+                    partitions[key] = self.select_partition(filter_dict)
+                plans.append((query, words, route, cleaned_query, key))
+
+            # Encode all the fuzzy queries at once, then score them partition by partition
+            fuzzy_positions = [position for position, plan in enumerate(plans) if plan[3] is not None]
+            embeddings = dict(zip(fuzzy_positions, self.encode_queries([plans[position][3] for position in fuzzy_positions])))
+
+            fuzzy_results = {}
+            for key in dict.fromkeys(plans[position][4] for position in fuzzy_positions):
+                positions = [position for position in fuzzy_positions if plans[position][4] == key]
+                batch_results = self.fuzzy_using_embeddings([plans[position][3] for position in positions],
+                                                            [embeddings[position] for position in positions],
+                                                            partitions[key],
+                                                            candidates=candidates or 25,
+                                                            limit=limit or 5)
+                fuzzy_results.update(zip(positions, batch_results))
+
+            for position, (query, words, route, cleaned_query, key) in enumerate(plans):
+                if route == "subject":
+                    yield fuzzy_results[position]
+                elif route == "fuzzy":
+                    yield self.sort_results(fuzzy_results[position])
+                else:
+                    abbreviation_results = self.abbreviation_search(query=query, partition=partitions[key], limit=limit)
+                    if route == "abbreviation":
+                        yield self.sort_results(abbreviation_results)
+                    else:
+                        yield self.sort_results(self.combine_results(words, abbreviation_results, fuzzy_results[position]), merged=True)
+
+
+    @staticmethod
+    def add_bias(results: list, bias: int = 10) -> list:
+        # The score is the last item of a result, with or without an address before it
+        return [result[:-1] + (result[-1] + bias,) if result[-1] is not None else None for result in results]
+
+
+    @staticmethod
+    def drop_duplicates(results: list) -> list:
+        # Results are sorted by score, so the first entry of a school is its best one
+        seen = set()
+        unique_results = []
+        for result in results:
+            school = result[:-1]
+            if school not in seen:
+                seen.add(school)
+                unique_results.append(result)
+        return unique_results
+
+
     def fuzzy_search(self,
                      query: str,
-                     df: pd.DataFrame,
-                     embeddings) -> list:
+                     partition: CorpusPartition,
+                     candidates: int = None,
+                     limit: int = None) -> list:
 
         # Perform fuzzy search using FuzzySchoolMatcher's fuzzy_using_ST method
-        return super().fuzzy_using_ST(query=query,
-                                      df=df,
-                                      embeddings=embeddings)
+        return super().fuzzy_using_ST(query=query, partition=partition, candidates=candidates or 25, limit=limit or 5)
 
 
     def abbreviation_search(self,
                             query: str,
-                            df = pd.DataFrame) -> list:
+                            partition: CorpusPartition,
+                            limit: int = None) -> list:
 
         # Perform abbreviation search using AbbrSchoolMatcher's abbreviation_search method
-        return super().abbreviation_search(query=query, df=df)
-
-
-    # function to filter the dataframe based on the filters
-    # filters is a dictionary with key as column name and value as the value to be filtered
-    def filter_df(self, filters: dict) -> list:
-
-        filtered_df = self.df
-        for key, value in filters.items():
-            filtered_df = filtered_df[filtered_df[key] == value]
-
-        return filtered_df
+        with search_metrics.timer(stage_seconds, self.dataset, "abbreviation"):
+            return super().abbreviation_search(query=query, partition=partition, limit=limit or 10)
 
 
 # search = SearchEngine()
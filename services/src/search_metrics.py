@@ -0,0 +1,223 @@
+import bisect
+import math
+import threading
+import time
+
+
+class Metric:
+
+    """
+    A metric with a fixed list of label names, holding one value per combination of label values.
+    The label values are given positionally, in the order of the label names, to keep recording cheap.
+    """
+
+    type_name = None
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.registry = None
+
+
+    @property
+    def enabled(self) -> bool:
+        return self.registry is None or self.registry.enabled
+
+
+    def format_labels(self, label_values: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.label_names, label_values)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, escape_label(value)) for name, value in pairs) + "}"
+
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} {}".format(self.name, self.type_name)]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values, key=lambda item: tuple(map(str, item[0]))):
+            lines.append("{}{} {}".format(self.name, self.format_labels(label_values), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, *label_values, value: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, *label_values) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+
+    """
+    Counts the observations per bucket, plus their sum and count, per combination of label values.
+    Recording is a bisect on the bucket bounds and three additions under a lock.
+    """
+
+    type_name = "histogram"
+
+    # Seconds, from 0.5ms to 10s
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = None):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+
+    def observe(self, value: float, *label_values) -> None:
+        if not self.enabled:
+            return
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                # Counts of each bucket and of +Inf, the sum and the count
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][position] += 1
+            entry[1] += value
+            entry[2] += 1
+
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            values = [(label_values, (list(entry[0]), entry[1], entry[2])) for label_values, entry in self.values.items()]
+
+        for label_values, (counts, total, count) in sorted(values, key=lambda item: tuple(map(str, item[0]))):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                labels = self.format_labels(label_values, {"le": format_value(bound)})
+                lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+            lines.append("{}_sum{} {}".format(self.name, self.format_labels(label_values), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, self.format_labels(label_values), count))
+        return lines
+
+
+class Timer:
+
+    # Context manager that observes the seconds spent in its block
+
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+
+class MetricsRegistry:
+
+    """
+    The metrics of the search pipeline, rendered in the Prometheus text format by the metrics endpoint.
+    Collectors are functions called on every render, for values that are already counted elsewhere,
+    like the hits of the query embedding cache. They return lines of the text format.
+    Recording can be switched off with enabled, the metrics then keep the values they had.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics = []
+        self.collectors = []
+
+
+    def register(self, metric: Metric) -> Metric:
+        metric.registry = self
+        self.metrics.append(metric)
+        return metric
+
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+
+
+    def gauge(self, name: str, help_text: str, label_names: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names))
+
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = None) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+
+    def add_collector(self, collector) -> None:
+        self.collectors.append(collector)
+
+
+    def timer(self, histogram: Histogram, *label_values) -> Timer:
+        return Timer(histogram, label_values)
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_samples(name: str, type_name: str, help_text: str, samples: list) -> list:
+
+    """
+    Lines of one metric for a collector, from a list of (labels dict, value).
+    """
+
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, type_name)]
+    for labels, value in samples:
+        label_text = ",".join('{}="{}"'.format(key, escape_label(label)) for key, label in labels.items())
+        lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", format_value(value)))
+    return lines
+
+
+search_metrics = MetricsRegistry()
+
+# Time of a whole SearchEngine.search call, per dataset and route (abbreviation, fuzzy, hybrid or subject)
+search_seconds = search_metrics.histogram(
+    "search_request_seconds", "Time of SearchEngine.search per dataset and route", ("dataset", "route"))
+
+# Time of each stage: partition, abbreviation, encode, similarity and rerank
+stage_seconds = search_metrics.histogram(
+    "search_stage_seconds", "Time of each stage of a search per dataset", ("dataset", "stage"))
+
+# Rows the last search of a dataset looked at: acronym index candidates, and embedding candidates reranked
+candidate_count = search_metrics.gauge(
+    "search_candidates", "Candidates of the last search per dataset and matcher", ("dataset", "matcher"))
+
+# Searches where a matcher missed the deadline
+partial_results = search_metrics.counter(
+    "search_partial_results_total", "Searches returned without the results of a matcher that missed the deadline", ("dataset",))
@@ -0,0 +1,165 @@
+import random
+import pandas as pd
+
+
+CURRICULA = ["CBSE", "ICSE", "IB", "IGCSE", "SSC", "HSC", "NIOS", "CIE"]
+
+EDUCATION_LEVELS = ["ssc", "hsc", "ug", "pg", "phd"]
+
+PLACES = [
+    ("Delhi", "Delhi"), ("Mumbai", "Maharashtra"), ("Pune", "Maharashtra"), ("Kolkata", "West Bengal"),
+    ("Chennai", "Tamil Nadu"), ("Bengaluru", "Karnataka"), ("Hyderabad", "Telangana"), ("Lucknow", "Uttar Pradesh"),
+    ("Jaipur", "Rajasthan"), ("Ahmedabad", "Gujarat"), ("Bhopal", "Madhya Pradesh"), ("Patna", "Bihar"),
+    ("Chandigarh", "Punjab"), ("Guwahati", "Assam"), ("Kochi", "Kerala"), ("Dehradun", "Uttarakhand"),
+    ("Ranchi", "Jharkhand"), ("Bhubaneswar", "Odisha"), ("Shimla", "Himachal Pradesh"), ("Panaji", "Goa"),
+]
+
+AREAS = ["R K Puram", "Vasant Kunj", "Salt Lake", "Civil Lines", "Model Town", "Sector", "Gandhi Nagar",
+         "Rajaji Nagar", "Banjara Hills", "Anna Nagar", "Malviya Nagar", "Ashok Vihar", "Shanti Nagar", "Old City"]
+
+SCHOOL_FIRST_WORDS = ["Delhi", "St. Xavier's", "St. Mary's", "Kendriya", "Sacred Heart", "Little Flower", "Modern",
+                      "Army", "Holy Cross", "Don Bosco", "Carmel", "Springdale", "Greenwood", "Mount Carmel",
+                      "Sri Chaitanya", "Bal Bharati", "Ryan", "National", "Loyola", "St. Joseph's", "Jawahar",
+                      "Guru Nanak", "Sardar Patel", "Vivekananda", "DAV", "Amity", "Podar", "Kamla Nehru"]
+
+SCHOOL_SECOND_WORDS = ["Public", "Convent", "Vidyalaya", "International", "Model", "Memorial", "Central",
+                       "English Medium", "Residential", "Higher Secondary", "Senior Secondary", "Girls", "Boys"]
+
+SCHOOL_LAST_WORDS = ["School", "Academy", "High School", "School & College", "Institute"]
+
+COLLEGE_FIRST_WORDS = ["Indian", "National", "Global", "Royal", "State", "Eastern", "Western", "Northern", "Southern",
+                       "Pacific", "Atlantic", "Central", "Metropolitan", "Technical", "Synergy", "Heritage", "Apex"]
+
+COLLEGE_KINDS = ["University", "Institute of Technology", "College of Engineering", "School of Business",
+                 "College of Arts and Science", "Medical College", "Institute of Management", "Polytechnic"]
+
+COUNTRIES = ["India", "United States", "United Kingdom", "Canada", "Australia", "Germany", "Singapore", "Japan"]
+
+SUBJECTS = ["Mathematics", "Physics", "Chemistry", "Biology", "English", "Hindi", "History", "Geography",
+            "Economics", "Computer Science", "Accountancy", "Business Studies", "Political Science", "Sanskrit",
+            "Physical Education", "Psychology", "Sociology", "Fine Arts", "Music", "Home Science"]
+
+SUBJECT_VARIANTS = ["", " Standard", " Basic", " Advanced", " I", " II", " Core", " Elective", " Applied", " Practical"]
+
+MAJORS = ["Computer Science", "Mechanical Engineering", "Electrical Engineering", "Civil Engineering",
+          "Biochemistry", "Biotechnology", "Agriculture", "Economics", "Finance", "Marketing", "Psychology",
+          "Mathematics", "Statistics", "Data Science", "Architecture", "Law", "Medicine", "Pharmacy", "Philosophy"]
+
+MAJOR_VARIANTS = ["", " and Engineering", " with Honours", " Management", " Technology", " Sciences", " Studies"]
+
+
+class SyntheticCorpus:
+
+    """
+    Generates reproducible school, college, subject and major datasets of any size, with the columns of
+    query_data.json, and a realistic mix of queries against them, for the search benchmarks.
+    Names are made of common school name words, so acronyms collide the way real ones do ("dps", "kv"),
+    and rows are spread evenly over the first 'curricula' curricula. The same seed gives the same rows and queries.
+    """
+
+    def __init__(self, seed: int = 0, curricula: int = 3):
+        self.seed = seed
+        self.curricula = CURRICULA[:max(1, min(curricula, len(CURRICULA)))]
+
+
+    def generate(self, dataset: str, rows: int) -> pd.DataFrame:
+        generator = getattr(self, "generate_" + dataset)
+        return generator(random.Random("{}-{}-{}".format(self.seed, dataset, rows)), rows)
+
+
+    def generate_school(self, rng: random.Random, rows: int) -> pd.DataFrame:
+        records = []
+        for row in range(rows):
+            name = " ".join([rng.choice(SCHOOL_FIRST_WORDS), rng.choice(SCHOOL_SECOND_WORDS), rng.choice(SCHOOL_LAST_WORDS)])
+            city, state = rng.choice(PLACES)
+            area = rng.choice(AREAS)
+            if area == "Sector":
+                area = "Sector {}".format(rng.randint(1, 60))
+            address = "{}, {}, {}".format(area, city, state)
+            records.append((name, address, self.curricula[row % len(self.curricula)]))
+        return pd.DataFrame(records, columns=["name", "address", "curriculum__abbreviation"])
+
+
+    def generate_college(self, rng: random.Random, rows: int) -> pd.DataFrame:
+        records = []
+        for _ in range(rows):
+            city, _ = rng.choice(PLACES)
+            first_word = rng.choice(COLLEGE_FIRST_WORDS + [city])
+            name = "{} {}".format(first_word, rng.choice(COLLEGE_KINDS))
+            records.append((name, rng.choice(COUNTRIES)))
+        return pd.DataFrame(records, columns=["name", "address"])
+
+
+    def generate_subject(self, rng: random.Random, rows: int) -> pd.DataFrame:
+        records = []
+        for row in range(rows):
+            name = rng.choice(SUBJECTS) + rng.choice(SUBJECT_VARIANTS)
+            records.append((name, self.curricula[row % len(self.curricula)], rng.choice(EDUCATION_LEVELS)))
+        return pd.DataFrame(records, columns=["name", "curriculum__abbreviation", "education_level"])
+
+
+    def generate_major(self, rng: random.Random, rows: int) -> pd.DataFrame:
+        records = [(rng.choice(MAJORS) + rng.choice(MAJOR_VARIANTS),) for _ in range(rows)]
+        return pd.DataFrame(records, columns=["name"])
+
+
+    def queries(self, dataset: str, df: pd.DataFrame, count: int) -> list:
+
+        """
+        Return count (query, filter_dict) pairs for a dataset, drawn from its rows:
+        - acronyms of names, alone or with the acronym of the area ("dps", "dps rkp")
+        - full names, with or without a word of the address ("delhi public school", "delhi public school lucknow")
+        - mixed queries, an acronym with a long word of the address ("dps delhi")
+        - full names with a typo (a dropped, doubled or swapped letter)
+        Every query filters on the curriculum of its row, when the dataset has one.
+        """
+
+        rng = random.Random("{}-{}-queries-{}".format(self.seed, dataset, len(df)))
+        kinds = ["acronym", "name", "mixed", "typo"]
+        queries = []
+
+        for position in range(count):
+            record = df.iloc[rng.randrange(len(df))]
+            kind = kinds[position % len(kinds)]
+            name = record["name"].replace(".", "").replace("'", "").lower()
+            address = record["address"].replace(",", "").lower() if "address" in df.columns else ""
+
+            if kind == "acronym":
+                query = acronym(name)
+                if address and rng.random() < 0.5:
+                    query += " " + acronym(address.split(" ")[0] + " " + " ".join(address.split(" ")[1:2]))
+            elif kind == "name":
+                query = name
+                address_words = [word for word in address.split(" ") if len(word) > 4]
+                if address_words and rng.random() < 0.5:
+                    query += " " + rng.choice(address_words)
+            elif kind == "mixed":
+                long_words = [word for word in address.split(" ") if len(word) > 4] or [word for word in name.split(" ") if len(word) > 4]
+                query = acronym(name) + " " + rng.choice(long_words) if long_words else acronym(name)
+            else:
+                query = add_typo(rng, name)
+
+            filter_dict = None
+            if "curriculum__abbreviation" in df.columns:
+                filter_dict = {"curriculum__abbreviation": record["curriculum__abbreviation"]}
+            queries.append((query.strip(), filter_dict))
+
+        return queries
+
+
+def acronym(text: str) -> str:
+    return "".join(word[0] for word in text.split() if word)
+
+
+def add_typo(rng: random.Random, text: str) -> str:
+    positions = [position for position, char in enumerate(text) if char.isalpha()]
+    if len(positions) < 2:
+        return text
+
+    position = rng.choice(positions[:-1])
+    kind = rng.randrange(3)
+    if kind == 0:
+        return text[:position] + text[position + 1:]
+    if kind == 1:
+        return text[:position] + text[position] + text[position:]
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
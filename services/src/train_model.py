@@ -1,7 +1,9 @@
-import pickle
-from sentence_transformers import SentenceTransformer
 from .data_loader import DataLoader
+from .model_registry import model_registry, DEFAULT_MODEL_NAME
+from .embedding_matrix import EmbeddingMatrix
+import numpy as np
 import pandas as pd
+import time
 
 
 class TrainModel:
@@ -9,60 +11,98 @@ class TrainModel:
     """
     This class is used to train the sentence transformer model on the dataset.
     It loads the dataframe and encodes the concatenated columns into embeddings.
-    The final embeddings are saved to a pickle file.
+    The strings are encoded in batches of batch_size. Partitions with at least pool_min_rows rows
+    are encoded by a pool of 'processes' worker processes, when processes is bigger than 1.
+    The final embeddings are saved as a memory mapped matrix, using the EmbeddingStore.
     """
-    def __init__(self):
+    def __init__(self, batch_size: int = 64, processes: int = 0, pool_min_rows: int = 50000):
         
-        self.model_name = 'all-MiniLM-L6-v2'
-        self.model = SentenceTransformer(self.model_name)
-
+        self.model_name = DEFAULT_MODEL_NAME
         self.loader = DataLoader()
-    
 
-    def train(self, df: pd.DataFrame, file_name: str):
-        print("Encoding the model...")
+        self.batch_size = batch_size
+        self.processes = processes
+        self.pool_min_rows = pool_min_rows
+
+
+    @property
+    def model(self):
+        # The model is only loaded when something has to be encoded, and is shared with the matchers
+        return model_registry.get_model(self.model_name)
+
+
+    def encode_values(self, values: list) -> tuple:
 
-        dataset_embeddings = {}
-        
         """
-        Encode the concatenated columns into embeddings, and save them to a dictionary
-        with the key as the concatenated string and the value as the embedding
+        Encode a list of strings into a matrix with one row per string.
+        Returns the matrix and a throughput report, which is also printed so rebuilds can be sized.
         """
-        for index, row in df.iterrows():
-            name_address = row["concat"]
-            embedding = self.model.encode(name_address)
-            dataset_embeddings[name_address] = embedding
 
-        self.save_embeddings(dataset_embeddings, file_name)       
+        start = time.perf_counter()
+
+        if not values:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        elif self.processes > 1 and len(values) >= self.pool_min_rows:
+            pool = self.model.start_multi_process_pool(target_devices=["cpu"] * self.processes)
+            try:
+                matrix = self.model.encode_multi_process(values, pool, batch_size=self.batch_size)
+            finally:
+                self.model.stop_multi_process_pool(pool)
+        else:
+            matrix = self.model.encode(values,
+                                       batch_size=self.batch_size,
+                                       show_progress_bar=False,
+                                       convert_to_numpy=True)
+
+        seconds = time.perf_counter() - start
+        report = {
+            "rows": len(values),
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(len(values) / seconds, 1) if seconds > 0 else None,
+        }
+        print("Encoded {rows} rows in {seconds}s ({rows_per_second} rows/s)".format(**report))
+
+        return matrix, report
+    
 
+    def train(self, df: pd.DataFrame, file_name: str) -> dict:
+        print("Encoding the model...")
+
+        """
+        Encode the concatenated columns into embeddings, with one row for every distinct concatenated
+        string, in the order they first appear in the dataframe
+        """
+        keys = list(dict.fromkeys(df["concat"]))
+        matrix, report = self.encode_values(keys)
 
-    # Function to update the pickle file by encoding the new values and saving them
-    def update_pickle_values(self, data: set(), file_name: str):
+        self.save_embeddings(EmbeddingMatrix(keys, EmbeddingMatrix.normalize(matrix)), file_name)
+        return report
 
-        dataset_embeddings = self.loader.load_pkl(file_name)
 
-        # encode the new values
-        for value in data:
-            embedding = self.model.encode(value)
-            dataset_embeddings[value] = embedding
+    def update_embeddings(self, values_to_encode: set, values_to_delete: set, file_name: str) -> dict:
 
-        self.save_embeddings(dataset_embeddings, file_name)
+        """
+        Bring the stored embeddings up to date in one new version: the rows of the deleted values are dropped,
+        and the new values are encoded in one batched pass and appended.
+        """
 
+        dataset_embeddings = self.loader.load_embeddings(file_name, mmap=False)
+        keep_rows = [row for row, key in enumerate(dataset_embeddings.keys) if key not in values_to_delete]
+        keys = [dataset_embeddings.keys[row] for row in keep_rows]
+        matrix = dataset_embeddings.matrix[keep_rows]
 
-    def delete_extra_values(self, data: set(), file_name: str):
-        
-        dataset_embeddings = self.loader.load_pkl(file_name)
-        for value in data:
-            del dataset_embeddings[value]
+        new_keys = sorted(values_to_encode)
+        new_matrix, report = self.encode_values(new_keys)
+        if new_keys:
+            new_rows = EmbeddingMatrix(new_keys, EmbeddingMatrix.normalize(new_matrix))
+            matrix = np.vstack([matrix, new_rows.matrix]) if len(keys) else new_rows.matrix
+            keys = keys + new_rows.keys
 
-        self.save_embeddings(dataset_embeddings, file_name)
+        self.save_embeddings(EmbeddingMatrix(keys, matrix), file_name)
+        return report
 
     
-    def save_embeddings(self, embeddings, file_name: str):
-        output_path = r"services\data\cache\\"
-        dest_path = output_path + file_name
-
-        with open(dest_path, "wb") as f:
-            pickle.dump(embeddings, f)
+    def save_embeddings(self, embeddings: EmbeddingMatrix, file_name: str):
+        self.loader.store.save(embeddings, file_name, model_name=self.model_name)
 
-        print("Embeddings saved to: ", dest_path, "\n")
\ No newline at end of file
+        print("Embeddings saved to: ", self.loader.store.manifest_path(file_name), "\n")
\ No newline at end of file